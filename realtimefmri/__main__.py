@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import argparse
 
-from realtimefmri import collect, collect_ttl, preprocess, web_interface
+from realtimefmri import (collect, collect_ttl, decoding, delivery, preprocess, runtime,
+                          web_interface)
 
 
 def parse_arguments():
@@ -31,6 +32,47 @@ def parse_arguments():
                          help='Name of preprocessing configuration file')
     preproc.add_argument('-v', '--verbose', action='store_true',
                          dest='verbose', default=True)
+    preproc.add_argument('--staged', action='store_true', dest='staged', default=None,
+                         help='Run pipeline stages in separate threads')
+
+    run = subcommand.add_parser('run',
+                                help="""Synchronize, collect, and preprocess in a single
+                                        process""")
+    run.set_defaults(command_name='run')
+    run.add_argument('recording_id', action='store',
+                     help='Unique recording identifier for this run')
+    run.add_argument('preproc_config', action='store',
+                     help='Name of preprocessing configuration file')
+    run.add_argument('--ttl-source', action='store', dest='ttl_source', default='keyboard',
+                     help='''TTL source. keyboard, serial, redis, or simulate''')
+    run.add_argument('--directory', action='store', dest='directory', default=None,
+                     help='Directory to monitor for new dicom files')
+    run.add_argument('-v', '--verbose', action='store_true',
+                     dest='verbose', default=True)
+
+    worker = subcommand.add_parser('worker',
+                                   help="""Run remote preprocessing steps for other hosts""")
+    worker.set_defaults(command_name='worker')
+    worker.add_argument('preproc_config', action='store',
+                        help='Name of preprocessing configuration file')
+    worker.add_argument('--steps', action='store', nargs='+', dest='steps', default=None,
+                        help='Names of the steps to serve. Defaults to all remote steps')
+
+    convert = subcommand.add_parser('convert_model',
+                                    help="""Convert pickled decoders to the compact model
+                                            format""")
+    convert.set_defaults(command_name='convert_model')
+    convert.add_argument('pickle_paths', action='store', nargs='+',
+                         help='Paths to pickled scikit-learn estimators')
+
+    stand_in = subcommand.add_parser('http_stand_in',
+                                     help="""Run a local HTTP server that accepts the posts of
+                                             delivery steps, for testing""")
+    stand_in.set_defaults(command_name='http_stand_in')
+    stand_in.add_argument('--host', action='store', dest='host', default='127.0.0.1')
+    stand_in.add_argument('--port', action='store', type=int, dest='port', default=8001)
+    stand_in.add_argument('--delay', action='store', type=float, dest='delay', default=0.,
+                          help='Seconds to wait before responding')
 
     simul = subcommand.add_parser('simulate',
                                   help="""Simulate a real-time experiment""")
@@ -56,7 +98,23 @@ def main():
         collect.collect(args.verbose)
 
     elif args.subcommand == 'preprocess':
-        preprocess.preprocess(args.recording_id, args.preproc_config, verbose=args.verbose)
+        preprocess.preprocess(args.recording_id, args.preproc_config, staged=args.staged,
+                              verbose=args.verbose)
+
+    elif args.subcommand == 'run':
+        runtime.run(args.recording_id, args.preproc_config, ttl_source=args.ttl_source,
+                    directory=args.directory, verbose=args.verbose)
+
+    elif args.subcommand == 'worker':
+        preprocess.serve_remote(args.preproc_config, step_names=args.steps)
+
+    elif args.subcommand == 'convert_model':
+        for pickle_path in args.pickle_paths:
+            decoding.convert_pickle(pickle_path)
+
+    elif args.subcommand == 'http_stand_in':
+        delivery.serve_stand_in(host=args.host, port=args.port, delay=args.delay,
+                                background=False)
 
     elif args.subcommand == 'web_interface':
         print(web_interface)
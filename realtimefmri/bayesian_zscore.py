@@ -1,6 +1,6 @@
 import numpy as np
 
-from realtimefmri import buffered_array, preprocess
+from realtimefmri import preprocess
 
 
 class InvGammaParameters():
@@ -54,11 +54,15 @@ class BayesianZScore(preprocess.PreprocessingStep):
         self.mean_belief = mean_belief
         self.inverse_gamma = inverse_gamma
         self.update_prior = update_prior
-        self.data = None  # set in first call to self.run
+        self.reset()
 
     def run(self, inp):
         """Run the z-scoring on one time point and update the prior
 
+        Only the number of samples and the sums of the samples and of their squares are kept, so
+        each call costs O(voxels) regardless of how many samples have been seen. The sums are
+        taken relative to the first sample to keep them well conditioned.
+
         Parameters
         ----------
         inp : numpy.ndarray
@@ -68,26 +72,36 @@ class BayesianZScore(preprocess.PreprocessingStep):
         -------
         The input array z-scored using the posterior mean and variance
         """
-        if self.data is None:
-            self.data = buffered_array.BufferedArray(inp.size, dtype=inp.dtype)
-
-        self.data.append(inp)
-
-        post_var = compute_posterior_variance(self.data.get_array(),
-                                              self.prior_means,
-                                              self.inverse_gamma.alpha,
-                                              self.inverse_gamma.beta)
-        post_mean = compute_posterior_mean(self.data.get_array(),
-                                           self.prior_means, self.mean_belief)
+        if self.n == 0:
+            self.center = np.nan_to_num(inp.astype('float64'))
+            self.sum_x = np.zeros(inp.shape, dtype='float64')
+            self.sum_sq_x = np.zeros(inp.shape, dtype='float64')
+
+        deviation = inp - self.center
+        self.n += 1
+        self.sum_x += deviation
+        self.sum_sq_x += deviation ** 2
+
+        post_var = compute_posterior_variance_from_statistics(self.n, self.sum_x, self.sum_sq_x,
+                                                              self.prior_means,
+                                                              self.inverse_gamma.alpha,
+                                                              self.inverse_gamma.beta,
+                                                              center=self.center)
+        post_mean = compute_posterior_mean_from_statistics(self.n, self.sum_x, self.prior_means,
+                                                           self.mean_belief, center=self.center)
 
         if self.update_prior:
             self.prior_means = post_mean
             self.prior_variances = post_var
 
-        return (inp - post_mean) / np.sqrt(post_var)
+        zscored = (inp - post_mean) / np.sqrt(post_var)
+        return zscored.astype(inp.dtype, copy=False)
 
     def reset(self):
-        del self.data
+        self.n = 0
+        self.center = None
+        self.sum_x = None
+        self.sum_sq_x = None
 
 
 def compute_posterior_variance(x, prior_mean, alpha, beta, axis=0):
@@ -134,3 +148,60 @@ def compute_posterior_mean(x, prior_mean, belief=10., axis=0):
     m2 = np.sum(x, axis) + belief * prior_mean
     mean = m1 * m2
     return mean
+
+
+def compute_posterior_variance_from_statistics(n, sum_x, sum_sq_x, prior_mean, alpha, beta,
+                                               center=0.):
+    """Compute the posterior variance from sufficient statistics of the data
+
+    Equivalent to ``compute_posterior_variance`` on the samples that produced the statistics, for
+    any value of ``prior_mean``.
+
+    Parameters
+    ----------
+    n : int
+        Number of samples
+    sum_x : float or numpy.ndarray
+        Sum of ``x - center`` over samples
+    sum_sq_x : float or numpy.ndarray
+        Sum of ``(x - center) ** 2`` over samples
+    prior_mean : float of numpy.ndarray
+        Prior mean
+    alpha : float
+        Alpha parameter of the inverse gamma prior
+    beta : float
+        Beta parameter of the inverse gamma prior
+    center : float or numpy.ndarray, optional
+        Value subtracted from the samples before accumulating the sums
+    """
+    # sum((x - prior_mean)**2) expanded around the center
+    offset = prior_mean - center
+    sum_sq_deviation = sum_sq_x - 2. * offset * sum_x + n * offset ** 2
+    v1 = 1. / (n + 2 * alpha + 2)
+    v2 = 2. * beta + sum_sq_deviation
+    variance = v1 * v2
+    return variance
+
+
+def compute_posterior_mean_from_statistics(n, sum_x, prior_mean, belief=10., center=0.):
+    """Compute the posterior mean from sufficient statistics of the data
+
+    Equivalent to ``compute_posterior_mean`` on the samples that produced the statistics.
+
+    Parameters
+    ----------
+    n : int
+        Number of samples
+    sum_x : float or numpy.ndarray
+        Sum of ``x - center`` over samples
+    prior_mean : float of numpy.ndarray
+        Prior mean
+    belief : float
+        Ratio determining how much to weigh the prior over the data
+    center : float or numpy.ndarray, optional
+        Value subtracted from the samples before accumulating the sums
+    """
+    m1 = 1. / (n + belief)
+    m2 = sum_x + n * center + belief * prior_mean
+    mean = m1 * m2
+    return mean
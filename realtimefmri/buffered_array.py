@@ -1,34 +1,122 @@
+import os
+import tempfile
+import weakref
+
 import numpy as np
 
 
+MODES = ('grow', 'ring', 'memmap')
+
+
 class BufferedArray():
-    def __init__(self, size, dtype='float32', buffer_size=1000):
+    def __init__(self, size, dtype='float32', buffer_size=1000, mode='grow', directory=None):
         """An array that grows with the syntax of a list and the efficiency of an ndarray
 
+        Rows are appended one at a time and read back with ndarray indexing. The memory policy is
+        set by ``mode``:
+
+        - ``grow``: rows are kept in memory and capacity doubles when it runs out, so appends are
+          amortized O(1) and there is no limit on the number of rows
+        - ``ring``: only the last ``buffer_size`` rows are kept. Each row is written twice into a
+          buffer of ``2 * buffer_size`` rows so that the window is always contiguous and is
+          returned as a view without copying
+        - ``memmap``: like ``grow``, but rows are stored in a ``numpy.memmap`` on disk so that
+          multi-hour sessions do not have to fit in memory
+
         Attributes
         ----------
         size : int
             Number of columns in the array
         dtype : str
         buffer_size : int
+            Initial capacity for ``grow`` and ``memmap``, window length for ``ring``
+        mode : str
+            One of ``grow``, ``ring``, or ``memmap``
+        directory : str or None
+            Directory for the ``memmap`` file. Defaults to the system temporary directory.
         """
         super(BufferedArray, self).__init__()
-        self._array = np.empty((buffer_size, size), dtype)
+        if mode not in MODES:
+            raise ValueError(f"Buffer mode {mode} not one of {', '.join(MODES)}")
+
+        self.mode = mode
+        self.buffer_size = buffer_size
         self._current_size = 0
+        self._path = None
+        self._finalizer = None
+
+        if mode == 'ring':
+            self._array = np.empty((2 * buffer_size, size), dtype)
+
+        elif mode == 'memmap':
+            f = tempfile.NamedTemporaryFile(dir=directory, suffix='.dat', delete=False)
+            f.close()
+            self._path = f.name
+            # delete the file when the buffer is garbage collected or at exit if not closed
+            self._finalizer = weakref.finalize(self, os.remove, self._path)
+            self._array = np.memmap(self._path, dtype=dtype, mode='w+', shape=(buffer_size, size))
+
+        else:
+            self._array = np.empty((buffer_size, size), dtype)
+
+    def _grow(self):
+        """Double the capacity of a ``grow`` or ``memmap`` buffer"""
+        n_rows, size = self._array.shape
+        capacity = 2 * n_rows
+        if self.mode == 'memmap':
+            dtype = self._array.dtype
+            self._array.flush()
+            del self._array
+            with open(self._path, 'r+b') as f:
+                f.truncate(capacity * size * dtype.itemsize)
+            self._array = np.memmap(self._path, dtype=dtype, mode='r+', shape=(capacity, size))
+
+        else:
+            array = np.empty((capacity, size), self._array.dtype)
+            array[:n_rows] = self._array
+            self._array = array
 
     def append(self, row):
-        if self._current_size + 1 >= self._array.shape[0]:
-            raise IndexError(f"Buffer size of {self._array.shape[0]} exceeded")
+        if self.mode == 'ring':
+            index = self._current_size % self.buffer_size
+            self._array[index] = row
+            self._array[index + self.buffer_size] = row
+
+        else:
+            if self._current_size >= self._array.shape[0]:
+                self._grow()
+            self._array[self._current_size] = row
 
-        self._array[self._current_size] = row
         self._current_size += 1
 
     def get_array(self):
+        if self.mode == 'ring':
+            if self._current_size <= self.buffer_size:
+                return self._array[:self._current_size]
+
+            start = self._current_size % self.buffer_size
+            return self._array[start:start + self.buffer_size]
+
         return self._array[:self._current_size]
 
+    def close(self):
+        """Release the buffer, deleting the backing file of a ``memmap`` buffer"""
+        if self._path is not None:
+            del self._array
+            self._finalizer()
+            self._path = None
+
+    @property
+    def n_appended(self):
+        """Total number of rows appended, including rows dropped from a ``ring`` buffer"""
+        return self._current_size
+
     @property
     def shape(self):
-        return self._current_size, self._array.shape[1]
+        return self.get_array().shape
+
+    def __len__(self):
+        return self.shape[0]
 
     def __getitem__(self, index):
         array = self.get_array()
@@ -0,0 +1,258 @@
+"""Binary encoding of arrays for storing in and publishing through redis
+
+A message is a fixed prefix with a magic number, the codec version, and the length of a JSON
+header, followed by the header and the raw bytes of every array. The header describes the value
+(dtype and shape of arrays, nested lists, tuples, and dicts, scalars) and holds the time and
+sequence number the producer attached. Array buffers start at 16-byte aligned offsets, so
+``decode`` returns read-only arrays that share memory with the message instead of copies.
+
+Per array, float data can be stored as float16 or as 16-bit integers scaled between the minimum
+and maximum of the array, and any buffer can be compressed with zlib. These arrays are copied when
+they are decoded.
+
+Nothing is pickled when encoding. ``decode`` falls back to unpickling messages without the magic
+number, so data stored by earlier versions can still be read.
+"""
+import json
+import pickle
+import struct
+import zlib
+
+import nibabel as nib
+import numpy as np
+
+MAGIC = b'RTFC'
+CODEC_VERSION = 1
+ALIGNMENT = 16
+ENCODINGS = ('raw', 'float16', 'quantized')
+COMPRESSIONS = (None, 'zlib')
+
+# magic number, version, 3 pad bytes, header length
+_PREFIX = struct.Struct('<4sB3xI')
+# quantized arrays use 0 to QUANTIZED_MAX - 1 for values and QUANTIZED_MAX for NaN
+QUANTIZED_MAX = 2 ** 16 - 1
+
+
+def _encode_array(array, buffers, encoding, compression):
+    spec = {'kind': 'array', 'dtype': array.dtype.str, 'shape': array.shape}
+    if encoding == 'float16' and array.dtype.kind == 'f':
+        array = array.astype('float16')
+        spec['encoding'] = 'float16'
+
+    elif encoding == 'quantized' and array.dtype.kind == 'f':
+        finite = np.isfinite(array)
+        if finite.any():
+            offset, high = float(array[finite].min()), float(array[finite].max())
+        else:
+            offset, high = 0., 0.
+        scale = (high - offset) / (QUANTIZED_MAX - 1) or 1.
+        quantized = np.full(array.shape, QUANTIZED_MAX, dtype='uint16')
+        quantized[finite] = np.round((array[finite] - offset) / scale)
+        array = quantized
+        spec.update(encoding='quantized', offset=offset, scale=scale)
+
+    data = memoryview(np.ascontiguousarray(array).reshape(-1).view('uint8'))
+    if compression == 'zlib':
+        data = zlib.compress(data, 1)
+        spec['compression'] = 'zlib'
+
+    buffers.append(data)
+    return spec
+
+
+def _encode_value(value, buffers, encoding, compression):
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return _encode_array(value, buffers, encoding, compression)
+
+    if isinstance(value, nib.Nifti1Image):
+        data = np.asanyarray(value.dataobj)
+        affine = np.asarray(value.affine, dtype='float64')
+        return {'kind': 'nifti',
+                'data': _encode_array(data, buffers, 'raw', compression),
+                'affine': _encode_array(affine, buffers, 'raw', None),
+                'header': _encode_array(np.frombuffer(value.header.binaryblock, 'uint8'),
+                                        buffers, 'raw', None)}
+
+    if isinstance(value, (list, tuple)):
+        return {'kind': type(value).__name__,
+                'values': [_encode_value(v, buffers, encoding, compression) for v in value]}
+
+    if isinstance(value, dict):
+        if not all(isinstance(k, str) for k in value):
+            raise TypeError('Only dicts with str keys can be encoded')
+        return {'kind': 'dict',
+                'values': {k: _encode_value(v, buffers, encoding, compression)
+                           for k, v in value.items()}}
+
+    if isinstance(value, np.generic):
+        value = value.item()
+
+    if isinstance(value, bytes):
+        return {'kind': 'bytes',
+                'data': _encode_array(np.frombuffer(value, 'uint8'), buffers, 'raw', compression)}
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {'kind': 'json', 'value': value}
+
+    raise TypeError(f'Cannot encode {type(value).__name__}')
+
+
+def encode(value, time=None, sequence=None, encoding='raw', compression=None):
+    """Encode a value
+
+    Parameters
+    ----------
+    value : object
+        numpy arrays, nifti images, bytes, JSON scalars, and lists, tuples, and dicts of these
+    time : float or None
+        Timestamp stored in the header
+    sequence : int or None
+        Sequence number stored in the header
+    encoding : str
+        Storage of float arrays, one of ``raw``, ``float16``, or ``quantized`` (16 bits). Arrays
+        of other types are stored raw.
+    compression : str or None
+        None or ``zlib``
+
+    Returns
+    -------
+    The message as bytes
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f'Unknown encoding {encoding}')
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {compression}')
+
+    buffers = []
+    spec = _encode_value(value, buffers, encoding, compression)
+
+    offsets = []
+    offset = 0
+    for buffer in buffers:
+        offsets.append([offset, len(buffer)])
+        offset += -(-len(buffer) // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({'time': time, 'sequence': sequence, 'value': spec,
+                         'buffers': offsets}).encode('utf-8')
+    # pad the header so that the buffers start aligned
+    header += b' ' * (-(_PREFIX.size + len(header)) % ALIGNMENT)
+
+    parts = [_PREFIX.pack(MAGIC, CODEC_VERSION, len(header)), header]
+    for buffer, (_, n_bytes) in zip(buffers, offsets):
+        parts.append(buffer)
+        parts.append(b'\0' * (-n_bytes % ALIGNMENT))
+
+    return b''.join(parts)
+
+
+def is_encoded(message):
+    """Check whether a message was created by ``encode`` rather than pickled"""
+    return message[:len(MAGIC)] == MAGIC
+
+
+def read_header(message):
+    """Read the header of a message
+
+    Parameters
+    ----------
+    message : bytes
+
+    Returns
+    -------
+    The header dict, with the ``time`` and ``sequence`` the message was encoded with, or None for
+    pickled messages
+    """
+    if not is_encoded(message):
+        return None
+
+    magic, version, header_length = _PREFIX.unpack_from(message)
+    if version > CODEC_VERSION:
+        raise ValueError(f'Message has codec version {version}, newer than {CODEC_VERSION}')
+
+    header = json.loads(bytes(message[_PREFIX.size:_PREFIX.size + header_length]))
+    header['payload_offset'] = _PREFIX.size + header_length
+    return header
+
+
+def _decode_array(spec, message, buffers):
+    offset, n_bytes = next(buffers)
+    if spec.get('compression') == 'zlib':
+        data = zlib.decompress(memoryview(message)[offset:offset + n_bytes])
+        offset = 0
+    else:
+        data = message
+
+    dtype = np.dtype(spec['dtype'])
+    encoding = spec.get('encoding', 'raw')
+    if encoding == 'float16':
+        stored_dtype = np.dtype('float16')
+    elif encoding == 'quantized':
+        stored_dtype = np.dtype('uint16')
+    else:
+        stored_dtype = dtype
+
+    count = int(np.prod(spec['shape'], dtype='int64'))
+    array = np.frombuffer(data, dtype=stored_dtype, count=count, offset=offset)
+    array = array.reshape(spec['shape'])
+
+    if encoding == 'float16':
+        array = array.astype(dtype)
+
+    elif encoding == 'quantized':
+        missing = array == QUANTIZED_MAX
+        array = array.astype(dtype) * dtype.type(spec['scale']) + dtype.type(spec['offset'])
+        array[missing] = np.nan
+
+    return array
+
+
+def _decode_value(spec, message, buffers):
+    kind = spec['kind']
+    if kind == 'array':
+        return _decode_array(spec, message, buffers)
+
+    if kind == 'nifti':
+        data = _decode_array(spec['data'], message, buffers)
+        affine = _decode_array(spec['affine'], message, buffers)
+        header = nib.Nifti1Header(binaryblock=_decode_array(spec['header'], message,
+                                                            buffers).tobytes())
+        return nib.Nifti1Image(data, affine, header=header)
+
+    if kind in ('list', 'tuple'):
+        values = [_decode_value(v, message, buffers) for v in spec['values']]
+        return tuple(values) if kind == 'tuple' else values
+
+    if kind == 'dict':
+        return {k: _decode_value(v, message, buffers) for k, v in spec['values'].items()}
+
+    if kind == 'bytes':
+        return _decode_array(spec['data'], message, buffers).tobytes()
+
+    if kind == 'json':
+        return spec['value']
+
+    raise ValueError(f'Unknown value kind {kind}')
+
+
+def decode(message, allow_pickle=True):
+    """Decode a message created by ``encode``, or unpickle one stored by earlier versions
+
+    Parameters
+    ----------
+    message : bytes
+    allow_pickle : bool
+        Unpickle messages that were not created by ``encode``. Otherwise they raise a ValueError.
+
+    Returns
+    -------
+    The decoded value. Raw arrays are read-only views of ``message``
+    """
+    header = read_header(message)
+    if header is None:
+        if not allow_pickle:
+            raise ValueError('Message was not created by codec.encode')
+        return pickle.loads(message)
+
+    payload_offset = header['payload_offset']
+    buffers = iter([(payload_offset + offset, n_bytes) for offset, n_bytes in header['buffers']])
+    return _decode_value(header['value'], message, buffers)
@@ -1,11 +1,10 @@
 import os.path as op
-import pickle
 import struct
 import time
 
 import redis
 
-from realtimefmri import config, image_utils
+from realtimefmri import codec, config, image_utils
 from realtimefmri.utils import get_logger
 
 
@@ -39,7 +38,9 @@ def collect(verbose=True):
             timestamped_volume = {'image_number': image_number, 'time': timestamp, 'volume': nii}
 
             logger.debug('%s %s', op.basename(new_volume_path), str(nii.shape))
-            redis_client.publish('timestamped_volume', pickle.dumps(timestamped_volume))
+            redis_client.publish('timestamped_volume',
+                                 codec.encode(timestamped_volume, time=timestamp,
+                                              sequence=image_number))
 
-            r.set('image_number', pickle.dumps(image_number))
+            r.set('image_number', codec.encode(image_number))
             image_number += 1
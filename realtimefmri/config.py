@@ -26,7 +26,7 @@ def initialize():
             shutil.copy(path, PIPELINE_DIR)
 
     for DIR in [SCANNER_DIR, DATASTORE_DIR, RECORDING_DIR, DATASTORE_DIR,
-                LOG_DIR]:
+                LOG_DIR, CACHE_DIR]:
         if not op.exists(DIR):
             os.makedirs(DIR)
 
@@ -122,6 +122,7 @@ DATASTORE_DIR = op.join(DATA_DIR, 'datastore')
 RECORDING_DIR = op.join(DATA_DIR, 'recordings')
 DATASET_DIR = op.join(DATA_DIR, 'datasets')
 LOG_DIR = op.join(DATA_DIR, 'logs')
+CACHE_DIR = op.join(DATA_DIR, 'cache')
 logfn = op.join(LOG_DIR,  f"{datetime.now():%Y%m%d}.log")
 
 initialize()
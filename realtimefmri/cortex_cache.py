@@ -0,0 +1,285 @@
+"""Process-wide cache for masks, transforms, and reference images from the pycortex database
+
+Masks are computed by pycortex once, saved as ``.npy`` files in the cache directory, and loaded as
+read-only memory maps, so every step that asks for the same resource shares a single copy. A
+cached file is recomputed whenever one of the pycortex files it was derived from is modified after
+the cache file was written.
+"""
+import hashlib
+import json
+import os
+import os.path as op
+import threading
+from glob import glob
+
+import numpy as np
+
+import cortex
+
+from realtimefmri import config
+from realtimefmri.utils import get_logger
+
+logger = get_logger('realtimefmri.cortex_cache', to_console=True, to_network=False, to_file=True)
+
+_registry = {}
+_lock = threading.RLock()
+
+
+def _surface_directory(surface):
+    return op.join(cortex.database.default_filestore, surface)
+
+
+def _transform_directory(surface, transform):
+    return op.join(_surface_directory(surface), 'transforms', transform)
+
+
+def _transform_sources(surface, transform):
+    """Files that every resource derived from a transform depends on"""
+    transform_dir = _transform_directory(surface, transform)
+    surface_files = glob(op.join(_surface_directory(surface), 'surfaces', '*'))
+    return [op.join(transform_dir, 'matrices.xfm'),
+            op.join(transform_dir, 'reference.nii.gz')] + surface_files
+
+
+def _cache_path(surface, transform, name):
+    return op.join(config.CACHE_DIR, surface, transform, name + '.npy')
+
+
+def is_stale(cache_path, source_paths):
+    """Check whether a cache file is missing or older than any of its sources
+
+    Parameters
+    ----------
+    cache_path : str
+    source_paths : list of str
+        Files the cached value was computed from. Missing source files are ignored.
+
+    Returns
+    -------
+    True if the cached value needs to be recomputed
+    """
+    if not op.exists(cache_path):
+        return True
+
+    cache_mtime = op.getmtime(cache_path)
+    for path in source_paths:
+        if op.exists(path) and op.getmtime(path) > cache_mtime:
+            return True
+
+    return False
+
+
+def _save(cache_path, array):
+    """Save an array to the cache directory"""
+    os.makedirs(op.dirname(cache_path), exist_ok=True)
+    # write to a temporary file first so that concurrent readers never see a partial file
+    temp_path = f'{cache_path}.{os.getpid()}.tmp.npy'
+    np.save(temp_path, array)
+    os.replace(temp_path, cache_path)
+
+
+def _load_or_compute(cache_path, source_paths, compute):
+    """Return a read-only memory map of the cached array, computing and saving it if stale"""
+    if is_stale(cache_path, source_paths):
+        logger.info('Computing %s', cache_path)
+        _save(cache_path, compute())
+
+    return np.load(cache_path, mmap_mode='r')
+
+
+def _get(key, load):
+    """Get a resource from the process-wide registry, loading it on first access"""
+    with _lock:
+        if key not in _registry:
+            _registry[key] = load()
+
+        return _registry[key]
+
+
+def clear():
+    """Drop all resources from the process-wide registry. Files in the cache directory are kept.
+    """
+    with _lock:
+        _registry.clear()
+
+
+def get_xfm(surface, transform):
+    """Get a pycortex transform
+
+    Parameters
+    ----------
+    surface : str
+    transform : str
+
+    Returns
+    -------
+    A cortex.xfm.Transform
+    """
+    return _get((surface, transform, 'xfm'), lambda: cortex.db.get_xfm(surface, transform))
+
+
+def get_reference(surface, transform):
+    """Get the reference image of a pycortex transform
+
+    Parameters
+    ----------
+    surface : str
+    transform : str
+
+    Returns
+    -------
+    A nibabel.nifti1.Nifti1Image
+    """
+    return _get((surface, transform, 'reference'),
+                lambda: get_xfm(surface, transform).reference)
+
+
+def get_mask(surface, transform, mask_type):
+    """Get a voxel mask from the pycortex database
+
+    Parameters
+    ----------
+    surface : str
+    transform : str
+    mask_type : str
+
+    Returns
+    -------
+    A read-only boolean numpy.memmap in zyx order, shared by all callers
+    """
+    def load():
+        mask_path = op.join(_transform_directory(surface, transform),
+                            'mask_' + mask_type + '.nii.gz')
+        sources = _transform_sources(surface, transform) + [mask_path]
+        return _load_or_compute(_cache_path(surface, transform, 'mask_' + mask_type), sources,
+                                lambda: cortex.db.get_mask(surface, transform, mask_type))
+
+    return _get((surface, transform, mask_type), load)
+
+
+def get_roi_masks(surface, transform, roi_names=None):
+    """Get a volume of ROI labels from the pycortex database
+
+    Parameters
+    ----------
+    surface : str
+    transform : str
+    roi_names : list of str or None
+        Names of the ROIs. None loads all ROIs.
+
+    Returns
+    -------
+    A read-only numpy.memmap of integer ROI labels in zyx order and a dict mapping ROI names to
+    labels
+    """
+    if roi_names is None:
+        roi_key = 'all'
+    else:
+        roi_names = list(roi_names)
+        roi_key = hashlib.md5(','.join(roi_names).encode('utf-8')).hexdigest()
+
+    def load():
+        cache_path = _cache_path(surface, transform, 'rois_' + roi_key)
+        dict_path = op.splitext(cache_path)[0] + '.json'
+        sources = (_transform_sources(surface, transform) +
+                   [op.join(_surface_directory(surface), 'overlays.svg')])
+
+        if is_stale(cache_path, sources) or not op.exists(dict_path):
+            logger.info('Computing %s', cache_path)
+            roi_masks, roi_dict = cortex.get_roi_masks(surface, transform, roi_names)
+            _save(cache_path, roi_masks)
+            with open(dict_path, 'w') as f:
+                json.dump({name: int(value) for name, value in roi_dict.items()}, f)
+
+        with open(dict_path, 'r') as f:
+            roi_dict = json.load(f)
+
+        return np.load(cache_path, mmap_mode='r'), roi_dict
+
+    return _get((surface, transform, 'rois:' + roi_key), load)
+
+
+def get_flatmap_projection(surface, transform, height=1024, mask_type=None, thick=32,
+                           sampler='nearest'):
+    """Get the sparse projection of voxels onto the pixels of a flatmap image
+
+    Parameters
+    ----------
+    surface : str
+    transform : str
+    height : int
+        Height of the flatmap image in pixels
+    mask_type : str or None
+        Project the voxels of this mask, in the order ``volume[mask]`` returns them, instead of
+        all voxels of the volume
+    thick : int
+        Number of cortical depths that are averaged
+    sampler : str
+        pycortex sampler name
+
+    Returns
+    -------
+    A (n_pixels, n_voxels) scipy.sparse.csr_matrix whose rows are the flatmap pixels covered by
+    cortex, an array of the flat index of each of those pixels in the (height, width) image, and
+    the image shape
+    """
+    def load():
+        from cortex.quickflat import utils as quickflat_utils
+
+        flatmask, _ = quickflat_utils.get_flatmask(surface, height=height)
+        projection = quickflat_utils.get_flatcache(surface, transform, height=height, thick=thick,
+                                                   sampler=sampler)
+        if mask_type is not None:
+            voxels = np.flatnonzero(get_mask(surface, transform, mask_type))
+            projection = projection[:, voxels]
+
+        # pycortex fills the flat mask in (width, height) order and then flips it upright
+        pixels = np.full(flatmask.shape, -1)
+        pixels[flatmask] = np.arange(flatmask.sum())
+        image_pixels = pixels.T[::-1].ravel()
+        image_index = np.empty(flatmask.sum(), dtype='int64')
+        image_index[image_pixels[image_pixels >= 0]] = np.flatnonzero(image_pixels >= 0)
+
+        covered = np.asarray(projection.sum(1)).ravel() > 0
+        projection = projection[covered].tocsr().astype('float32')
+        return projection, image_index[covered], (flatmask.shape[1], flatmask.shape[0])
+
+    return _get((surface, transform, 'flatmap', height, mask_type, thick, sampler), load)
+
+
+def get_flatmap_curvature(surface, height=1024):
+    """Get the curvature background of flatmaps, shaded like ``cortex.quickflat`` does
+
+    Parameters
+    ----------
+    surface : str
+    height : int
+        Height of the flatmap image in pixels
+
+    Returns
+    -------
+    A read-only (height, width, 4) uint8 RGBA image that is transparent outside of cortex
+    """
+    def load():
+        curvature, _ = cortex.quickflat.make_flatmap_image(cortex.db.get_surfinfo(surface),
+                                                           height=height)
+        cortex_config = cortex.options.config
+        contrast = float(cortex_config.get('curvature', 'contrast'))
+        brightness = float(cortex_config.get('curvature', 'brightness'))
+        threshold = cortex_config.get('curvature', 'threshold').lower() in ('true', 't', '1', 'y',
+                                                                            'yes')
+
+        outside = np.isnan(curvature)
+        # curvature between -0.5 and 0.5 is scaled to 0 to 1
+        shade = np.clip(np.nan_to_num(curvature) + 0.5, 0, 1)
+        if threshold:
+            shade = (shade > 0.5).astype('float64')
+        shade = np.clip((shade - 0.5) * contrast + brightness, 0, 1)
+
+        image = np.empty(curvature.shape + (4,), dtype='uint8')
+        image[..., :3] = np.round(shade * 255)[..., None]
+        image[..., 3] = np.where(outside, 0, 255)
+        image.setflags(write=False)
+        return image
+
+    return _get((surface, 'flatmap_curvature', height), load)
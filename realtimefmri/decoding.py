@@ -0,0 +1,500 @@
+"""Load and evaluate decoders
+
+Calling ``predict`` on each of many scikit-learn estimators repeats input validation and does a
+separate matrix-vector product for every estimator. ``LinearDecoderStack`` instead extracts
+``coef_`` and ``intercept_`` from the linear estimators once, stacks them into one weight matrix,
+and computes the scores of all of them at once. Estimators that are not linear in the activity
+are kept and evaluated through scikit-learn.
+
+Linear decoders can also be stored in a compact model format: a directory with a small
+``metadata.json`` header and the weights as ``.npy`` files. ``load_model`` memory-maps the
+weights read-only, so loading is fast, pages are only read when they are used, and processes
+that load the same model share one copy in the page cache. ``convert_pickle`` converts existing
+pickled estimators.
+"""
+import json
+import os
+import os.path as op
+import pickle
+import shutil
+
+import numpy as np
+from scipy import sparse
+from scipy.special import expit, logsumexp
+from sklearn import discriminant_analysis, linear_model, svm
+
+from realtimefmri.utils import get_logger
+
+logger = get_logger('realtimefmri.decoding', to_console=True, to_network=False, to_file=True)
+
+# estimators whose ``predict`` is the argmax (or sign, for two classes) of ``X @ coef_.T +
+# intercept_``
+LINEAR_CLASSIFIERS = (linear_model.LogisticRegression, linear_model.RidgeClassifier,
+                      linear_model.SGDClassifier, linear_model.Perceptron,
+                      linear_model.PassiveAggressiveClassifier, svm.LinearSVC,
+                      discriminant_analysis.LinearDiscriminantAnalysis)
+
+# classifiers whose ``predict_log_proba`` is monotonic in the decision function, so that the top
+# k classes can be ranked by their scores
+PROBABILISTIC_CLASSIFIERS = (linear_model.LogisticRegression,
+                             discriminant_analysis.LinearDiscriminantAnalysis)
+
+# probabilities of compact models that are monotonic in the decision scores. ``modified_huber``
+# clips the scores, so classes with clipped scores tie
+RANKED_PROBABILITIES = ('logistic', 'softmax', 'ovr')
+
+# estimators whose ``predict`` is ``X @ coef_.T + intercept_``
+LINEAR_REGRESSORS = (linear_model.LinearRegression, linear_model.Ridge, linear_model.Lasso,
+                     linear_model.ElasticNet, svm.LinearSVR)
+
+
+MODEL_FORMAT_VERSION = 1
+MODEL_EXTENSION = '.model'
+
+
+def _log_expit(x):
+    """Log of the logistic function, stable for large ``abs(x)``. Like ``scipy.special.log_expit``,
+    which needs SciPy 1.8"""
+    return -np.logaddexp(0, -x)
+
+
+class LinearModel():
+    """A linear estimator loaded from the compact model format
+
+    Implements the prediction methods of the scikit-learn estimator it was converted from. The
+    weights are read-only memory maps. Pickling a ``LinearModel`` only stores its path.
+
+    Parameters
+    ----------
+    path : str
+        Path to the model directory
+    metadata : dict
+        Contents of ``metadata.json``
+
+    Attributes
+    ----------
+    coef_ : numpy.ndarray
+    intercept_ : numpy.ndarray
+    classes_ : numpy.ndarray or None
+        None for regressors
+    probability : str or None
+        How decision scores are converted to probabilities: ``logistic`` for binary
+        classifiers, ``softmax`` for multinomial classifiers, ``ovr`` for one-vs-rest
+        classifiers, ``modified_huber`` for ``SGDClassifier(loss='modified_huber')``, or None if
+        the estimator has no ``predict_proba``
+    """
+    def __init__(self, path, metadata):
+        self.path = path
+        self.metadata = metadata
+        self.estimator = metadata['estimator']
+        self.probability = metadata['probability']
+        self.coef_ = np.load(op.join(path, 'coef.npy'), mmap_mode='r')
+        self.intercept_ = np.load(op.join(path, 'intercept.npy'), mmap_mode='r')
+        if metadata['kind'] == 'classifier':
+            self.classes_ = np.load(op.join(path, 'classes.npy'))
+        else:
+            self.classes_ = None
+
+    def __reduce__(self):
+        return (load_model, (self.path,))
+
+    def __repr__(self):
+        return f'LinearModel({self.estimator}, {self.path})'
+
+    def decision_function(self, X):
+        scores = np.asarray(X).dot(np.asarray(self.coef_).T) + self.intercept_
+        if self.classes_ is not None and scores.shape[1] == 1:
+            # binary classifiers have one score per sample
+            scores = scores[:, 0]
+        return scores
+
+    def predict(self, X):
+        scores = self.decision_function(X)
+        if self.classes_ is None:
+            return scores
+
+        if scores.ndim == 1:
+            return self.classes_[(scores > 0).astype(int)]
+        return self.classes_[scores.argmax(axis=1)]
+
+    def predict_log_proba(self, X):
+        if self.probability is None:
+            raise AttributeError(f'{self.estimator} has no predict_log_proba')
+
+        if self.probability == 'modified_huber':
+            with np.errstate(divide='ignore'):
+                return np.log(self.predict_proba(X))
+
+        scores = self.decision_function(X)
+        if self.probability == 'logistic':
+            return np.stack([_log_expit(-scores), _log_expit(scores)], axis=1)
+
+        if self.probability == 'softmax':
+            return scores - logsumexp(scores, axis=1, keepdims=True)
+
+        log_prob = _log_expit(scores)
+        return log_prob - logsumexp(log_prob, axis=1, keepdims=True)
+
+    def predict_proba(self, X):
+        if self.probability == 'logistic':
+            prob = expit(self.decision_function(X))
+            return np.stack([1 - prob, prob], axis=1)
+
+        if self.probability == 'modified_huber':
+            prob = (np.clip(self.decision_function(X), -1, 1) + 1) / 2
+            if prob.ndim == 1:
+                return np.stack([1 - prob, prob], axis=1)
+
+            # samples with all scores at or below -1 are equally likely to be any class
+            normalizer = prob.sum(axis=1, keepdims=True)
+            return np.divide(prob, normalizer, out=np.full_like(prob, 1 / prob.shape[1]),
+                             where=normalizer != 0)
+
+        return np.exp(self.predict_log_proba(X))
+
+
+def _probability(estimator):
+    """How the probabilities of a linear classifier follow from its decision scores"""
+    if isinstance(estimator, linear_model.SGDClassifier):
+        if estimator.loss == 'modified_huber':
+            return 'modified_huber'
+        if estimator.loss not in ('log_loss', 'log'):
+            return None
+        # probabilities of the logistic loss are normalized one-vs-rest
+        return 'logistic' if len(estimator.classes_) == 2 else 'ovr'
+
+    if not isinstance(estimator, PROBABILISTIC_CLASSIFIERS):
+        return None
+
+    if len(estimator.classes_) == 2:
+        return 'logistic'
+
+    if isinstance(estimator, linear_model.LogisticRegression):
+        multi_class = getattr(estimator, 'multi_class', None)
+        if multi_class in ('ovr', 'warn') or estimator.solver == 'liblinear':
+            return 'ovr'
+
+    return 'softmax'
+
+
+def save_model(estimator, path):
+    """Save a linear estimator in the compact model format
+
+    Parameters
+    ----------
+    estimator : sklearn estimator
+        One of ``LINEAR_CLASSIFIERS`` or ``LINEAR_REGRESSORS``
+    path : str
+        Path to the model directory, usually ending in ``MODEL_EXTENSION``
+    """
+    if (not isinstance(estimator, LINEAR_CLASSIFIERS + LINEAR_REGRESSORS) or
+            sparse.issparse(estimator.coef_)):
+        raise ValueError(f'Cannot save {type(estimator).__name__} in the compact model format')
+
+    is_classifier = isinstance(estimator, LINEAR_CLASSIFIERS)
+    probability = _probability(estimator) if is_classifier else None
+    if probability is None and is_classifier and hasattr(estimator, 'predict_proba'):
+        raise ValueError(f'Cannot save the probabilities of {type(estimator).__name__} in the '
+                         'compact model format')
+
+    cls = type(estimator)
+    metadata = {'format_version': MODEL_FORMAT_VERSION,
+                'estimator': f'{cls.__module__}.{cls.__name__}',
+                'kind': 'classifier' if is_classifier else 'regressor',
+                'probability': probability,
+                'n_features': int(np.shape(estimator.coef_)[-1])}
+
+    # write into a temporary directory so that readers never see a partial model
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(temp_path)
+    np.save(op.join(temp_path, 'coef.npy'), np.asarray(estimator.coef_))
+    np.save(op.join(temp_path, 'intercept.npy'), np.asarray(estimator.intercept_))
+    if is_classifier:
+        np.save(op.join(temp_path, 'classes.npy'), np.asarray(estimator.classes_.tolist()))
+    with open(op.join(temp_path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    if op.exists(path):
+        shutil.rmtree(path)
+    os.rename(temp_path, path)
+
+
+def load_model(path):
+    """Load a model saved with ``save_model``
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    A LinearModel
+    """
+    with open(op.join(path, 'metadata.json'), 'r') as f:
+        metadata = json.load(f)
+
+    if metadata['format_version'] > MODEL_FORMAT_VERSION:
+        raise ValueError(f'Model {path} has unsupported format version '
+                         f'{metadata["format_version"]}')
+
+    return LinearModel(path, metadata)
+
+
+def convert_pickle(pickle_path, model_path=None):
+    """Convert a pickled linear estimator to the compact model format
+
+    Parameters
+    ----------
+    pickle_path : str
+    model_path : str or None
+        Defaults to ``pickle_path`` with its extension replaced by ``MODEL_EXTENSION``
+
+    Returns
+    -------
+    The path of the converted model
+    """
+    if model_path is None:
+        model_path = op.splitext(pickle_path)[0] + MODEL_EXTENSION
+
+    with open(pickle_path, 'rb') as f:
+        estimator = pickle.load(f)
+
+    save_model(estimator, model_path)
+    logger.info('Converted %s to %s', pickle_path, model_path)
+    return model_path
+
+
+def load_predictor(path):
+    """Load a predictor from a compact model or a pickle
+
+    A pickle is loaded from the compact model next to it if that was converted after the pickle
+    was last written.
+
+    Parameters
+    ----------
+    path : str
+        Path to a compact model directory or a pickle file
+
+    Returns
+    -------
+    A LinearModel or the unpickled estimator
+    """
+    if op.isdir(path):
+        return load_model(path)
+
+    model_path = op.splitext(path)[0] + MODEL_EXTENSION
+    if op.isdir(model_path) and op.getmtime(model_path) >= op.getmtime(path):
+        return load_model(model_path)
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def compile_estimator(estimator):
+    """Extract the weights of a linear estimator
+
+    Parameters
+    ----------
+    estimator : sklearn estimator
+
+    Returns
+    -------
+    A tuple ``(weights, intercept, classes)`` with weights of shape (n_outputs, n_features) and
+    intercept of shape (n_outputs,). For classifiers, each row scores one of ``classes``. Binary
+    classifiers get two rows with opposite signs, so that the prediction is the argmax in every
+    case. ``classes`` is None for regressors. Returns None if the estimator is not linear.
+    """
+    if not isinstance(estimator, LINEAR_CLASSIFIERS + LINEAR_REGRESSORS + (LinearModel,)):
+        return None
+
+    coef = getattr(estimator, 'coef_', None)
+    if coef is None or sparse.issparse(coef):
+        return None
+
+    weights = np.atleast_2d(np.asarray(coef, dtype='float64'))
+    intercept = np.zeros(weights.shape[0]) + np.asarray(estimator.intercept_, dtype='float64')
+
+    classes = getattr(estimator, 'classes_', None)
+    if classes is None:
+        return weights, intercept, None
+
+    if len(classes) == 2:
+        weights = np.concatenate([-weights, weights])
+        intercept = np.concatenate([-intercept, intercept])
+
+    if weights.shape[0] != len(classes):
+        return None
+
+    return weights, intercept, classes
+
+
+def _probability_ranked(estimator):
+    """Whether the classes of an estimator are ranked the same by probability and by score"""
+    if isinstance(estimator, LinearModel):
+        return estimator.probability in RANKED_PROBABILITIES
+    return isinstance(estimator, PROBABILISTIC_CLASSIFIERS)
+
+
+class LinearDecoderStack():
+    """A list of estimators evaluated with one stacked weight matrix
+
+    Parameters
+    ----------
+    estimators : list of sklearn estimators
+    top_k : bool
+        Whether the stack is used to rank classes with ``top_k``. Only classifiers with a
+        ``predict_log_proba`` that is monotonic in their decision function are then compiled.
+
+    Attributes
+    ----------
+    weights : numpy.ndarray
+        Stacked weights of all compiled estimators, (n_outputs, n_features)
+    intercept : numpy.ndarray
+        Stacked intercepts, (n_outputs,)
+    compiled : list
+        For each estimator, a tuple ``(start, stop, classes)`` of its rows in ``weights``, or None
+        if it is evaluated through scikit-learn
+
+    Methods
+    -------
+    scores(activity)
+        Return the scores of all compiled estimators
+    predict(activity, map_function=map)
+        Return the prediction of each estimator
+    top_k(activity, k, map_function=map)
+        Return the k most likely classes of each estimator
+    """
+    def __init__(self, estimators, top_k=False):
+        self.estimators = list(estimators)
+
+        weights, intercepts, compiled = [], [], []
+        n_outputs = 0
+        for estimator in self.estimators:
+            result = None
+            if not top_k or _probability_ranked(estimator):
+                result = compile_estimator(estimator)
+
+            if result is None:
+                compiled.append(None)
+                continue
+
+            w, b, classes = result
+            if len(weights) > 0 and w.shape[1] != weights[0].shape[1]:
+                raise ValueError('Estimators were fit on different numbers of features')
+
+            weights.append(w)
+            intercepts.append(b)
+            compiled.append((n_outputs, n_outputs + w.shape[0], classes))
+            n_outputs += w.shape[0]
+
+        self.compiled = compiled
+        if len(weights) > 0:
+            self.weights = np.ascontiguousarray(np.concatenate(weights))
+            self.intercept = np.concatenate(intercepts)
+        else:
+            self.weights = self.intercept = None
+
+        n_fallback = sum(c is None for c in compiled)
+        logger.info('Compiled %d of %d estimators into %d stacked outputs',
+                    len(compiled) - n_fallback, len(compiled), n_outputs)
+        if n_fallback > 0:
+            logger.info('%d estimators are evaluated through scikit-learn', n_fallback)
+
+    def scores(self, activity):
+        """Scores of all compiled estimators
+
+        Parameters
+        ----------
+        activity : numpy.ndarray
+            A single sample of features
+
+        Returns
+        -------
+        A vector with the stacked outputs of all compiled estimators
+        """
+        if self.weights is None:
+            return None
+
+        return self.weights.dot(activity.ravel()) + self.intercept
+
+    def _fallback(self, function, map_function):
+        """Apply ``function`` to each estimator that was not compiled"""
+        indices = [i for i, c in enumerate(self.compiled) if c is None]
+        results = map_function(function, [self.estimators[i] for i in indices])
+        return dict(zip(indices, results))
+
+    def predict(self, activity, map_function=map):
+        """Prediction of each estimator
+
+        Parameters
+        ----------
+        activity : numpy.ndarray
+            A single sample of features
+        map_function : callable
+            Used to apply ``predict`` to estimators that were not compiled, e.g. the ``map`` of a
+            thread pool
+
+        Returns
+        -------
+        A list with the prediction of each estimator, as returned by ``estimator.predict(X)[0]``
+        """
+        scores = self.scores(activity)
+        X = activity.ravel()[None]
+        fallback = self._fallback(lambda estimator: estimator.predict(X)[0], map_function)
+
+        predictions = []
+        for index, compiled in enumerate(self.compiled):
+            if compiled is None:
+                predictions.append(fallback[index])
+                continue
+
+            start, stop, classes = compiled
+            if classes is None:
+                prediction = scores[start:stop]
+                predictions.append(prediction[0] if stop - start == 1 else prediction)
+            else:
+                predictions.append(classes[np.argmax(scores[start:stop])])
+
+        return predictions
+
+    def top_k(self, activity, k, map_function=map):
+        """The k most likely classes of each estimator
+
+        Parameters
+        ----------
+        activity : numpy.ndarray
+            A single sample of features
+        k : int
+        map_function : callable
+            Used to evaluate estimators that were not compiled
+
+        Returns
+        -------
+        A list with an array of the k most likely classes of each estimator, from most to least
+        likely
+        """
+        scores = self.scores(activity)
+        X = activity.ravel()[None]
+
+        def top_k_sklearn(estimator):
+            log_prob = estimator.predict_log_proba(X)[0]
+            return estimator.classes_[np.argsort(log_prob)[::-1][:k]]
+
+        fallback = self._fallback(top_k_sklearn, map_function)
+
+        predictions = []
+        for index, compiled in enumerate(self.compiled):
+            if compiled is None:
+                predictions.append(fallback[index])
+                continue
+
+            start, stop, classes = compiled
+            class_scores = scores[start:stop]
+            if k < len(class_scores):
+                top = np.argpartition(class_scores, -k)[-k:]
+            else:
+                top = np.arange(len(class_scores))
+            top = top[np.argsort(class_scores[top])[::-1]]
+            predictions.append(classes[top])
+
+        return predictions
@@ -0,0 +1,353 @@
+"""Deliver pipeline outputs to HTTP endpoints without blocking the pipeline
+
+Steps hand their payloads to a ``HTTPDelivery`` and return right away. Worker threads post them
+through a ``requests.Session``, whose connection pool keeps connections to each endpoint alive, so
+a TR does not pay for a new TCP and TLS handshake. Each endpoint has a bounded queue of pending
+payloads. When sending falls behind, the oldest payloads are dropped, and with ``coalesce`` only
+the newest payload is kept, because a stale decoding result or flatmap is of no use. Failed posts
+are retried until the payload's deadline passes. Payloads to the same endpoint are sent in order,
+one at a time.
+
+``serve_stand_in`` runs a local HTTP server that accepts and records posts, to test pipelines
+without the real endpoints.
+"""
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from realtimefmri.utils import get_logger
+
+logger = get_logger('realtimefmri.delivery', to_console=True, to_network=False, to_file=True)
+
+
+class EndpointStatistics():
+    """Delivery counts and latency of one endpoint
+
+    Attributes
+    ----------
+    n_queued, n_sent, n_failed, n_dropped : int
+        Number of payloads queued, delivered, that failed all retries or passed their deadline,
+        and that were dropped or replaced by newer payloads before being sent
+    latency, mean_latency, max_latency : float
+        Last, mean, and maximum seconds from queueing to a successful response
+    """
+    def __init__(self):
+        self.n_queued = 0
+        self.n_sent = 0
+        self.n_failed = 0
+        self.n_dropped = 0
+        self.latency = 0.
+        self.mean_latency = 0.
+        self.max_latency = 0.
+
+    def add_latency(self, latency):
+        self.n_sent += 1
+        self.latency = latency
+        self.mean_latency += (latency - self.mean_latency) / self.n_sent
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class HTTPDelivery():
+    """Post payloads to HTTP endpoints from a pool of worker threads
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of worker threads, i.e., of endpoints that are posted to at the same time
+    queue_size : int
+        Maximum number of pending payloads per endpoint
+    timeout : float
+        Seconds to wait for a response to one post
+    deadline : float
+        Seconds after queueing after which a payload is no longer sent or retried
+    retry_delay : float
+        Seconds to wait before retrying a failed post, doubled after each retry
+
+    Attributes
+    ----------
+    session : requests.Session
+    statistics : dict
+        ``EndpointStatistics`` of each endpoint
+
+    Methods
+    -------
+    post(url, data=None, json=None, files=None, coalesce=False, deadline=None)
+        Queue a payload
+    flush(timeout=None)
+        Wait until all queued payloads are sent or dropped
+    close()
+        Stop the worker threads
+    report()
+        Latency and counts of each endpoint
+    log_report()
+        Log the latency and counts of each endpoint
+    """
+    def __init__(self, n_workers=4, queue_size=8, timeout=2., deadline=5., retry_delay=0.1):
+        self.n_workers = n_workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retry_delay = retry_delay
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=n_workers, pool_maxsize=n_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.statistics = {}
+        self._pending = {}
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, daemon=True,
+                                          name=f'delivery-{i}')
+                         for i in range(n_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def post(self, url, data=None, json=None, files=None, coalesce=False, deadline=None):
+        """Queue a payload to be posted to ``url``
+
+        Parameters
+        ----------
+        url : str
+        data, json, files
+            Passed to ``requests.Session.post``
+        coalesce : bool
+            Replace the payloads to ``url`` that are still waiting with this one
+        deadline : float or None
+            Seconds after which the payload is dropped. Defaults to the delivery's ``deadline``
+        """
+        if deadline is None:
+            deadline = self.deadline
+
+        payload = {'data': data, 'json': json, 'files': files}
+        queued_time = time.monotonic()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Delivery is closed')
+
+            if url not in self._pending:
+                self._pending[url] = deque()
+                self.statistics[url] = EndpointStatistics()
+
+            pending = self._pending[url]
+            statistics = self.statistics[url]
+            statistics.n_queued += 1
+            if coalesce:
+                statistics.n_dropped += len(pending)
+                pending.clear()
+            elif len(pending) >= self.queue_size:
+                pending.popleft()
+                statistics.n_dropped += 1
+                logger.warning('Delivery to %s is falling behind, dropped a payload', url)
+
+            pending.append((payload, queued_time, queued_time + deadline))
+            self._condition.notify()
+
+    def _next(self):
+        """Take the oldest payload of an endpoint that is not being posted to. Called with the
+        condition held."""
+        for url, pending in self._pending.items():
+            if len(pending) > 0 and url not in self._in_flight:
+                return url, pending.popleft()
+
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._next()
+                while job is None and not self._closed:
+                    self._condition.wait()
+                    job = self._next()
+
+                if job is None:
+                    return
+
+                url, item = job
+                self._in_flight.add(url)
+
+            try:
+                self._send(url, *item)
+            finally:
+                with self._condition:
+                    self._in_flight.discard(url)
+                    self._condition.notify_all()
+
+    def _send(self, url, payload, queued_time, deadline_time):
+        statistics = self.statistics[url]
+        retry_delay = self.retry_delay
+        while True:
+            timeout = min(self.timeout, deadline_time - time.monotonic())
+            if timeout <= 0:
+                with self._condition:
+                    statistics.n_failed += 1
+                logger.warning('Payload to %s passed its deadline', url)
+                return
+
+            try:
+                response = self.session.post(url, timeout=timeout, **payload)
+                response.raise_for_status()
+                with self._condition:
+                    statistics.add_latency(time.monotonic() - queued_time)
+                return
+
+            except requests.RequestException as e:
+                logger.debug('Post to %s failed: %s', url, e)
+                if time.monotonic() + retry_delay >= deadline_time:
+                    with self._condition:
+                        statistics.n_failed += 1
+                    logger.warning('Post to %s failed: %s', url, e)
+                    return
+
+                time.sleep(retry_delay)
+                retry_delay *= 2
+
+    def flush(self, timeout=None):
+        """Wait until all queued payloads are sent or dropped
+
+        Returns
+        -------
+        True if everything was delivered before ``timeout`` seconds
+        """
+        def idle():
+            return (len(self._in_flight) == 0 and
+                    all(len(pending) == 0 for pending in self._pending.values()))
+
+        with self._condition:
+            return self._condition.wait_for(idle, timeout)
+
+    def close(self):
+        """Stop the worker threads after the queued payloads are sent"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        for worker in self._workers:
+            worker.join()
+        self.session.close()
+
+    def report(self):
+        """Latency and counts of each endpoint
+
+        Returns
+        -------
+        A dict from each endpoint URL to a dict of its statistics
+        """
+        with self._condition:
+            return {url: statistics.as_dict() for url, statistics in self.statistics.items()}
+
+    def log_report(self):
+        """Log the latency and counts of each endpoint"""
+        for url, statistics in self.report().items():
+            logger.info('Delivery to %s: %d queued, %d sent, %d failed, %d dropped, '
+                        'mean latency %.3f s, max latency %.3f s', url, statistics['n_queued'],
+                        statistics['n_sent'], statistics['n_failed'], statistics['n_dropped'],
+                        statistics['mean_latency'], statistics['max_latency'])
+
+
+_delivery = None
+
+
+def get_delivery():
+    """Get the process-wide ``HTTPDelivery``, creating it if needed"""
+    global _delivery
+    if _delivery is None:
+        _delivery = HTTPDelivery()
+
+    return _delivery
+
+
+def log_report():
+    """Log the statistics of the process-wide ``HTTPDelivery``, if it was created"""
+    if _delivery is not None:
+        _delivery.log_report()
+
+
+def shutdown(timeout=None):
+    """Send the payloads queued in the process-wide ``HTTPDelivery``, log its statistics, and
+    close it
+
+    Parameters
+    ----------
+    timeout : float or None
+        Seconds to wait for queued payloads before closing
+    """
+    global _delivery
+    if _delivery is None:
+        return
+
+    if not _delivery.flush(timeout):
+        logger.warning('Payloads were still pending after %s s', timeout)
+    _delivery.log_report()
+    _delivery.close()
+    _delivery = None
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.server.received.append({'path': self.path, 'time': time.time(),
+                                     'content_type': self.headers.get('Content-Type'),
+                                     'body': body})
+        if self.server.delay > 0:
+            time.sleep(self.server.delay)
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.info('Stand-in server: ' + format, *args)
+
+
+def serve_stand_in(host='127.0.0.1', port=0, delay=0., background=True, max_received=1000):
+    """Start a local HTTP server that accepts any post, for testing delivery
+
+    Parameters
+    ----------
+    host : str
+    port : int
+        Port to listen on. 0 picks a free port
+    delay : float
+        Seconds to wait before responding, to simulate a slow endpoint
+    background : bool
+        Serve from a background thread and return. Otherwise serve until interrupted.
+    max_received : int
+        Number of the most recent posts that are kept in ``received``
+
+    Returns
+    -------
+    The server. Its ``url`` is the address to post to, ``received`` holds the posted requests,
+    and ``shutdown()`` stops it.
+    """
+    # ThreadingHTTPServer needs Python 3.7, so it is only imported when a stand-in is served
+    from http.server import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer((host, port), _StandInHandler)
+    server.daemon_threads = True
+    server.received = deque(maxlen=max_received)
+    server.delay = delay
+    server.url = f'http://{server.server_address[0]}:{server.server_address[1]}'
+    logger.info('Stand-in server listening on %s', server.url)
+    if not background:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return server
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True, name='stand-in-server')
+    thread.start()
+    return server
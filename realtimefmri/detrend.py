@@ -1,31 +1,428 @@
+"""Remove trends that are shared with white matter activity from gray matter activity
+
+``WhiteMatterDetrend`` regresses gray matter activity on the top principal components of white
+matter activity. It can be fit on arrays in memory, or streamed from chunks of responses stored in
+redis or recorded to disk, in which case peak memory is bounded by the chunk size. Fitted
+detrenders are saved as a versioned ``.npz`` file in the subject directory.
+"""
+import json
+import os
 import os.path as op
 import pickle
 
+import nibabel as nib
+import numpy as np
+from scipy import linalg as la
 from sklearn import decomposition, linear_model
 
+from realtimefmri import codec, utils
 from realtimefmri.config import get_subject_directory
 
 
+DETREND_FORMAT_VERSION = 1
+
+
 class WhiteMatterDetrend():
-    def __init__(self, n_pcs=10):
-        pca = decomposition.PCA(n_components=n_pcs)
-        model = linear_model.LinearRegression()
+    """Detrend gray matter activity by regressing out the principal components of white matter
+    activity
 
-        self.pca = pca
-        self.model = model
+    Parameters
+    ----------
+    n_pcs : int
+        Number of white matter principal components
+
+    Attributes
+    ----------
+    mean_ : numpy.ndarray
+        (n_wm,) mean white matter activity
+    components_ : numpy.ndarray
+        (n_pcs, n_wm) white matter principal components
+    coef_ : numpy.ndarray
+        (n_pcs, n_gm) regression weights
+    intercept_ : numpy.ndarray
+        (n_gm,) regression intercepts
+
+    Methods
+    -------
+    fit(gm, wm)
+        Fit on arrays in memory
+    fit_chunks(chunks)
+        Fit on chunks of samples, streamed in a few passes
+    detrend(gm, wm)
+        Remove the white matter trend from gray matter activity
+    save(subject, name)
+    """
+    def __init__(self, n_pcs=10):
+        self.n_pcs = n_pcs
 
     def fit(self, gm, wm):
-        pcs = self.pca.fit_transform(wm)
-        self.model.fit(pcs, gm)
+        pca = decomposition.PCA(n_components=self.n_pcs)
+        pcs = pca.fit_transform(wm)
+        model = linear_model.LinearRegression().fit(pcs, gm)
+
+        self.mean_ = pca.mean_
+        self.components_ = pca.components_
+        self.coef_ = model.coef_.T
+        self.intercept_ = model.intercept_
+        return self
+
+    def fit_chunks(self, chunks, svd_solver='full', n_oversamples=10, n_iter=4, random_state=None):
+        """Fit on chunks of samples that are loaded one at a time
+
+        The first pass computes the white matter mean and, for the ``full`` solver, the
+        (n_wm, n_wm) white matter covariance, whose top eigenvectors are the principal
+        components. The ``randomized`` solver instead finds the components by subspace
+        iteration, with one pass per iteration, and only keeps (n_wm, n_pcs + n_oversamples)
+        matrices. The last pass accumulates the normal equations of the gray matter regression.
+
+        Parameters
+        ----------
+        chunks : callable
+            Returns a new iterable of (gm, wm) pairs of (n_samples, n_gm) and (n_samples, n_wm)
+            arrays each time it is called, e.g., ``functools.partial(iter_redis_chunks, prefix)``
+        svd_solver : str
+            ``full`` or ``randomized``
+        n_oversamples : int
+            Number of extra random directions for the ``randomized`` solver
+        n_iter : int
+            Number of subspace iterations for the ``randomized`` solver
+        random_state : int or None
+
+        Returns
+        -------
+        self
+        """
+        if svd_solver not in ('full', 'randomized'):
+            raise ValueError(f'Unknown svd_solver {svd_solver}')
+
+        n_samples = 0
+        sum_wm = None
+        wm_wm = None
+        for _, wm in chunks():
+            wm = np.asarray(wm, dtype='float64')
+            if sum_wm is None:
+                sum_wm = np.zeros(wm.shape[1])
+                if svd_solver == 'full':
+                    wm_wm = np.zeros((wm.shape[1], wm.shape[1]))
+            sum_wm += wm.sum(0)
+            if svd_solver == 'full':
+                wm_wm += wm.T.dot(wm)
+            n_samples += len(wm)
+
+        if n_samples <= self.n_pcs:
+            raise ValueError(f'Need more than {self.n_pcs} samples, got {n_samples}')
+
+        self.mean_ = sum_wm / n_samples
+        if svd_solver == 'full':
+            covariance = wm_wm - n_samples * np.outer(self.mean_, self.mean_)
+            n_wm = len(covariance)
+            _, eigenvectors = la.eigh(covariance, subset_by_index=(n_wm - self.n_pcs, n_wm - 1))
+            self.components_ = eigenvectors[:, ::-1].T
+        else:
+            self.components_ = self._randomized_components(chunks, n_samples, n_oversamples,
+                                                           n_iter, random_state)
+
+        n_gm = None
+        for gm, wm in chunks():
+            pcs = self.transform(wm)
+            gm = np.asarray(gm, dtype='float64')
+            if n_gm is None:
+                n_gm = gm.shape[1]
+                pcs_pcs = np.zeros((self.n_pcs, self.n_pcs))
+                pcs_gm = np.zeros((self.n_pcs, n_gm))
+                sum_pcs = np.zeros(self.n_pcs)
+                sum_gm = np.zeros(n_gm)
+            pcs_pcs += pcs.T.dot(pcs)
+            pcs_gm += pcs.T.dot(gm)
+            sum_pcs += pcs.sum(0)
+            sum_gm += gm.sum(0)
+
+        mean_pcs = sum_pcs / n_samples
+        mean_gm = sum_gm / n_samples
+        pcs_pcs -= n_samples * np.outer(mean_pcs, mean_pcs)
+        pcs_gm -= n_samples * np.outer(mean_pcs, mean_gm)
+        self.coef_ = la.lstsq(pcs_pcs, pcs_gm)[0]
+        self.intercept_ = mean_gm - mean_pcs.dot(self.coef_)
         return self
 
+    def _randomized_components(self, chunks, n_samples, n_oversamples, n_iter, random_state):
+        """Top eigenvectors of the white matter covariance by subspace iteration"""
+        n_wm = len(self.mean_)
+        rng = np.random.RandomState(random_state)
+        basis = rng.randn(n_wm, min(self.n_pcs + n_oversamples, n_wm))
+        for _ in range(n_iter + 1):
+            basis, _ = la.qr(basis, mode='economic')
+            basis = self._covariance_product(chunks, basis, n_samples)
+
+        # Rayleigh-Ritz: the eigenvectors of the small matrix Q' C Q rotate the subspace Q onto
+        # the top components
+        projected_basis, _ = la.qr(basis, mode='economic')
+        product = self._covariance_product(chunks, projected_basis, n_samples)
+        eigenvalues, eigenvectors = la.eigh(projected_basis.T.dot(product))
+        order = eigenvalues.argsort()[::-1][:self.n_pcs]
+        return projected_basis.dot(eigenvectors[:, order]).T
+
+    def _covariance_product(self, chunks, basis, n_samples):
+        product = np.zeros_like(basis)
+        for _, wm in chunks():
+            centered = np.asarray(wm, dtype='float64') - self.mean_
+            product += centered.T.dot(centered.dot(basis))
+        return product / n_samples
+
+    def transform(self, wm):
+        """White matter principal component scores"""
+        return (np.asarray(wm) - self.mean_).dot(self.components_.T)
+
     def detrend(self, gm, wm):
-        trend = self.model.predict(self.pca.transform(wm))
+        trend = self.transform(wm).dot(self.coef_) + self.intercept_
         return gm - trend
 
     def save(self, subject, name):
-        subj_dir = get_subject_directory(subject)
-        with open(op.join(subj_dir, 'model-{}.pkl'.format(name)), 'r') as f:
-            pickle.dump(self.model, f)
-        with open(op.join(subj_dir, 'pca-{}.pkl'.format(name)), 'r') as f:
-            pickle.dump(self.pca, f)
+        """Save to ``wmdetrend-<name>.npz`` in the subject directory
+
+        The file is written to a temporary path and renamed, so a running pipeline never loads
+        a partially written detrender.
+        """
+        path = op.join(get_subject_directory(subject), f'wmdetrend-{name}.npz')
+        temp_path = f'{path}.{os.getpid()}.tmp.npz'
+        metadata = {'format_version': DETREND_FORMAT_VERSION, 'n_pcs': self.n_pcs}
+        np.savez(temp_path, metadata=json.dumps(metadata), mean=self.mean_,
+                 components=self.components_, coef=self.coef_, intercept=self.intercept_)
+        os.replace(temp_path, path)
+        return path
+
+
+def load_detrender(subject, name):
+    """Load a white matter detrender saved with ``WhiteMatterDetrend.save``
+
+    Detrenders saved as the older pair of ``model-<name>.pkl`` and ``pca-<name>.pkl`` pickles
+    are converted.
+
+    Parameters
+    ----------
+    subject : str
+    name : str
+
+    Returns
+    -------
+    A ``WhiteMatterDetrend``
+    """
+    subj_dir = get_subject_directory(subject)
+    path = op.join(subj_dir, f'wmdetrend-{name}.npz')
+    if op.exists(path):
+        with np.load(path) as archive:
+            metadata = json.loads(str(archive['metadata']))
+            if metadata['format_version'] > DETREND_FORMAT_VERSION:
+                raise ValueError(f'{path} has format version {metadata["format_version"]}, '
+                                 f'newer than {DETREND_FORMAT_VERSION}')
+            detrender = WhiteMatterDetrend(n_pcs=metadata['n_pcs'])
+            detrender.mean_ = archive['mean']
+            detrender.components_ = archive['components']
+            detrender.coef_ = archive['coef']
+            detrender.intercept_ = archive['intercept']
+        return detrender
+
+    with open(op.join(subj_dir, f'model-{name}.pkl'), 'rb') as f:
+        model = pickle.load(f)
+    with open(op.join(subj_dir, f'pca-{name}.pkl'), 'rb') as f:
+        pca = pickle.load(f)
+
+    detrender = WhiteMatterDetrend(n_pcs=pca.n_components_)
+    detrender.mean_ = pca.mean_
+    detrender.components_ = pca.components_
+    detrender.coef_ = np.atleast_2d(model.coef_).T
+    detrender.intercept_ = model.intercept_
+    return detrender
+
+
+def iter_redis_chunks(gm_key_prefix, wm_key_prefix='responses:whitematterdetrend',
+                      chunk_size=100):
+    """Iterate over gray and white matter responses stored in redis in chunks
+
+    Responses stored by ``StoreToRedis`` under both prefixes are paired by the rest of their
+    key, i.e., their trial and sample index.
+
+    Parameters
+    ----------
+    gm_key_prefix : str
+    wm_key_prefix : str
+    chunk_size : int
+        Number of samples per chunk
+
+    Yields
+    ------
+    Arrays of gray matter and white matter responses
+    """
+    def suffixes(key_prefix):
+        keys = utils.r.scan_iter(key_prefix + ':*')
+        return {key.decode('utf-8')[len(key_prefix):] for key in keys}
+
+    paired = sorted(suffixes(gm_key_prefix) & suffixes(wm_key_prefix))
+    for start in range(0, len(paired), chunk_size):
+        chunk = paired[start:start + chunk_size]
+        gm = [codec.decode(value)[1] for value in utils.r.mget([gm_key_prefix + s for s in chunk])]
+        wm = [codec.decode(value)[1] for value in utils.r.mget([wm_key_prefix + s for s in chunk])]
+        yield np.array(gm), np.array(wm)
+
+
+def iter_nifti_chunks(paths, mask_gm, mask_wm, chunk_size=100):
+    """Iterate over gray and white matter activity of recorded volumes in chunks
+
+    Parameters
+    ----------
+    paths : list of str
+        Paths to nifti volumes, e.g., those written by ``preprocess.SaveNifti``, in temporal
+        order
+    mask_gm, mask_wm : numpy.ndarray
+        Boolean gray and white matter masks with the shape of the volumes
+    chunk_size : int
+        Number of volumes per chunk
+
+    Yields
+    ------
+    Arrays of gray matter and white matter activity
+    """
+    for start in range(0, len(paths), chunk_size):
+        volumes = [nib.load(path).get_fdata() for path in paths[start:start + chunk_size]]
+        yield (np.array([volume[mask_gm] for volume in volumes]),
+               np.array([volume[mask_wm] for volume in volumes]))
+
+
+class IncrementalWhiteMatterDetrend(WhiteMatterDetrend):
+    """White matter detrending that is updated as new samples arrive
+
+    Only sums and cross-products of the samples are kept: the white matter sum and (n_wm, n_wm)
+    cross-product, the (n_wm, n_gm) cross-product of white and gray matter, and the sums of gray
+    matter activity and its squares. Their size does not depend on the number of samples, so an
+    update costs the same at the end of a session as at its start. Solving takes the top
+    eigenvectors of the white matter covariance as the principal components, like the ``full``
+    solver of ``WhiteMatterDetrend.fit_chunks``, and projects the cross-products onto them to
+    get the normal equations of the regression. The mean and standard deviation of the detrended
+    activity follow from the same statistics.
+
+    Parameters
+    ----------
+    n_pcs : int
+        Number of white matter principal components
+
+    Attributes
+    ----------
+    n_samples : int
+        Number of samples the detrender was updated with
+    sum_wm, wm_wm, wm_gm, sum_gm, sum_sq_gm : numpy.ndarray
+        Sums and cross-products of the samples, in float64
+    mean_, components_, coef_, intercept_ : numpy.ndarray
+        See ``WhiteMatterDetrend``
+    std_ : numpy.ndarray
+        (n_gm,) standard deviation of the detrended gray matter activity
+
+    Methods
+    -------
+    partial_fit(gm, wm)
+        Update with new samples
+    detrend(gm, wm)
+        Remove the white matter trend from gray matter activity
+    normalize(gm, wm)
+        Detrend and z-score gray matter activity
+    get_state()
+        The statistics as a dict of arrays
+    from_state(state)
+        Create a detrender from ``get_state``
+    """
+    STATISTICS = ('sum_wm', 'wm_wm', 'wm_gm', 'sum_gm', 'sum_sq_gm')
+
+    def __init__(self, n_pcs=10):
+        super(IncrementalWhiteMatterDetrend, self).__init__(n_pcs=n_pcs)
+        self.n_samples = 0
+        for name in self.STATISTICS:
+            setattr(self, name, None)
+        self._stale = True
+
+    def partial_fit(self, gm, wm):
+        """Update with new samples
+
+        Parameters
+        ----------
+        gm : numpy.ndarray
+            (n_samples, n_gm) gray matter activity
+        wm : numpy.ndarray
+            (n_samples, n_wm) white matter activity
+        """
+        gm = np.nan_to_num(np.atleast_2d(np.asarray(gm, dtype='float64')))
+        wm = np.nan_to_num(np.atleast_2d(np.asarray(wm, dtype='float64')))
+        if self.sum_wm is None:
+            n_gm, n_wm = gm.shape[1], wm.shape[1]
+            self.sum_wm = np.zeros(n_wm)
+            self.wm_wm = np.zeros((n_wm, n_wm))
+            self.wm_gm = np.zeros((n_wm, n_gm))
+            self.sum_gm = np.zeros(n_gm)
+            self.sum_sq_gm = np.zeros(n_gm)
+
+        self.sum_wm += wm.sum(0)
+        self.wm_wm += wm.T.dot(wm)
+        self.wm_gm += wm.T.dot(gm)
+        self.sum_gm += gm.sum(0)
+        self.sum_sq_gm += (gm ** 2).sum(0)
+        self.n_samples += len(gm)
+        self._stale = True
+        return self
+
+    def _solve(self):
+        if self.n_samples <= self.n_pcs:
+            raise ValueError(f'Detrender needs more than {self.n_pcs} samples, '
+                             f'got {self.n_samples}')
+
+        if not self._stale:
+            return
+
+        n = self.n_samples
+        self.mean_ = self.sum_wm / n
+        mean_gm = self.sum_gm / n
+        covariance = self.wm_wm - n * np.outer(self.mean_, self.mean_)
+        n_wm = len(covariance)
+        _, eigenvectors = la.eigh(covariance, subset_by_index=(n_wm - self.n_pcs, n_wm - 1))
+        self.components_ = eigenvectors[:, ::-1].T
+
+        # the scores of the centered white matter have zero mean, so the centered products of
+        # the scores are projections of the centered products of the activity
+        pcs_pcs = self.components_.dot(covariance).dot(self.components_.T)
+        pcs_gm = self.components_.dot(self.wm_gm - n * np.outer(self.mean_, mean_gm))
+        self.coef_ = la.lstsq(pcs_pcs, pcs_gm)[0]
+        self.intercept_ = mean_gm
+
+        # least squares residuals have zero mean and the variance that is not explained
+        var_gm = self.sum_sq_gm / n - mean_gm ** 2
+        var_detrended = var_gm - (self.coef_ * pcs_gm).sum(0) / n
+        self.std_ = np.sqrt(np.clip(var_detrended, 0, None))
+        self._stale = False
+
+    def detrend(self, gm, wm):
+        self._solve()
+        return super(IncrementalWhiteMatterDetrend, self).detrend(gm, np.nan_to_num(wm))
+
+    def normalize(self, gm, wm):
+        return self.detrend(gm, wm) / self.std_
+
+    def get_state(self):
+        """The number of samples and the sums and cross-products, e.g., to store them with
+        ``codec.encode``
+
+        Returns
+        -------
+        A dict of arrays and ints
+        """
+        state = {'n_pcs': self.n_pcs, 'n_samples': self.n_samples}
+        if self.sum_wm is not None:
+            state.update({name: getattr(self, name) for name in self.STATISTICS})
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """Create a detrender from the dict returned by ``get_state``"""
+        detrender = cls(n_pcs=state['n_pcs'])
+        detrender.n_samples = state['n_samples']
+        if 'sum_wm' in state:
+            for name in cls.STATISTICS:
+                # decoded arrays are read-only views, and the sums are updated in place
+                setattr(detrender, name, np.array(state[name], dtype='float64'))
+        return detrender
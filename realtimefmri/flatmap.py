@@ -0,0 +1,140 @@
+"""Render flatmap images of cortical activity without matplotlib
+
+``cortex.quickflat.make_figure`` builds and rasterizes a whole matplotlib figure for every image.
+``FlatmapRenderer`` instead takes the sparse projection of voxels onto flatmap pixels and the
+curvature background from ``cortex_cache`` once. A frame is then a sparse matrix-vector product,
+a lookup in a 256-entry color table, and a copy of the colored pixels over the background, which
+is encoded to PNG or WebP with Pillow.
+"""
+import io
+
+import numpy as np
+from PIL import Image
+
+import cortex
+
+from realtimefmri import cortex_cache
+from realtimefmri.utils import get_logger
+
+logger = get_logger('realtimefmri.flatmap', to_console=True, to_network=False, to_file=True)
+
+N_COLORS = 256
+
+
+def get_color_table(cmap):
+    """Get the RGBA colors of a pycortex or matplotlib colormap
+
+    Parameters
+    ----------
+    cmap : str or None
+        Colormap name. None uses the pycortex default
+
+    Returns
+    -------
+    A (256, 4) uint8 array
+    """
+    if cmap is None:
+        cmap = cortex.options.config.get('basic', 'default_cmap')
+
+    colormap = cortex.utils.get_cmap(cmap)
+    colors = colormap(np.linspace(0, 1, N_COLORS))
+    return np.round(colors * 255).astype('uint8')
+
+
+class FlatmapRenderer():
+    """Render activity as flatmap images
+
+    Parameters
+    ----------
+    surface : str
+    transform : str
+    height : int
+        Height of the image in pixels
+    vmin, vmax : float or None
+        Limits of the colormap. None uses the 1st and 99th percentile of each frame, like
+        ``cortex.Volume``
+    cmap : str or None
+        Colormap name. None uses the pycortex default
+    mask_type : str or None
+        If given, activity is the vector of the voxels in this mask instead of a whole volume
+    image_format : str
+        ``PNG`` or ``WebP``
+    compress_level : int
+        PNG compression level. Low levels encode faster and make larger files
+
+    Attributes
+    ----------
+    projection : scipy.sparse.csr_matrix
+        (n_pixels, n_voxels) weights of voxels in each flatmap pixel that is covered by cortex
+    pixel_index : numpy.ndarray
+        Flat index of each covered pixel in the image
+    background : numpy.ndarray
+        (height, width, 4) curvature image
+    frame : numpy.ndarray
+        (height, width, 4) RGBA image of the last rendered frame. Reused by every frame
+
+    Methods
+    -------
+    render(activity)
+        Render a frame to ``frame``
+    encode(activity)
+        Render and encode a frame
+    """
+    def __init__(self, surface, transform, height=1024, vmin=None, vmax=None, cmap=None,
+                 mask_type=None, image_format='PNG', compress_level=1):
+        self.vmin = vmin
+        self.vmax = vmax
+        self.image_format = image_format
+        self.compress_level = compress_level
+
+        self.projection, self.pixel_index, _ = cortex_cache.get_flatmap_projection(
+            surface, transform, height=height, mask_type=mask_type)
+        self.background = cortex_cache.get_flatmap_curvature(surface, height=height)
+        self.color_table = get_color_table(cmap)
+        self.frame = self.background.copy()
+        self._buffer = io.BytesIO()
+
+    def render(self, activity):
+        """Render a frame
+
+        Parameters
+        ----------
+        activity : numpy.ndarray
+            A volume, or a vector of the voxels in ``mask_type``
+
+        Returns
+        -------
+        The (height, width, 4) uint8 RGBA image, which is overwritten by the next frame
+        """
+        values = self.projection.dot(np.asarray(activity, dtype='float32').ravel())
+
+        vmin, vmax = self.vmin, self.vmax
+        if vmin is None or vmax is None:
+            low, high = np.percentile(np.nan_to_num(activity), (1, 99))
+            vmin = low if vmin is None else vmin
+            vmax = high if vmax is None else vmax
+
+        valid = np.isfinite(values)
+        scale = (N_COLORS - 1) / max(vmax - vmin, np.finfo('float32').eps)
+        color_index = np.clip((values[valid] - vmin) * scale, 0, N_COLORS - 1).astype('uint8')
+
+        np.copyto(self.frame, self.background)
+        self.frame.reshape(-1, 4)[self.pixel_index[valid]] = self.color_table[color_index]
+        return self.frame
+
+    def encode(self, activity):
+        """Render a frame and encode it as an image file
+
+        Returns
+        -------
+        bytes of the encoded image
+        """
+        image = Image.fromarray(self.render(activity), mode='RGBA')
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        if self.image_format.upper() == 'PNG':
+            image.save(self._buffer, format='PNG', compress_level=self.compress_level)
+        else:
+            image.save(self._buffer, format=self.image_format)
+
+        return self._buffer.getvalue()
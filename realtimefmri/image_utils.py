@@ -6,6 +6,7 @@ import subprocess
 
 import nibabel
 import numpy as np
+from scipy import sparse
 
 import cortex
 from realtimefmri import utils
@@ -61,6 +62,50 @@ def secondary_mask(mask1, mask2, order='C'):
     return masks[:, 1].astype(bool)
 
 
+def roi_average_matrix(roi_weights, n_voxels):
+    """Build a sparse matrix that averages voxel activity within each ROI
+
+    Each ROI is given as a vector of voxel weights. Boolean masks produce unweighted means,
+    non-negative float weights produce weighted means, and ROIs are free to overlap.
+
+    Parameters
+    ----------
+    roi_weights : list of numpy.ndarray
+        One vector of length ``n_voxels`` per ROI
+    n_voxels : int
+
+    Returns
+    -------
+    A scipy.sparse.csr_matrix with shape (n_rois, n_voxels) whose rows sum to one. Rows for empty
+    ROIs have no entries, so their product with activity is zero rather than missing. Callers
+    should set the averages of these ROIs to NaN.
+    """
+    rows, cols, vals = [], [], []
+    for roi_index, weights in enumerate(roi_weights):
+        weights = np.asarray(weights).ravel()
+        if weights.size != n_voxels:
+            raise ValueError(f'ROI {roi_index} has {weights.size} voxels, expected {n_voxels}')
+
+        voxel_indices = np.flatnonzero(weights)
+        voxel_weights = weights[voxel_indices].astype('float64')
+        total = voxel_weights.sum()
+        if total == 0:
+            logger.warning('ROI %d is empty', roi_index)
+            continue
+
+        rows.append(np.full(voxel_indices.size, roi_index))
+        cols.append(voxel_indices)
+        vals.append(voxel_weights / total)
+
+    n_rois = len(roi_weights)
+    if len(rows) == 0:
+        return sparse.csr_matrix((n_rois, n_voxels))
+
+    matrix = sparse.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                               shape=(n_rois, n_voxels))
+    return matrix.tocsr()
+
+
 def register(volume, reference, twopass=False, output_transform=False):
     """Register the input image to the reference image
 
@@ -124,6 +169,48 @@ def mosaic_to_volume(mosaic, nrows=6, ncols=6):
     return volume
 
 
+def mosaic_index(shape, dim=0, strides=None):
+    """Gather index from the voxels of a volume to the pixels of its ``cortex.mosaic``
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the 3D volume
+    dim : int
+        Dimension across which to mosaic
+    strides : tuple of int or None
+        Strides of the volume in elements, to index its memory directly, e.g., a volume in
+        Fortran order raveled with ``order='K'``. None indexes the volume raveled in C order.
+
+    Returns
+    -------
+    An array with the shape of the mosaic holding the flat index of the voxel shown at each
+    pixel, a boolean array that is True at the padding pixels between slices, and the number of
+    slices across and down, like ``cortex.mosaic``
+    """
+    plane = list(shape)
+    n_slices = plane.pop(dim)
+    height, width = plane
+    n_wide = int(np.ceil(np.sqrt(n_slices / (width / float(height)))))
+    n_tall = int(np.ceil(float(n_slices) / n_wide))
+
+    if strides is None:
+        voxels = np.arange(np.prod(shape)).reshape(shape)
+    else:
+        voxels = sum(np.ix_(*[np.arange(n) * stride for n, stride in zip(shape, strides)]))
+    voxels = np.moveaxis(voxels, dim, 0)
+    index = np.zeros((n_tall * (height + 1) + 1, n_wide * (width + 1) + 1), dtype='intp')
+    padding = np.ones(index.shape, dtype=bool)
+    for i in range(n_slices):
+        row, column = divmod(i, n_wide)
+        rows = slice(row * (height + 1) + 1, (row + 1) * (height + 1))
+        columns = slice(column * (width + 1) + 1, (column + 1) * (width + 1))
+        index[rows, columns] = voxels[i]
+        padding[rows, columns] = False
+
+    return index, padding, (n_wide, n_tall)
+
+
 def decompose_affine(affine):
     """Decompose a affine matrix into pitch, roll, and yaw, x, y, z displacement components
 
@@ -5,15 +5,20 @@ Anwar O. Nunez-Elizalde (anwarnunez@berkeley.edu)
 """
 
 import numpy as np
+from scipy.special import comb
 
 from realtimefmri.preprocess import PreprocessingStep
 
 
 class OnlineMoments(PreprocessingStep):
-    """Compute 1-Nth raw moments online
+    """Compute the mean and 2nd-Nth central moments online
 
-    For the Ith moment: E[X^i] = (1/n)*\Sum(X^i). This function only stores
-    \Sum(X^i) and keeps track of the number of observations.
+    The state is a single stacked array. Its first row is the running mean and row ``i - 1``
+    holds the running sum of centered powers ``Sum((X - mean)^i)`` for ``i >= 2``. These are
+    updated with the single-pass formulas of Pebay (2008), which remain accurate in float32 data
+    with large offsets, unlike sums of raw powers. Partial states computed over different samples
+    (e.g., separate runs or workers) can be combined with ``merge``, and states computed over
+    different voxels can be joined with ``concatenate``.
 
     Parameters
     ----------
@@ -24,58 +29,187 @@ class OnlineMoments(PreprocessingStep):
     ----------
     order : int
         The number of moments to compute
-    all_raw_moments : numpy.ndarray
-        All of the raw moments
+    n : float
+        The number of observations
+    moments : numpy.ndarray
+        Array of shape (order, ...) with the mean and the sums of centered powers, in float64
 
     Methods
     -------
     update(x)
         Update the moments given the new observations
+    merge(other)
+        Combine with the moments of another set of observations
     get_statistics()
         Compute the statistics for the data
+    get_central_moments()
+        Return the central moments
     get_raw_moments()
         Return the raw moments
     get_norm_raw_moments
         Return normalized raw moments
     run(inp)
         Return the mean and standard deviation
+
+    References
+    ----------
+    .. [1] Pebay, P. (2008). Formulas for robust, one-pass parallel computation of covariances
+           and arbitrary-order statistical moments. Sandia Report SAND2008-6212.
     """
     def __init__(self, order=4, **kwargs):
-        self.n = 0.0
+        parameters = {'order': order}
+        parameters.update(kwargs)
+        super(OnlineMoments, self).__init__(**parameters)
         self.order = order
-        self.all_raw_moments = [0.0] * self.order
-        for odx in range(self.order):
-            self.__setattr__('rawmnt%i' % (odx + 1), self.all_raw_moments[odx])
+        self.n = 0.0
+        self.moments = None
 
     def __repr__(self):
         return '%s.online_moments' % (__name__)
 
     def update(self, x):
-        """Update the raw moments
+        """Update the moments
 
         Parameters
         ----------
         x : np.ndarray, or scalar-like
             The new observation. This can be any dimension.
         """
-        self.n += 1
+        x = np.asarray(x, dtype='float64')
+        if self.n == 0:
+            self.moments = np.zeros((self.order,) + x.shape)
+            self.moments[0] = x
+            self.n = 1.
+            return
+
+        n = self.n + 1
+        delta = x - self.moments[0]
+        self._combine(n, delta, 1., None)
+        self.n = n
+
+    def merge(self, other):
+        """Combine with the moments computed on a separate set of observations
+
+        Parameters
+        ----------
+        other : OnlineMoments
+            Moments of the same order, computed over the same voxels
+
+        Returns
+        -------
+        self, updated in place to hold the moments of all observations
+        """
+        if other.order != self.order:
+            raise ValueError(f'Cannot merge moments of order {other.order} into order {self.order}')
+
+        if other.n == 0:
+            return self
 
-        for odx in range(self.order):
-            name = 'rawmnt%i' % (odx + 1)
-            self.all_raw_moments[odx] = self.all_raw_moments[odx] + x**(odx + 1)
-            self.__setattr__(name, self.all_raw_moments[odx])
+        if self.n == 0:
+            self.n = other.n
+            self.moments = other.moments.copy()
+            return self
+
+        n = self.n + other.n
+        delta = other.moments[0] - self.moments[0]
+        self._combine(n, delta, other.n, other.moments)
+        self.n = n
+        return self
+
+    def _combine(self, n, delta, n_b, moments_b):
+        """Update the stacked moments in place with a second set of ``n_b`` observations
+
+        Parameters
+        ----------
+        n : float
+            Total number of observations
+        delta : numpy.ndarray
+            Mean of the second set minus the current mean
+        n_b : float
+            Number of observations in the second set
+        moments_b : numpy.ndarray or None
+            Stacked moments of the second set. None for a single observation.
+        """
+        n_a = n - n_b
+        moments_a = self.moments
+        # go from high to low order so that lower orders still hold their previous values
+        for p in range(self.order, 1, -1):
+            update = (n_a * n_b * delta / n) ** p * (1. / n_b ** (p - 1) - (-1. / n_a) ** (p - 1))
+            if moments_b is not None:
+                update += moments_b[p - 1]
+
+            for k in range(1, p - 1):
+                term = (-n_b / n) ** k * moments_a[p - k - 1]
+                if moments_b is not None:
+                    term = term + (n_a / n) ** k * moments_b[p - k - 1]
+                update += comb(p, k) * term * delta ** k
+
+            moments_a[p - 1] += update
+
+        moments_a[0] += delta * (n_b / n)
+
+    @classmethod
+    def concatenate(cls, parts, axis=0):
+        """Join moments computed over separate voxels from the same observations
+
+        Parameters
+        ----------
+        parts : list of OnlineMoments
+            Moments computed on shards of the data along ``axis``
+        axis : int
+            Axis of the observations along which the shards were taken
+
+        Returns
+        -------
+        An OnlineMoments for the full data
+        """
+        n = parts[0].n
+        if any(part.n != n for part in parts):
+            raise ValueError('All parts must have the same number of observations')
+
+        joined = cls(order=parts[0].order)
+        joined.n = n
+        joined.moments = np.concatenate([part.moments for part in parts], axis=axis + 1)
+        return joined
+
+    def get_central_moments(self):
+        """Return the mean and the 2nd-Nth central moments, E[(X - E[X])^i]"""
+        central = self.moments / self.n
+        central[0] = self.moments[0]
+        return central
 
     def get_statistics(self):
-        """Return the 1,2,3,4-moment estimates"""
-        # mean,var,skew,kurt
-        return convert_parallel2moments([self.get_raw_moments()[:4]],
-                                        self.n)
+        """Return the mean, variance, skewness and excess kurtosis estimates, up to ``order``"""
+        central = self.get_central_moments()
+        statistics = [central[0]]
+        if self.order >= 2:
+            statistics.append(central[1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.order >= 3:
+                statistics.append(central[2] / central[1] ** 1.5)
+            if self.order >= 4:
+                statistics.append(central[3] / central[1] ** 2 - 3)
+
+        return tuple(statistics)
 
     def get_raw_moments(self):
-        return self.all_raw_moments
+        """Return the sums of raw powers, Sum(X^i), for compatibility with
+        ``convert_parallel2moments``"""
+        central = self.get_central_moments()
+        mean = central[0].copy()
+        central[0] = 0.
+        raw_moments = []
+        for i in range(1, self.order + 1):
+            # E[X^i] = sum_j C(i, j) * mean^(i - j) * E[(X - mean)^j]
+            raw = mean ** i
+            for j in range(1, i + 1):
+                raw = raw + comb(i, j) * mean ** (i - j) * central[j - 1]
+            raw_moments.append(raw * self.n)
+
+        return raw_moments
 
     def get_norm_raw_moments(self):
-        return map(lambda x: x/float(self.n), self.all_raw_moments)
+        return map(lambda x: x/float(self.n), self.get_raw_moments())
 
     def run(self, inp):
         self.update(inp)
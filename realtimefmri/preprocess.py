@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
+import functools
+import inspect
+import json
 import os
 import os.path as op
 import pickle
+import queue
+import threading
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 
 import dash_core_components as dcc
@@ -21,14 +27,23 @@ import cortex
 
 from datetime import datetime
 
-from realtimefmri import buffered_array, config, image_utils, pipeline_utils
+from realtimefmri import (buffered_array, codec, config, cortex_cache, decoding, delivery,
+                         detrend, flatmap, image_utils, pipeline_utils, remote)
 from realtimefmri.utils import get_logger
 
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
 logger = get_logger('realtimefmri.preprocess', to_console=True, to_network=False, to_file=True)
 r = redis.StrictRedis(config.REDIS_HOST)
 
+# data type of voxel data passed between steps, unless the ``dtype`` global parameter says otherwise
+DEFAULT_DTYPE = 'float32'
+
 
-def preprocess(recording_id, pipeline_name, **global_parameters):
+def preprocess(recording_id, pipeline_name, staged=None, **global_parameters):
     """Highest-level class for running preprocessing
 
     This class loads the preprocessing pipeline from the configuration
@@ -42,6 +57,9 @@ def preprocess(recording_id, pipeline_name, **global_parameters):
         `pipeline` filestore
     recording_id : str
         A unique identifier for the recording
+    staged : bool or None
+        Run the pipeline stages in separate threads, see ``StagedExecutor``. None uses the
+        ``staged`` setting of the pipeline configuration
     log : bool
         Whether to send log messages to the network logger
     verbose : bool
@@ -52,36 +70,103 @@ def preprocess(recording_id, pipeline_name, **global_parameters):
         pipeline_config = yaml.load(f)
 
     pipeline_config['global_parameters'].update(global_parameters)
+    if staged is not None:
+        pipeline_config['staged'] = staged
 
     pipeline = Pipeline(**pipeline_config)
 
+    if pipeline.staged:
+        executor = StagedExecutor(pipeline, queue_size=pipeline.queue_size)
+    else:
+        executor = None
+
     # XXX: global n_skip is unused.
     # n_skip = pipeline.global_parameters.get('n_skip', 0)
 
     volume_subscription = r.pubsub()
     volume_subscription.subscribe('timestamped_volume')
     volume_subscription.subscribe('pipeline_reset')
-    for message in volume_subscription.listen():
-        if message['channel'] == b'timestamped_volume' and message['type'] == 'message':
-            timestamped_volume = pickle.loads(message['data'])
-            logger.info('Received image %d', timestamped_volume['image_number'])
-            data_dict = {'image_number': timestamped_volume['image_number'],
-                         'raw_image_time': timestamped_volume['time'],
-                         'raw_image_nii': timestamped_volume['volume']}
-            cue = r.get("cur_cue")
-            if cue is not None:
-                data_dict['experiment_info'] = dict(cur_cue=cue.decode('utf-8'))
-            else:
-                data_dict['experiment_info'] = None
+    try:
+        for message in volume_subscription.listen():
+            if message['channel'] == b'timestamped_volume' and message['type'] == 'message':
+                timestamped_volume = codec.decode(message['data'])
+                logger.info('Received image %d', timestamped_volume['image_number'])
+                data_dict = create_data_dict(timestamped_volume)
+
+                if executor is not None:
+                    executor.submit(data_dict)
+
+                else:
+                    t1 = time.time()
+                    data_dict = pipeline.process(data_dict)
+                    t2 = time.time()
+                    logger.debug('Pipeline ran in %.4f seconds', t2 - t1)
+
+            elif message['channel'] == b'pipeline_reset' and message['type'] == 'message':
+                if executor is not None:
+                    executor.drain()
+                pipeline.reset()
+                logger.info('Pipeline reset.')
+                delivery.log_report()
+
+    finally:
+        # finish the queued volumes and send their outputs before the process exits
+        if executor is not None:
+            executor.stop()
+        delivery.shutdown(timeout=10.)
+
+
+def create_data_dict(timestamped_volume):
+    """Create the data dict that a timestamped volume enters the pipeline with
 
-            t1 = time.time()
-            data_dict = pipeline.process(data_dict)
-            t2 = time.time()
-            logger.debug('Pipeline ran in %.4f seconds', t2 - t1)
+    Parameters
+    ----------
+    timestamped_volume : dict
+        Dictionary with ``image_number``, ``time``, and ``volume`` keys, as sent by the collector
+
+    Returns
+    -------
+    A dictionary with the raw image, its number and acquisition time, and the current cue of the
+    experiment
+    """
+    data_dict = {'image_number': timestamped_volume['image_number'],
+                 'raw_image_time': timestamped_volume['time'],
+                 'raw_image_nii': timestamped_volume['volume']}
+    cue = r.get("cur_cue")
+    if cue is not None:
+        data_dict['experiment_info'] = dict(cur_cue=cue.decode('utf-8'))
+    else:
+        data_dict['experiment_info'] = None
 
-        elif message['channel'] == b'pipeline_reset' and message['type'] == 'message':
-            pipeline.reset()
-            logger.info('Pipeline reset.')
+    return data_dict
+
+
+def serve_remote(pipeline_name, step_names=None, **global_parameters):
+    """Serve the remote steps of a pipeline to other preprocessing processes
+
+    Parameters
+    ----------
+    pipeline_name : str
+        Name of the preprocessing configuration file
+    step_names : list of str or None
+        Names of the steps to serve. None serves every step marked ``remote``
+    """
+    config_path = op.join(config.PIPELINE_DIR, pipeline_name + '.yaml')
+    with open(config_path, 'rb') as f:
+        pipeline_config = yaml.load(f)
+
+    pipeline_config['global_parameters'].update(global_parameters)
+    if step_names is None:
+        step_names = [step['name'] for step in pipeline_config['pipeline']
+                      if step.get('remote', False)]
+
+    # only build the served steps
+    pipeline_config['pipeline'] = [step for step in pipeline_config['pipeline']
+                                   if step['name'] in step_names]
+    pipeline_config['static_pipeline'] = None
+    pipeline = Pipeline(remote_steps=False, **pipeline_config)
+
+    remote.serve({step['name']: step['instance'] for step in pipeline.pipeline})
 
 
 class Pipeline():
@@ -95,12 +180,22 @@ class Pipeline():
     pipeline : list of dict
         The parameters for pipeline steps
     global_parameters : dict
-        Settings passed as keyword arguments to each pipeline step
+        Settings passed as keyword arguments to each pipeline step. ``dtype`` sets the data type
+        of voxel data passed between steps and defaults to ``DEFAULT_DTYPE``. It is only passed
+        to steps that take a ``dtype`` argument
     static_pipeline : list of dict
         Pipeline steps that start with initialization and do not receive input
     recording_id : str
         A unique identifier for the recording. If none is provided, one will be
         generated from the subject name and date
+    staged : bool
+        Run the stages of the pipeline in separate threads. Steps are grouped into stages by
+        their ``stage`` key
+    queue_size : int
+        Maximum number of volumes waiting in front of each stage when ``staged``
+    remote_steps : bool
+        Run steps marked ``remote`` on remote workers, see ``realtimefmri.remote``. If False,
+        every step runs locally, as it does on the workers themselves
     log : bool
         Log to network logger
     verbose : bool
@@ -126,18 +221,44 @@ class Pipeline():
     process(data_dict)
         Run the data in ```data_dict``` through each of the preprocessing steps
     """
-    def __init__(self, pipeline, static_pipeline=None, global_parameters=None, recording_id=None):
+    def __init__(self, pipeline, static_pipeline=None, global_parameters=None, recording_id=None,
+                 staged=False, queue_size=2, remote_steps=True):
         if recording_id is None:
             recording_id = 'recording_{}'.format(time.strftime('%Y%m%d_%H%M'))
 
+        global_parameters = dict(global_parameters or {})
+        global_parameters.setdefault('dtype', DEFAULT_DTYPE)
+
         self.recording_id = recording_id
         self.global_parameters = global_parameters
+        self.staged = staged
+        self.queue_size = queue_size
+        self.remote_steps = remote_steps
         self.static_pipeline = None  # set in self.build
         self.pipeline = None  # set in self.build
 
         self.build(pipeline, static_pipeline)
         self.register()
 
+    def _add_global_parameters(self, cls, kwargs):
+        """Fill in the global parameters that are not set in the kwargs of a step
+
+        ``dtype`` is only passed to steps that take a ``dtype`` argument, so it does not reach
+        steps without one, or overwrite their attributes in ``update_state``.
+
+        Parameters
+        ----------
+        cls : type
+            Class of the step
+        kwargs : dict
+            Keyword arguments of the step, updated in place
+        """
+        takes_dtype = 'dtype' in inspect.signature(cls).parameters
+        for key, value in self.global_parameters.items():
+            if key == 'dtype' and not takes_dtype:
+                continue
+            kwargs.setdefault(key, value)
+
     def _build_static_pipeline(self, static_pipeline_steps):
         """Build the static pipeline
 
@@ -155,12 +276,8 @@ class Pipeline():
                 args = step.get('args', ())
                 kwargs = step.get('kwargs', {})
 
-                if self.global_parameters:
-                    for key in self.global_parameters.keys():
-                        if key not in kwargs:
-                            kwargs[key] = self.global_parameters[key]
-
                 cls = pipeline_utils.load_class(step['class_name'])
+                self._add_global_parameters(cls, kwargs)
                 step['instance'] = cls(*args, **kwargs)
                 static_pipeline.append(step)
 
@@ -182,12 +299,13 @@ class Pipeline():
             args = step.get('args', ())
             kwargs = step.get('kwargs', dict())
 
-            if self.global_parameters:
-                for k, v in self.global_parameters.items():
-                    kwargs[k] = kwargs.get(k, v)
-
             cls = pipeline_utils.load_class(step['class_name'])
+            self._add_global_parameters(cls, kwargs)
             step['instance'] = cls(*args, **kwargs)
+            if self.remote_steps and step.get('remote', False):
+                deadline = step.get('deadline', remote.DEFAULT_DEADLINE)
+                step['instance'] = remote.RemoteStep(step['name'], step['instance'],
+                                                     deadline=deadline)
             pipeline.append(step)
 
         self.pipeline = pipeline
@@ -245,7 +363,22 @@ class Pipeline():
         -------
         A dictionary of all processing results
         """
-        for step in self.pipeline:
+        return self.process_steps(self.pipeline, data_dict)
+
+    @staticmethod
+    def process_steps(steps, data_dict):
+        """Run the data in ``data_dict`` through a list of built steps
+
+        Parameters
+        ----------
+        steps : list of dict
+        data_dict : dict
+
+        Returns
+        -------
+        A dictionary of all processing results
+        """
+        for step in steps:
             inputs = [data_dict[k] for k in step['input']]
 
             logger.info('Running %s', step['name'])
@@ -263,6 +396,29 @@ class Pipeline():
 
         return data_dict
 
+    def stages(self):
+        """Partition the pipeline into stages
+
+        Consecutive steps with the same ``stage`` key form a stage. Steps without a ``stage`` key
+        belong to the stage of the previous step, so the key only needs to be set on the first
+        step of each stage.
+
+        Returns
+        -------
+        A list of lists of steps
+        """
+        stages = []
+        current_stage = None
+        for step in self.pipeline:
+            stage = step.get('stage', current_stage)
+            if len(stages) == 0 or stage != current_stage:
+                stages.append([])
+                current_stage = stage
+
+            stages[-1].append(step)
+
+        return stages
+
     @staticmethod
     def create_interface(key):
         contents = []
@@ -297,6 +453,91 @@ class Pipeline():
             step['instance'].reset()
 
 
+class StagedExecutor():
+    """Run the stages of a pipeline in separate threads connected by bounded queues
+
+    Each stage runs in its own thread and processes volumes in the order they were submitted,
+    so every step sees its inputs in order and its state is only ever touched by one thread.
+    While a later stage works on one volume, earlier stages can start on the next one, so
+    throughput is set by the slowest stage rather than by the sum of all stages.
+
+    Parameters
+    ----------
+    pipeline : Pipeline
+    queue_size : int
+        Maximum number of volumes waiting in front of each stage. ``submit`` blocks when the
+        first stage is this far behind
+    callback : callable or None
+        Called with the data dict of each volume after the last stage
+
+    Methods
+    -------
+    submit(data_dict)
+        Queue a volume for processing
+    drain()
+        Wait until all submitted volumes have been processed
+    stop()
+        Process all submitted volumes and stop the stage threads
+    """
+    _stop = object()
+
+    def __init__(self, pipeline, queue_size=2, callback=None):
+        self.stages = pipeline.stages()
+        self.callback = callback
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in self.stages]
+        self.threads = []
+        for stage_index, steps in enumerate(self.stages):
+            thread = threading.Thread(target=self._run_stage, args=(stage_index, steps),
+                                      name=f'pipeline-stage-{stage_index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        logger.info('Running pipeline in %d stages', len(self.stages))
+
+    def _run_stage(self, stage_index, steps):
+        in_queue = self.queues[stage_index]
+        is_last = stage_index == len(self.queues) - 1
+        while True:
+            data_dict = in_queue.get()
+            try:
+                if data_dict is self._stop:
+                    if not is_last:
+                        self.queues[stage_index + 1].put(data_dict)
+                    return
+
+                t1 = time.time()
+                data_dict = Pipeline.process_steps(steps, data_dict)
+                t2 = time.time()
+                logger.debug('Stage %d ran in %.4f seconds', stage_index, t2 - t1)
+
+                if not is_last:
+                    self.queues[stage_index + 1].put(data_dict)
+                elif self.callback is not None:
+                    self.callback(data_dict)
+
+            except Exception:
+                logger.exception('Stage %d failed on image %s', stage_index,
+                                 data_dict.get('image_number'))
+
+            finally:
+                in_queue.task_done()
+
+    def submit(self, data_dict):
+        """Queue a volume for processing, blocking while the first stage is full"""
+        self.queues[0].put(data_dict)
+
+    def drain(self):
+        """Wait until all submitted volumes have passed through every stage"""
+        for stage_queue in self.queues:
+            stage_queue.join()
+
+    def stop(self):
+        """Process all submitted volumes and stop the stage threads"""
+        self.queues[0].put(self._stop)
+        for thread in self.threads:
+            thread.join()
+
+
 class PreprocessingStep():
     def __init__(self, *args, **kwargs):
         self._parameters = kwargs
@@ -356,6 +597,114 @@ class PreprocessingStep():
         raise NotImplementedError
 
 
+_blas_threads = None
+
+
+def _limit_blas_threads(n_threads):
+    """Lower the number of BLAS threads of the process to ``n_threads``"""
+    global _blas_threads
+    if threadpool_limits is None or (_blas_threads is not None and _blas_threads <= n_threads):
+        return
+
+    threadpool_limits(limits=n_threads, user_api='blas')
+    _blas_threads = n_threads
+
+
+class VoxelSharder():
+    """Run per-voxel computations on shards of the voxel axis in a persistent thread pool
+
+    NumPy releases the GIL in ufuncs and BLAS calls, so threads working on disjoint ranges of
+    voxels run in parallel. BLAS is limited to ``cpu_count // n_workers`` threads (if
+    ``threadpoolctl`` is installed) so that the pool and BLAS do not oversubscribe the cores. The
+    limit applies to the whole process, so it is set once when the sharder is created, and the
+    lowest limit of all sharders is kept.
+
+    Parameters
+    ----------
+    n_workers : int or None
+        Number of threads. None uses one per core.
+    min_shard_size : int
+        Minimum number of voxels per shard. Smaller inputs are split into fewer shards.
+
+    Attributes
+    ----------
+    pool : concurrent.futures.ThreadPoolExecutor
+    blas_threads : int
+        Number of BLAS threads allowed while the sharder is in use
+
+    Methods
+    -------
+    map(function, *arrays, **kwargs)
+        Call a function on matching shards of the arrays, writing outputs in place
+    sum(function, *arrays, **kwargs)
+        Sum the results of a function over shards of the arrays
+    """
+    def __init__(self, n_workers=None, min_shard_size=4096):
+        n_cores = os.cpu_count()
+        if n_workers is None:
+            n_workers = n_cores
+
+        self.n_workers = n_workers
+        self.min_shard_size = min_shard_size
+        self.blas_threads = max(1, n_cores // n_workers)
+        self.pool = ThreadPoolExecutor(max_workers=n_workers)
+        self._shards = {}
+        _limit_blas_threads(self.blas_threads)
+
+    def shards(self, n_voxels):
+        """Contiguous slices that split the voxel axis, cached by number of voxels"""
+        if n_voxels not in self._shards:
+            n_shards = max(1, min(self.n_workers, n_voxels // self.min_shard_size))
+            bounds = np.linspace(0, n_voxels, n_shards + 1).astype(int)
+            self._shards[n_voxels] = [slice(start, stop)
+                                      for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        return self._shards[n_voxels]
+
+    def _run(self, function, arrays, kwargs):
+        shards = self.shards(arrays[0].shape[-1])
+
+        def run_shard(shard):
+            return function(*[array[..., shard] for array in arrays], **kwargs)
+
+        if len(shards) == 1:
+            return [run_shard(shards[0])]
+
+        return list(self.pool.map(run_shard, shards))
+
+    def map(self, function, *arrays, **kwargs):
+        """Call ``function`` on matching voxel shards of ``arrays``
+
+        Every array is sliced along its last (voxel) axis and ``function`` receives views of the
+        shards. Outputs are preallocated by the caller, passed among ``arrays``, and written to
+        in place. Keyword arguments are passed to ``function`` unchanged.
+        """
+        self._run(function, arrays, kwargs)
+
+    def sum(self, function, *arrays, **kwargs):
+        """Sum of ``function`` over voxel shards of ``arrays``, for reductions over voxels"""
+        return sum(self._run(function, arrays, kwargs))
+
+
+_sharders = {}
+
+
+def get_sharder(n_workers=None):
+    """Get the process-wide ``VoxelSharder`` with ``n_workers`` threads, creating it if needed"""
+    if n_workers not in _sharders:
+        _sharders[n_workers] = VoxelSharder(n_workers)
+
+    return _sharders[n_workers]
+
+
+def _sharder_for(n_workers):
+    """Steps shard over voxels if ``n_workers`` is None or more than one"""
+    if n_workers == 1:
+        return None
+
+    return get_sharder(n_workers)
+
+
 class Debug(PreprocessingStep):
     def run(self, nii):
         return str(nii), nii.shape
@@ -444,7 +793,7 @@ class MotionCorrect(PreprocessingStep):
         parameters.update(kwargs)
         super(MotionCorrect, self).__init__(**parameters)
 
-        reference = cortex.db.get_xfm(surface, transform).reference
+        reference = cortex_cache.get_reference(surface, transform)
 
         self.reference_affine = reference.affine
         self.reference_path = reference.get_filename()
@@ -477,22 +826,124 @@ class Function(PreprocessingStep):
 class NiftiToVolume(PreprocessingStep):
     """Extract data volume from Nifti image. Translates image dimensions to be consistent with
     pycortex convention, e.g., volume shape is (30, 100, 100)
+
+    Parameters
+    ----------
+    dtype : str
+        Data type of the returned volume
     """
+    def __init__(self, *args, dtype=DEFAULT_DTYPE, **kwargs):
+        parameters = {'dtype': dtype}
+        parameters.update(kwargs)
+        super(NiftiToVolume, self).__init__(**parameters)
+        self.dtype = np.dtype(dtype)
+
     def run(self, nii):
-        return nii.get_data().T
+        return np.asarray(nii.dataobj).astype(self.dtype, copy=False).T
 
 
 class VolumeToMosaic(PreprocessingStep):
-    def __init__(self, *args, dim=0, **kwargs):
-        parameters = {'dim': dim}
+    """Tile the slices of a volume into a 2D mosaic, laid out like ``cortex.mosaic``
+
+    The gather index from voxels to mosaic pixels is computed once per volume shape, so each
+    volume is a single ``np.take`` into a preallocated mosaic.
+
+    Parameters
+    ----------
+    dim : int
+        Dimension across which to mosaic
+    quantize : bool
+        Return a uint8 mosaic scaled from ``vmin`` to ``vmax``, e.g., to send smaller images to
+        the dashboard. Padding and non-finite voxels are 0.
+    vmin, vmax : float or None
+        Limits of the quantization. None uses the minimum and maximum of each volume
+    copy : bool
+        Return a copy instead of the preallocated mosaic. The mosaic is overwritten by the next
+        volume, so set this if a step in a later stage of a staged pipeline uses the output.
+
+    Attributes
+    ----------
+    index : numpy.ndarray
+        Flat index of the voxel shown at each mosaic pixel
+    padding : numpy.ndarray
+        Flat indices of the padding pixels between slices
+    """
+    def __init__(self, *args, dim=0, quantize=False, vmin=None, vmax=None, copy=False,
+                 **kwargs):
+        parameters = {'dim': dim, 'quantize': quantize, 'vmin': vmin, 'vmax': vmax,
+                      'copy': copy}
         parameters.update(kwargs)
         super(VolumeToMosaic, self).__init__(**parameters)
         self.dim = dim
+        self.quantize = quantize
+        self.vmin = vmin
+        self.vmax = vmax
+        self.copy = copy
+        self.shape = None
+
+    @staticmethod
+    def _strides(volume):
+        """Element strides of volumes that are contiguous in some axis order, e.g., the
+        transposed volumes of ``NiftiToVolume``, so they can be indexed without a copy"""
+        if volume.flags.c_contiguous or volume.flags.f_contiguous:
+            return tuple(stride // volume.itemsize for stride in volume.strides)
+
+        return None
+
+    def _setup(self, volume):
+        self.shape = volume.shape
+        self.dtype = volume.dtype
+        self.strides = self._strides(volume)
+        self.index, padding, _ = image_utils.mosaic_index(volume.shape, dim=self.dim,
+                                                          strides=self.strides)
+        self.padding = np.flatnonzero(padding)
+        self.gathered = np.empty(self.index.shape, dtype=volume.dtype)
+        # padding is NaN, which needs a floating point mosaic
+        if volume.dtype.kind == 'f':
+            self.mosaic = self.gathered
+        else:
+            self.mosaic = np.empty(self.index.shape, dtype='float32')
+        if self.quantize:
+            self.quantized = np.empty(self.index.shape, dtype='uint8')
 
     def run(self, volume):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            return cortex.mosaic(volume, dim=self.dim, show=False)[0]
+        if volume.ndim != 3:
+            # RGBA volumes
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                return cortex.mosaic(volume, dim=self.dim, show=False)[0]
+
+        if (volume.shape != self.shape or volume.dtype != self.dtype or
+                self._strides(volume) != self.strides):
+            self._setup(volume)
+
+        order = 'C' if self.strides is None else 'K'
+        np.take(np.ravel(volume, order=order), self.index, out=self.gathered)
+        if self.mosaic is not self.gathered:
+            np.copyto(self.mosaic, self.gathered, casting='unsafe')
+
+        if self.quantize:
+            vmin, vmax = self.vmin, self.vmax
+            if vmin is None or vmax is None:
+                finite = volume[np.isfinite(volume)]
+                if finite.size == 0:
+                    finite = np.zeros(1)
+                vmin = finite.min() if vmin is None else vmin
+                vmax = finite.max() if vmax is None else vmax
+
+            scale = 255. / max(vmax - vmin, np.finfo('float32').eps)
+            np.subtract(self.mosaic, vmin, out=self.mosaic)
+            np.multiply(self.mosaic, scale, out=self.mosaic)
+            np.clip(self.mosaic, 0, 255, out=self.mosaic)
+            np.copyto(self.mosaic, 0., where=np.isnan(self.mosaic))
+            self.quantized[:] = self.mosaic
+            self.quantized.ravel()[self.padding] = 0
+            mosaic = self.quantized
+        else:
+            self.mosaic.ravel()[self.padding] = np.nan
+            mosaic = self.mosaic
+
+        return mosaic.copy() if self.copy else mosaic
 
 
 class ApplyMask(PreprocessingStep):
@@ -516,7 +967,7 @@ class ApplyMask(PreprocessingStep):
         parameters = {'surface': surface, 'transform': transform, 'mask_type': mask_type}
         parameters.update(kwargs)
         super(ApplyMask, self).__init__(**parameters)
-        mask = cortex.db.get_mask(surface, transform, mask_type)
+        mask = cortex_cache.get_mask(surface, transform, mask_type)
         self.mask = mask
 
     def run(self, volume):
@@ -593,8 +1044,8 @@ class ApplySecondaryMask(PreprocessingStep):
                       'mask_type_1': mask_type_1, 'mask_type_2': mask_type_2}
         parameters.update(kwargs)
         super(ApplySecondaryMask, self).__init__(**parameters)
-        mask1 = cortex.db.get_mask(surface, transform, mask_type_1).T  # in xyz
-        mask2 = cortex.db.get_mask(surface, transform, mask_type_2).T  # in xyz
+        mask1 = cortex_cache.get_mask(surface, transform, mask_type_1).T  # in xyz
+        mask2 = cortex_cache.get_mask(surface, transform, mask_type_2).T  # in xyz
         self.mask = image_utils.secondary_mask(mask1, mask2, order='F')
 
     def run(self, x):
@@ -617,9 +1068,11 @@ class ActivityRatio(PreprocessingStep):
 
 
 class RoiActivity(PreprocessingStep):
-    """Extract activity from an ROI.
+    """Extract mean activity from a set of ROIs or parcels.
 
-    Placeholder
+    All ROI averages are computed with a single sparse (ROI x voxel) matrix-vector product, so
+    the cost is proportional to the number of voxels in the ROIs rather than the number of ROIs
+    times the number of voxels.
 
     Parameters
     ----------
@@ -632,22 +1085,34 @@ class RoiActivity(PreprocessingStep):
         provided as a vector of gray matter activity. ``pre_mask_name`` is the
         name of the mask that was applied to the raw image volume to produce
         the gray matter activity vector.
-    roi_names : list of str
-        names of the ROIs to extract
+    roi_names : list of str or None
+        names of the pycortex ROIs to extract. Ignored if ``parcellation_name`` is provided.
+    parcellation_name : str or None
+        Name of a nifti file in the subject directory that defines the ROIs. A 3D volume of
+        integer labels defines one ROI per non-zero label. A 4D volume defines one weighted ROI
+        per frame, so parcels can overlap.
+    dtype : str
+        Data type of the ROI weights and the returned activity
 
     Attributes
     ----------
-    masks : dict
-        A dictionary containing the voxel masks for each named ROI
+    roi_names : list of str
+        Names of the ROIs, in the order of the returned activity
+    roi_matrix : scipy.sparse.csr_matrix
+        A (n_rois, n_voxels) matrix whose rows hold the normalized voxel weights of each ROI
+    empty_rois : numpy.ndarray
+        Boolean mask of the ROIs without voxels in ``pre_mask_name``, whose activity is NaN
 
     Methods
     -------
     run():
-        Returns a list of floats of mean activity in the requested ROIs
+        Returns an array of mean activity in the requested ROIs
     """
-    def __init__(self, surface, transform, pre_mask_name, roi_names, *args, **kwargs):
+    def __init__(self, surface, transform, pre_mask_name, roi_names=None, *args,
+                 parcellation_name=None, dtype=DEFAULT_DTYPE, **kwargs):
         parameters = {'surface': surface, 'transform': transform,
-                      'pre_mask_name': pre_mask_name, 'roi_names': roi_names}
+                      'pre_mask_name': pre_mask_name, 'roi_names': roi_names,
+                      'parcellation_name': parcellation_name, 'dtype': dtype}
         parameters.update(kwargs)
         super(RoiActivity, self).__init__(**parameters)
 
@@ -655,47 +1120,162 @@ class RoiActivity(PreprocessingStep):
         pre_mask_path = op.join(subj_dir, pre_mask_name + '.nii')
 
         # mask in zyx
-        pre_mask = nib.load(pre_mask_path).get_data().T.astype(bool)
+        pre_mask = np.asarray(nib.load(pre_mask_path).dataobj).T.astype(bool)
+
+        if parcellation_name is not None:
+            parcellation_path = op.join(subj_dir, parcellation_name + '.nii')
+            parcellation = np.asarray(nib.load(parcellation_path).dataobj)
+            if parcellation.ndim == 3:
+                labels = np.rint(parcellation.T).astype(int)
+                label_values = np.unique(labels[labels != 0])
+                roi_names = [str(label) for label in label_values]
+                roi_volumes = (labels == label for label in label_values)
+            else:
+                # one weight map per frame, in zyx
+                roi_names = [str(i) for i in range(parcellation.shape[-1])]
+                roi_volumes = (parcellation[..., i].T for i in range(parcellation.shape[-1]))
 
-        # returns masks in zyx
-        roi_masks, roi_dict = cortex.get_roi_masks(surface, transform, roi_names)
+        else:
+            # returns masks in zyx
+            roi_masks, roi_dict = cortex_cache.get_roi_masks(surface, transform, roi_names)
+            roi_names = list(roi_dict.keys())
+            roi_volumes = (roi_masks == mask_value for mask_value in roi_dict.values())
 
-        self.masks = dict()
-        for name, mask_value in roi_dict.items():
-            roi_mask = roi_masks == mask_value
-            self.masks[name] = image_utils.secondary_mask(pre_mask, roi_mask)
+        self.roi_names = roi_names
+        roi_matrix = image_utils.roi_average_matrix([vol[pre_mask] for vol in roi_volumes],
+                                                    int(pre_mask.sum()))
+        self.roi_matrix = roi_matrix.astype(dtype)
+        self.empty_rois = np.diff(self.roi_matrix.indptr) == 0
 
     def run(self, activity):
-        if activity.ndim > 1:
-            activity = activity.reshape(-1, 1)
-        roi_activities = dict()
-        for name, mask in self.masks.items():
-            roi_activities[name] = float(activity[mask].mean())
-        return roi_activities
+        roi_activity = self.roi_matrix.dot(activity.ravel())
+        roi_activity[self.empty_rois] = np.nan
+        return roi_activity
 
 
-def detrend_poly(data, poly_degree=1):
-    """Run polynomial detrending on data.
+@functools.lru_cache(maxsize=64)
+def poly_basis(n_samples, poly_degree=1, dtype='float64'):
+    """Orthonormal basis for a Legendre polynomial design matrix
+
+    Cached on the arguments, so it is computed once per window length.
 
     Parameters
     ----------
-    data : array (n_samples, n_voxels)
+    n_samples : int
     poly_degree : int
+    dtype : str
 
     Returns
     -------
-    data : array (n_samples, n_voxels)
-        Detrended data.
+    A read-only array (n_samples, poly_degree + 1) whose columns span the constant and polynomial
+    trends up to ``poly_degree``
     """
-    n_samples = data.shape[0]
     X = np.ones((n_samples, 1))  # mean
     for d in range(poly_degree):
         poly = Legendre.basis(d + 1)
         poly_trend = poly(np.linspace(-1, 1, n_samples))
         X = np.hstack((X, poly_trend[:, None]))
-    coef_poly, _, _, _ = la.lstsq(X, data)
-    data = data - X.dot(coef_poly)
-    return data
+
+    basis, _ = np.linalg.qr(X)
+    basis = basis.astype(dtype)
+    basis.setflags(write=False)
+    return basis
+
+
+@functools.lru_cache(maxsize=64)
+def detrend_poly_projector(n_samples, poly_degree=1, dtype='float64'):
+    """Residual-forming matrix I - X X^+ for polynomial detrending
+
+    Cached on the arguments, so it is computed once per window length.
+
+    Parameters
+    ----------
+    n_samples : int
+    poly_degree : int
+    dtype : str
+
+    Returns
+    -------
+    A read-only array (n_samples, n_samples). Multiplying data (n_samples, n_voxels) by it
+    removes the polynomial trends.
+    """
+    basis = poly_basis(n_samples, poly_degree)
+    projector = np.eye(n_samples) - basis.dot(basis.T)
+    projector = projector.astype(dtype)
+    projector.setflags(write=False)
+    return projector
+
+
+def detrend_poly(data, poly_degree=1, last_only=False):
+    """Run polynomial detrending on data.
+
+    Projects the data onto the complement of a cached orthonormal polynomial basis, which costs
+    two thin matrix products instead of a least squares solve.
+
+    Parameters
+    ----------
+    data : array (n_samples, n_voxels)
+    poly_degree : int
+    last_only : bool
+        Only detrend the newest sample. This is a single matrix-vector product with the last row
+        of the cached projector.
+
+    Returns
+    -------
+    data : array (n_samples, n_voxels), or (n_voxels,) if ``last_only``
+        Detrended data.
+    """
+    n_samples = data.shape[0]
+    # detrend in the precision of the data
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.dtype('float64')
+    if last_only:
+        projector = detrend_poly_projector(n_samples, poly_degree, dtype.name)
+        return projector[-1].dot(data)
+
+    basis = poly_basis(n_samples, poly_degree, dtype.name)
+    return data - basis.dot(basis.T.dot(data))
+
+
+class DetrendPoly(PreprocessingStep):
+    """Polynomial detrending over a sliding window of samples
+
+    Keeps the last ``window_size`` samples and returns the newest sample with the polynomial
+    trends of the window removed, using one row of a cached projector.
+
+    Parameters
+    ----------
+    window_size : int
+        Number of samples over which to estimate the trends
+    poly_degree : int
+        Degree of the polynomial trends. 0 only removes the mean.
+
+    Methods
+    -------
+    run(inp)
+        Returns the detrended input
+    """
+    def __init__(self, *args, window_size=30, poly_degree=1, **kwargs):
+        parameters = {'window_size': window_size, 'poly_degree': poly_degree}
+        parameters.update(kwargs)
+        super(DetrendPoly, self).__init__(**parameters)
+        self.window_size = window_size
+        self.poly_degree = poly_degree
+        self.data = None
+
+    def run(self, inp):
+        if self.data is None:
+            self.data = buffered_array.BufferedArray(inp.size, dtype=inp.dtype,
+                                                     buffer_size=self.window_size, mode='ring')
+
+        self.data.append(inp.ravel())
+        if self.data.shape[0] <= self.poly_degree + 1:
+            return np.zeros_like(inp)
+
+        detrended = detrend_poly(self.data.get_array(), self.poly_degree, last_only=True)
+        return detrended.reshape(inp.shape)
+
+    def reset(self):
+        self.data = None
 
 
 class OnlineCompcorDetrending(PreprocessingStep):
@@ -732,6 +1312,27 @@ class OnlineCompcorDetrending(PreprocessingStep):
         Default 'whitematterdetrend-3'.
         (This needs to be generated before)
 
+    buffer_mode : str or None
+        Memory policy for the stored samples, one of the ``buffered_array.BufferedArray`` modes.
+        Defaults to 'ring' when ``window_size`` is set, so only the window is kept, and 'grow'
+        otherwise.
+
+    incremental : bool
+        Update the white matter Gram matrix of the window with one new row and column per
+        sample and solve the PCA and regression in that (samples x samples) space, instead of
+        refitting PCA and LinearRegression on all voxels every sample. Gives the same result to
+        numerical tolerance.
+        Default True.
+
+    n_workers : int or None
+        Number of threads over which to shard voxels in the incremental updates. 1 runs
+        serially, None uses all cores.
+        Default 1.
+
+    dtype : str
+        Data type of the stored samples and the detrended activity.
+        Default ``DEFAULT_DTYPE``.
+
     Methods
     -------
     run(volume)
@@ -743,6 +1344,10 @@ class OnlineCompcorDetrending(PreprocessingStep):
                  window_size=120,
                  mask_gray_matter='thick',
                  mask_white_matter='whitematterdetrend-3',
+                 buffer_mode=None,
+                 incremental=True,
+                 n_workers=1,
+                 dtype=DEFAULT_DTYPE,
                  **kwargs):
         parameters = {
             'subject': subject,
@@ -750,19 +1355,18 @@ class OnlineCompcorDetrending(PreprocessingStep):
             'n_components': n_components,
             'window_size': window_size,
             'mask_gray_matter': mask_gray_matter,
-            'mask_white_matter': mask_white_matter
-
+            'mask_white_matter': mask_white_matter,
+            'buffer_mode': buffer_mode,
+            'incremental': incremental,
+            'n_workers': n_workers,
+            'dtype': dtype
         }
         parameters.update(kwargs)
         super(OnlineCompcorDetrending, self).__init__(**parameters)
-        self.mask_gm = cortex.db.get_mask(subject,
-                                          transform,
-                                          type=mask_gray_matter)
+        self.mask_gm = cortex_cache.get_mask(subject, transform, mask_gray_matter)
         self.n_gm_voxels = self.mask_gm.sum()
 
-        self.mask_wm = cortex.db.get_mask(subject,
-                                          transform,
-                                          type=mask_white_matter)
+        self.mask_wm = cortex_cache.get_mask(subject, transform, mask_white_matter)
         # remove gm voxels from white matter
         n_intersection_voxels = np.logical_and(
             self.mask_gm, self.mask_wm).sum()
@@ -772,35 +1376,100 @@ class OnlineCompcorDetrending(PreprocessingStep):
         self.n_wm_voxels = self.mask_wm.sum()
 
         # make buffered arrays for non-detrended gm and wm data
-        self.gm_data = buffered_array.BufferedArray(self.n_gm_voxels)
-        self.wm_data = buffered_array.BufferedArray(self.n_wm_voxels)
+        if buffer_mode is None:
+            buffer_mode = 'grow' if window_size is None else 'ring'
+        buffer_size = 1000 if window_size is None else window_size
+        self.gm_data = buffered_array.BufferedArray(self.n_gm_voxels, dtype=dtype,
+                                                    buffer_size=buffer_size, mode=buffer_mode)
+        self.wm_data = buffered_array.BufferedArray(self.n_wm_voxels, dtype=dtype,
+                                                    buffer_size=buffer_size, mode=buffer_mode)
 
         self.n_components = n_components
         self.window_size = window_size
+        self.incremental = incremental
+        self.sharder = _sharder_for(n_workers)
+        self.dtype = np.dtype(dtype)
+
+        # the first sample is subtracted from all stored samples to keep them well conditioned.
+        # This does not change the result because polynomial detrending removes the mean.
+        self.gm_reference = None
+        self.wm_reference = None
+
+        # white matter Gram matrix of the window, in chronological order
+        self.n_gram = 0
+        self.gram = np.zeros((buffer_size, buffer_size))
 
         self.detrend = pipeline.Pipeline(steps=[
             ('pca', decomposition.PCA(n_components=self.n_components,
                                       svd_solver='full')),
             ('regression', linear_model.LinearRegression())])
 
-    def run(self, volume):
-        tstart = time.time()
-        wm = volume[self.mask_wm]
-        gm = volume[self.mask_gm]
-        self.gm_data.append(gm)
-        self.wm_data.append(wm)
-        # if we don't have enough samples return the masked data without
-        # further preprocessing
-        n_samples = self.gm_data.shape[0]
-        if n_samples <= self.n_components:
-            return gm
-        # otherwise run detrending
+    def _window(self, data):
+        """Take only the last ``window_size`` samples of a buffered array"""
+        n_samples = data.shape[0]
         window_start = 0
         if self.window_size is not None:
             window_start = max(n_samples - self.window_size, 0)
-        # Take only a window of data
-        gm_data = self.gm_data[window_start:]
-        wm_data = self.wm_data[window_start:]
+        return data[window_start:]
+
+    def _update_gram(self):
+        """Add the newest sample to the Gram matrix, dropping the oldest if it left the window"""
+        wm_data = self._window(self.wm_data)
+        n_samples = wm_data.shape[0]
+
+        if n_samples > self.gram.shape[0]:
+            gram = np.zeros((2 * n_samples, 2 * n_samples))
+            gram[:self.n_gram, :self.n_gram] = self.gram[:self.n_gram, :self.n_gram]
+            self.gram = gram
+
+        if n_samples == self.n_gram:
+            self.gram[:n_samples - 1, :n_samples - 1] = self.gram[1:n_samples, 1:n_samples]
+
+        if self.sharder is None:
+            products = wm_data.dot(wm_data[-1])
+        else:
+            products = self.sharder.sum(lambda wm: wm.dot(wm[-1]), wm_data)
+        products = products.astype('float64')
+        self.gram[n_samples - 1, :n_samples] = products
+        self.gram[:n_samples, n_samples - 1] = products
+        self.n_gram = n_samples
+
+    def _detrend_incremental(self):
+        """Detrend the newest gray matter sample using the white matter Gram matrix
+
+        With P the polynomial detrending projector and U the top eigenvectors of the detrended
+        Gram matrix P W W' P, the PCA scores of the detrended white matter are U S and the
+        regression of detrended gray matter P G on them predicts U U' P G. The detrended newest
+        sample is therefore a weighted sum of the raw gray matter samples in the window.
+        """
+        n_samples = self.n_gram
+        projector = detrend_poly_projector(n_samples)
+        centered_gram = projector.dot(self.gram[:n_samples, :n_samples]).dot(projector)
+        eigenvalues, eigenvectors = la.eigh(centered_gram)
+
+        order = eigenvalues.argsort()[::-1][:self.n_components]
+        # drop components without variance, which the regression would ignore
+        order = order[eigenvalues[order] > eigenvalues.max() * 1e-10]
+        components = eigenvectors[:, order]
+
+        weights = projector[:, -1] - components.dot(components[-1])
+        gm_data = self._window(self.gm_data)
+        weights = weights.astype(gm_data.dtype)
+        if self.sharder is None:
+            return weights.dot(gm_data)
+
+        gm_detrended = np.empty(gm_data.shape[1], gm_data.dtype)
+
+        def weighted_sum(gm, out):
+            out[:] = weights.dot(gm)
+
+        self.sharder.map(weighted_sum, gm_data, gm_detrended)
+        return gm_detrended
+
+    def _detrend_batch(self):
+        """Detrend the newest gray matter sample by refitting PCA and regression on the window"""
+        gm_data = self._window(self.gm_data)
+        wm_data = self._window(self.wm_data)
         # Remove mean and linear trend first
         both_data = np.hstack((gm_data, wm_data))
         both_data = detrend_poly(both_data)
@@ -810,9 +1479,36 @@ class OnlineCompcorDetrending(PreprocessingStep):
         self.detrend.fit(wm_data, gm_data)
         trend = self.detrend.predict(wm_data[-1][None])
         gm_detrended = gm_data[-1][None] - trend
-        logger.debug(f"OnlineCompcorDetrending took {time.time()-tstart:.2f} s")
         return gm_detrended[0]
 
+    def run(self, volume):
+        tstart = time.time()
+        wm = volume[self.mask_wm]
+        gm = volume[self.mask_gm]
+        if self.gm_reference is None:
+            self.gm_reference = gm.copy()
+            self.wm_reference = wm.copy()
+
+        self.gm_data.append(gm - self.gm_reference)
+        self.wm_data.append(wm - self.wm_reference)
+        if self.incremental:
+            self._update_gram()
+
+        # if we don't have enough samples return the masked data without
+        # further preprocessing
+        n_samples = self.gm_data.shape[0]
+        if n_samples <= self.n_components:
+            return gm.astype(self.dtype, copy=False)
+
+        # otherwise run detrending
+        if self.incremental:
+            gm_detrended = self._detrend_incremental()
+        else:
+            gm_detrended = self._detrend_batch()
+
+        logger.debug(f"OnlineCompcorDetrending took {time.time()-tstart:.2f} s")
+        return gm_detrended.astype(self.dtype, copy=False)
+
 
 class WMDetrend(PreprocessingStep):
     """Detrend a volume using white matter detrending
@@ -833,6 +1529,7 @@ class WMDetrend(PreprocessingStep):
         Subject identifier
     model_name : str
         Name of white matter detrending model in subject's directory
+    detrender : detrend.WhiteMatterDetrend
 
     Methods
     -------
@@ -844,29 +1541,45 @@ class WMDetrend(PreprocessingStep):
         parameters = {'subject': subject, 'model_name': model_name}
         parameters.update(kwargs)
         super(WMDetrend, self).__init__(**parameters)
-        subj_dir = config.get_subject_directory(subject)
-
-        model_path = op.join(subj_dir, 'model-%s.pkl' % model_name)
-        pca_path = op.join(subj_dir, 'pca-%s.pkl' % model_name)
-
-        with open(model_path, 'r') as f:
-            model = pickle.load(f)
-
-        with open(pca_path, 'r') as f:
-            pca = pickle.load(f)
-
-        self.model = model
-        self.pca = pca
+        self.detrender = detrend.load_detrender(subject, model_name)
 
     def run(self, wm_activity, gm_activity):
-        wm_activity_pcs = self.pca.transform(wm_activity.reshape(1, -1)).reshape(1, -1)
-        gm_trend = self.model.predict(wm_activity_pcs)
-        return gm_activity - gm_trend
+        return self.detrender.detrend(gm_activity, wm_activity.reshape(1, -1))[0]
 
 
 class IncrementalMeanStd(PreprocessingStep):
     """Preprocessing module that z-scores data using running mean and variance
+
+    The mean and the sum of squared deviations are updated with Welford's algorithm, so each
+    update costs O(voxels) in time and memory regardless of the number of samples seen.
+
+    Parameters
+    ----------
+    keep_history : bool
+        Also store every sample in a ``BufferedArray``. Not needed to compute the statistics.
+    buffer_mode : str
+        Memory policy for the stored samples, one of the ``buffered_array.BufferedArray`` modes
+
+    Attributes
+    ----------
+    n : int
+        Number of samples seen
+    mean : numpy.ndarray
+        Running mean, accumulated in float64
+    m2 : numpy.ndarray
+        Running sum of squared deviations from the mean, accumulated in float64
+    data : buffered_array.BufferedArray or None
+        All samples, if ``keep_history`` is set
     """
+    def __init__(self, *args, keep_history=False, buffer_mode='grow', **kwargs):
+        parameters = {'keep_history': keep_history, 'buffer_mode': buffer_mode}
+        parameters.update(kwargs)
+        super(IncrementalMeanStd, self).__init__(**parameters)
+        self.keep_history = keep_history
+        self.buffer_mode = buffer_mode
+        self.data = None
+        self.reset()
+
     def run(self, array):
         """Run the z-scoring on one time point and update the prior
 
@@ -880,20 +1593,41 @@ class IncrementalMeanStd(PreprocessingStep):
         The input array z-scored using the posterior mean and variance
         """
         self.update_state()
-        if not getattr(self, 'data', None):
+        if self.n == 0:
             self.array_shape = array.shape
-            self.data = buffered_array.BufferedArray(array.size, dtype=array.dtype)
-            self.data.append(array.ravel())
+            self.dtype = array.dtype
+            self.mean = np.zeros(array.size, dtype='float64')
+            self.m2 = np.zeros(array.size, dtype='float64')
+            self._delta = np.empty(array.size, dtype='float64')
+            if self.keep_history:
+                self.data = buffered_array.BufferedArray(array.size, dtype=array.dtype,
+                                                         mode=self.buffer_mode)
+
+        x = array.ravel()
+        if self.data is not None:
+            self.data.append(x)
+
+        # Welford update
+        self.n += 1
+        delta = np.subtract(x, self.mean, out=self._delta)
+        self.mean += delta / self.n
+        delta *= x - self.mean
+        self.m2 += delta
+
+        if self.n == 1:
             return None, None
 
-        self.data.append(array.ravel())
-
-        std = np.std(self.data.get_array(), 0)
-        mean = np.mean(self.data.get_array(), 0)
+        std = np.sqrt(self.m2 / self.n).astype(self.dtype, copy=False)
+        mean = self.mean.astype(self.dtype)
 
         return mean.reshape(self.array_shape), std.reshape(self.array_shape)
 
     def reset(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        if self.data is not None:
+            self.data.close()
         self.data = None
 
 
@@ -901,13 +1635,25 @@ class RunningMeanStd(PreprocessingStep):
     """Compute a running mean and standard deviation for a set of voxels
 
     Compute a running mean and standard deviation, looking back a set number of
-    samples.
+    samples. Samples are kept in a circular buffer alongside running sums, sums of squares, and
+    counts of non-NaN values, so each update costs O(voxels) regardless of the window size. The
+    running sums are recomputed exactly from the buffer every ``recompute_every`` updates to
+    bound floating point drift.
 
     Parameters
     ----------
     n : int
         The number of past samples over which to compute mean and standard
         deviation
+    n_skip : int
+        Number of initial images to skip
+    recompute_every : int
+        Number of updates between exact recomputations of the running sums
+    dtype : str
+        Data type of the stored samples and of the returned mean and standard deviation. The
+        running sums are always accumulated in float64.
+    n_workers : int or None
+        Number of threads over which to shard voxels. 1 runs serially, None uses all cores.
 
     Attributes
     ----------
@@ -919,7 +1665,10 @@ class RunningMeanStd(PreprocessingStep):
     std : numpy.ndarray
         The standard deviation for the samples
     samples : numpy.ndarray
-        The stored samples
+        The stored samples, offset by ``shift``. Unfilled rows are NaN.
+    shift : numpy.ndarray
+        The first sample, subtracted from every sample to keep the sums of squares well
+        conditioned
 
     Methods
     -------
@@ -927,59 +1676,133 @@ class RunningMeanStd(PreprocessingStep):
         Adds the input vector to the stored samples (discard the oldest sample)
         and compute and return the mean and standard deviation.
     """
-    def __init__(self, *args, n=20, n_skip=5, **kwargs):
-        parameters = {'n': n, 'n_skip': n_skip}
+    def __init__(self, *args, n=20, n_skip=5, recompute_every=100, dtype=DEFAULT_DTYPE,
+                 n_workers=1, **kwargs):
+        parameters = {'n': n, 'n_skip': n_skip, 'recompute_every': recompute_every,
+                      'dtype': dtype, 'n_workers': n_workers}
         parameters.update(kwargs)
         super(RunningMeanStd, self).__init__(**parameters)
         self.n = n
-        self.mean = None
-        self.samples = None
         self.n_skip = n_skip
+        self.recompute_every = recompute_every
+        self.dtype = np.dtype(dtype)
+        self.sharder = _sharder_for(n_workers)
+        self.reset()
+
+    @staticmethod
+    def _update(inp, shift, samples, total, total_sq, count, mean, std, index=0,
+                recompute=False):
+        """Update the stored samples and running sums of a set of voxels in place, and write
+        their mean and standard deviation to ``mean`` and ``std``"""
+        old = samples[index].astype('float64')
+        old_valid = ~np.isnan(old)
+        old = np.where(old_valid, old, 0.)
+
+        samples[index] = inp - shift
+        # accumulate what was stored so that the exact recomputation gives the same sums
+        new = samples[index].astype('float64')
+        new_valid = ~np.isnan(new)
+        new = np.where(new_valid, new, 0.)
+
+        if recompute:
+            # recompute the running sums exactly from the stored samples
+            count[:] = (~np.isnan(samples)).sum(0)
+            total[:] = np.nansum(samples, 0, dtype='float64')
+            total_sq[:] = np.nansum(np.square(samples, dtype='float64'), 0)
+        else:
+            total += new - old
+            total_sq += new * new - old * old
+            count += new_valid.astype(int) - old_valid
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            voxel_mean = total / count
+            var = np.maximum(total_sq / count - voxel_mean ** 2, 0.)
+
+        mean[:] = voxel_mean + shift
+        std[:] = np.sqrt(var)
 
     def run(self, inp, image_number=None):
         if image_number < self.n_skip:
-            return np.zeros(inp.size), np.ones(inp.size)
-
-        if self.mean is None:
-            self.samples = np.empty((self.n, inp.size)) * np.nan
+            return np.zeros(inp.size, self.dtype), np.ones(inp.size, self.dtype)
+
+        inp = inp.ravel()
+        if self.samples is None:
+            self.samples = np.full((self.n, inp.size), np.nan, dtype=self.dtype)
+            self.shift = np.nan_to_num(inp.astype('float64'))
+            self._sum = np.zeros(inp.size)
+            self._sumsq = np.zeros(inp.size)
+            self._count = np.zeros(inp.size, dtype=int)
+
+        self._n_updates += 1
+        recompute = self._n_updates % self.recompute_every == 0
+
+        mean = np.empty(inp.size, self.dtype)
+        std = np.empty(inp.size, self.dtype)
+        arrays = (inp, self.shift, self.samples, self._sum, self._sumsq, self._count, mean, std)
+        if self.sharder is None:
+            self._update(*arrays, index=self._index, recompute=recompute)
         else:
-            self.samples[:-1, :] = self.samples[1:, :]
+            self.sharder.map(self._update, *arrays, index=self._index, recompute=recompute)
 
-        self.samples[-1, :] = inp
-        self.mean = np.nanmean(self.samples, 0)
-        self.std = np.nanstd(self.samples, 0)
+        self._index = (self._index + 1) % self.n
+        self.mean = mean
+        self.std = std
         return self.mean, self.std
 
     def reset(self):
         self.mean = None
+        self.std = None
         self.samples = None
+        self.shift = None
+        self._index = 0
+        self._n_updates = 0
+
+
+def _zscore(array, mean, std, out):
+    np.subtract(array, mean, out=out)
+    np.divide(out, std, out=out, where=std != 0)
 
 
 class ZScore(PreprocessingStep):
     """Compute a z-scored version of an input array given precomputed means and standard deviations
 
+    Parameters
+    ----------
+    n_workers : int or None
+        Number of threads over which to shard voxels. 1 runs serially, None uses all cores.
+
     Methods
     -------
     run(inp, mean, std)
         Return the z-scored version of the data
     """
+    def __init__(self, *args, n_workers=1, **kwargs):
+        parameters = {'n_workers': n_workers}
+        parameters.update(kwargs)
+        super(ZScore, self).__init__(**parameters)
+        self.sharder = _sharder_for(n_workers)
+
     def run(self, array, mean, std):
         if mean is None:
             zscored_array = np.zeros_like(array)
-        else:
+        elif self.sharder is None:
             zscored_array = np.divide(array - mean, std, where=std != 0)
+        else:
+            zscored_array = np.empty(array.shape, np.result_type(array, mean, std))
+            self.sharder.map(_zscore, array, mean, std, zscored_array)
 
         return zscored_array
 
 
 class AggregateTimestampedVolumes(PreprocessingStep):
-    def __init__(self, *args, active=True, buffer_size=1000, **kwargs):
-        parameters = {'active': active, 'buffer_size': buffer_size}
+    def __init__(self, *args, active=True, buffer_size=1000, buffer_mode='grow', **kwargs):
+        parameters = {'active': active, 'buffer_size': buffer_size, 'buffer_mode': buffer_mode}
         parameters.update(kwargs)
         super(AggregateTimestampedVolumes, self).__init__(**parameters)
 
         self.active = active
         self.buffer_size = buffer_size
+        self.buffer_mode = buffer_mode
         self.array = None
         self.times = None
 
@@ -988,8 +1811,10 @@ class AggregateTimestampedVolumes(PreprocessingStep):
 
         if self.array is None:
             n_samples = array.size
-            self.times = buffered_array.BufferedArray(size=1, buffer_size=self.buffer_size)
-            self.array = buffered_array.BufferedArray(size=n_samples, buffer_size=self.buffer_size)
+            self.times = buffered_array.BufferedArray(size=1, buffer_size=self.buffer_size,
+                                                      mode=self.buffer_mode)
+            self.array = buffered_array.BufferedArray(size=n_samples, buffer_size=self.buffer_size,
+                                                      mode=self.buffer_mode)
             self.n_samples = n_samples
 
         if self.active:
@@ -1005,10 +1830,113 @@ class AggregateTimestampedVolumes(PreprocessingStep):
         return times, array
 
     def reset(self):
+        if self.array is not None:
+            self.array.close()
+            self.times.close()
         self.array = None
         self.times = None
 
 
+class DelayFeatures(PreprocessingStep):
+    """Build time-delayed features from incoming activity
+
+    The delayed features are the activity vectors from ``delays[0]``, ``delays[1]``, ...
+    volumes ago, concatenated in that order, as expected by decoders trained on delayed
+    features (see ``utils.VoxelScoreSelectKBest``). Volumes from before the first one are zeros.
+
+    The last ``max(delays) + 1`` activity vectors are kept in a ring in which every vector is
+    written twice and the newest vector comes first, so the window of recent activity is always a
+    contiguous block of memory. For consecutive delays, the concatenated vector is returned as a
+    view of that block without copying. With ``selected_indices``, only the selected delayed
+    features are gathered from the ring.
+
+    Parameters
+    ----------
+    delays : list of int
+        Number of volumes by which each block of features is delayed
+    selected_indices : list of int, str, or None
+        Indices into the concatenated delayed features to return, e.g., the
+        ``selected_indices_`` of a fitted ``utils.VoxelScoreSelectKBest``. A str is the filename
+        of a ``.npy`` file in the subject directory of ``surface``. None returns all features.
+    surface : str or None
+        subject/surface ID, used to find the ``selected_indices`` file
+    copy : bool
+        Return a copy instead of a view into the ring. The view is overwritten by the next
+        volume, so set this if a step in a later stage of a staged pipeline uses the output.
+    dtype : str
+        Data type of the features
+
+    Attributes
+    ----------
+    ring : numpy.ndarray
+        (2 * n_rows, n_voxels) ring buffer of recent activity
+    n_appended : int
+        Number of volumes received
+
+    Methods
+    -------
+    run(activity)
+        Returns the delayed features
+    """
+    def __init__(self, *args, delays=(0, 1, 2), selected_indices=None, surface=None,
+                 copy=False, dtype=DEFAULT_DTYPE, **kwargs):
+        parameters = {'delays': delays, 'selected_indices': selected_indices, 'copy': copy,
+                      'dtype': dtype}
+        parameters.update(kwargs)
+        super(DelayFeatures, self).__init__(**parameters)
+
+        if isinstance(selected_indices, str):
+            selected_indices = np.load(op.join(config.get_subject_directory(surface),
+                                               selected_indices))
+
+        delays = np.asarray(delays, dtype=int)
+        if np.any(delays < 0):
+            raise ValueError('Delays must be non-negative')
+
+        self.delays = delays
+        self.n_rows = int(delays.max()) + 1
+        self.selected_indices = selected_indices
+        self.copy = copy
+        self.dtype = dtype
+
+        # consecutive delays are a contiguous block of rows of the ring
+        self.contiguous = bool(np.all(np.diff(delays) == 1))
+        self.ring = None
+        self.n_appended = 0
+
+    def _setup(self, n_voxels):
+        self.ring = np.zeros((2 * self.n_rows, n_voxels), dtype=self.dtype)
+        if self.selected_indices is not None:
+            selected_indices = np.asarray(self.selected_indices, dtype=int)
+            delay_index, self.selected_voxels = np.divmod(selected_indices, n_voxels)
+            self.selected_rows = self.delays[delay_index]
+
+    def run(self, activity):
+        activity = activity.ravel()
+        if self.ring is None:
+            self._setup(activity.size)
+
+        # newest first: each volume goes one row before the previous one
+        start = -(self.n_appended + 1) % self.n_rows
+        self.ring[start] = activity
+        self.ring[start + self.n_rows] = activity
+        self.n_appended += 1
+
+        if self.selected_indices is not None:
+            return self.ring[start + self.selected_rows, self.selected_voxels]
+
+        if self.contiguous:
+            first = start + self.delays[0]
+            features = self.ring[first:first + len(self.delays)].reshape(-1)
+            return features.copy() if self.copy else features
+
+        return self.ring[start + self.delays].reshape(-1)
+
+    def reset(self):
+        self.ring = None
+        self.n_appended = 0
+
+
 class SklearnPredictor(PreprocessingStep):
     """Run the `.predict` method of a scikit-learn predictor on incoming
     activity. Returns the predicted output.
@@ -1018,7 +1946,8 @@ class SklearnPredictor(PreprocessingStep):
     surface : str
         subject/surface ID
     pickled_predictor : str
-        filename of the pickle file containing the trained classifier
+        filename of the pickle file containing the trained classifier, or
+        of a model converted with ``decoding.convert_pickle``
 
     Attributes
     ----------
@@ -1037,7 +1966,7 @@ class SklearnPredictor(PreprocessingStep):
         super(SklearnPredictor, self).__init__(**parameters)
         subj_dir = config.get_subject_directory(surface)
         pickled_path = op.join(subj_dir, pickled_predictor)
-        self.predictor = pickle.load(open(pickled_path, 'rb'))
+        self.predictor = decoding.load_predictor(pickled_path)
         self.nan_to_num = nan_to_num
 
     def run(self, activity):
@@ -1069,17 +1998,23 @@ class SklearnMultiplePredictorsTopK(PreprocessingStep):
     of each one of them on incoming activity. Returns a list with the
     predicted output.
 
+    Logistic regression and linear discriminant analysis predictors are
+    ranked together with one matrix-vector product, see
+    ``decoding.LinearDecoderStack``.
+
     Parameters
     ----------
     surface : str
         subject/surface ID
     pickled_predictors : list of str
-        filenames of the pickle files containing the trained classifiers
+        filenames of the pickle files containing the trained classifiers, or
+        of models converted with ``decoding.convert_pickle``
     k: int
 
     Attributes
     ----------
     predictors : list of sklearn fitted learner
+    decoder : decoding.LinearDecoderStack
 
     Methods
     -------
@@ -1102,22 +2037,18 @@ class SklearnMultiplePredictorsTopK(PreprocessingStep):
             pickled_predictors = [pickled_predictors]
         pickled_paths = [op.join(subj_dir, pp) for pp in pickled_predictors]
         self.predictors = [
-            pickle.load(open(pp, 'rb')) for pp in pickled_paths
+            decoding.load_predictor(pp) for pp in pickled_paths
         ]
+        self.decoder = decoding.LinearDecoderStack(self.predictors, top_k=True)
         self.nan_to_num = nan_to_num
         self.k = k
 
     def run(self, activity):
-        activity = activity.ravel()[None]
+        activity = activity.ravel()
         if self.nan_to_num:
             activity = np.nan_to_num(activity)
 
-        predictions = []
-        for estimator in self.predictors:
-            log_prob = estimator.predict_log_proba(activity)
-            classes = estimator.classes_
-            topklogprob = log_prob.argsort(axis=1)[:, ::-1][:, :self.k]
-            predictions.append(classes[topklogprob][0].tolist())
+        predictions = [top.tolist() for top in self.decoder.top_k(activity, self.k)]
         return {'pred': predictions}
 
 
@@ -1126,16 +2057,25 @@ class SklearnMultiplePredictors(PreprocessingStep):
     of each one of them on incoming activity. Returns a list with the
     predicted output.
 
+    Linear predictors are evaluated together with one matrix-vector
+    product, see ``decoding.LinearDecoderStack``. Only the remaining
+    predictors are run through scikit-learn.
+
     Parameters
     ----------
     surface : str
         subject/surface ID
     pickled_predictors : list of str
-        filenames of the pickle files containing the trained classifiers
+        filenames of the pickle files containing the trained classifiers, or
+        of models converted with ``decoding.convert_pickle``
+    n_workers : int or None
+        Number of threads over which to run the predictors that are not linear. 1 runs
+        serially, None uses all cores.
 
     Attributes
     ----------
     predictors : list of sklearn fitted learner
+    decoder : decoding.LinearDecoderStack
 
     Methods
     -------
@@ -1143,12 +2083,13 @@ class SklearnMultiplePredictors(PreprocessingStep):
         Returns the prediction
     """
 
-    def __init__(self, surface, pickled_predictors, *args, nan_to_num=True,
+    def __init__(self, surface, pickled_predictors, *args, nan_to_num=True, n_workers=1,
                  **kwargs):
         parameters = {
             'surface': surface,
             'pickled_predictors': pickled_predictors,
-            'nan_to_num': nan_to_num
+            'nan_to_num': nan_to_num,
+            'n_workers': n_workers
         }
         parameters.update(kwargs)
         super(SklearnMultiplePredictors, self).__init__(**parameters)
@@ -1157,18 +2098,21 @@ class SklearnMultiplePredictors(PreprocessingStep):
             pickled_predictors = [pickled_predictors]
         pickled_paths = [op.join(subj_dir, pp) for pp in pickled_predictors]
         self.predictors = [
-            pickle.load(open(pp, 'rb')) for pp in pickled_paths
+            decoding.load_predictor(pp) for pp in pickled_paths
         ]
+        self.decoder = decoding.LinearDecoderStack(self.predictors)
         self.nan_to_num = nan_to_num
+        self.sharder = _sharder_for(n_workers)
 
     def run(self, activity):
-        activity = activity.ravel()[None]
+        activity = activity.ravel()
         if self.nan_to_num:
             activity = np.nan_to_num(activity)
 
-        predictions = [
-            predictor.predict(activity)[0] for predictor in self.predictors
-        ]
+        if self.sharder is None:
+            predictions = self.decoder.predict(activity)
+        else:
+            predictions = self.decoder.predict(activity, map_function=self.sharder.pool.map)
         return {'pred': predictions}
 
 
@@ -1180,15 +2124,22 @@ class SendToDashboard(PreprocessingStep):
     name : str
     plot_type : str
         Type of plot
+    encoding : str
+        ``codec`` encoding of float arrays, ``raw``, ``float16``, or ``quantized``
+    compression : str or None
+        ``codec`` compression, None or ``zlib``
 
     Attributes
     ----------
     redis : redis connection
     key_name : str
         Name of the key in the redis database
+    index : int
+        Sequence number of the next sample
     """
-    def __init__(self, name, plot_type='marker', **kwargs):
-        parameters = {'name': name, 'plot_type': plot_type}
+    def __init__(self, name, plot_type='marker', encoding='raw', compression=None, **kwargs):
+        parameters = {'name': name, 'plot_type': plot_type, 'encoding': encoding,
+                      'compression': compression}
         parameters.update(kwargs)
         super(SendToDashboard, self).__init__(**parameters)
         key_name = 'dashboard:data:' + name
@@ -1198,9 +2149,14 @@ class SendToDashboard(PreprocessingStep):
 
         self.redis = r
         self.key_name = key_name
+        self.encoding = encoding
+        self.compression = compression
+        self.index = 0
 
     def run(self, *args):
-        data = pickle.dumps(args)
+        data = codec.encode(args, time=time.time(), sequence=self.index, encoding=self.encoding,
+                            compression=self.compression)
+        self.index += 1
         logger.debug('SendToDashboard key_name=%s len(data)=%d', self.key_name, len(data))
         self.redis.set(self.key_name, data)
         self.redis.set(self.key_name + ':update', b'true')
@@ -1212,18 +2168,27 @@ class SendToPycortexViewer(PreprocessingStep):
     Parameters
     ----------
     name : str
+    encoding : str
+        ``codec`` encoding of float arrays, ``raw``, ``float16``, or ``quantized``
+    compression : str or None
+        ``codec`` compression, None or ``zlib``
 
     Attributes
     ----------
     redis : redis connection
     """
-    def __init__(self, name, *args, **kwargs):
-        parameters = {'name': name}
+    def __init__(self, name, *args, encoding='raw', compression=None, **kwargs):
+        parameters = {'name': name, 'encoding': encoding, 'compression': compression}
         parameters.update(kwargs)
         super(SendToPycortexViewer, self).__init__(**parameters)
+        self.encoding = encoding
+        self.compression = compression
+        self.index = 0
 
     def run(self, data):
-        r.publish("viewer", pickle.dumps(data))
+        r.publish("viewer", codec.encode(data, time=time.time(), sequence=self.index,
+                                         encoding=self.encoding, compression=self.compression))
+        self.index += 1
 
 
 class StoreToRedis(PreprocessingStep):
@@ -1235,6 +2200,10 @@ class StoreToRedis(PreprocessingStep):
         Prefix to redis key. Individual samples will be stored to the database with keys that
         append the current trial index and sample index to this prefix,
         e.g., responses:trial0000:0000
+    encoding : str
+        ``codec`` encoding of float arrays, ``raw``, ``float16``, or ``quantized``
+    compression : str or None
+        ``codec`` compression, None or ``zlib``
 
     Attributes
     ----------
@@ -1242,13 +2211,17 @@ class StoreToRedis(PreprocessingStep):
         Incrementing index
     active : bool
     """
-    def __init__(self, key_prefix, *args, active=True, **kwargs):
-        parameters = {'key_prefix': key_prefix, 'active': active}
+    def __init__(self, key_prefix, *args, active=True, encoding='raw', compression=None,
+                 **kwargs):
+        parameters = {'key_prefix': key_prefix, 'active': active, 'encoding': encoding,
+                      'compression': compression}
         parameters.update(kwargs)
         super(StoreToRedis, self).__init__(**parameters)
         self.key_prefix = key_prefix
         self.index = 0
         self.active = active
+        self.encoding = encoding
+        self.compression = compression
 
     def update_state(self):
         super(StoreToRedis, self).update_state()
@@ -1273,7 +2246,8 @@ class StoreToRedis(PreprocessingStep):
 
         if self.active:
             key = f'{self.key}:{self.index:04}'
-            r.set(key, pickle.dumps(args))
+            r.set(key, codec.encode(args, time=time.time(), sequence=self.index,
+                                    encoding=self.encoding, compression=self.compression))
             self.index += 1
 
             return key
@@ -1289,15 +2263,25 @@ class PublishToRedis(PreprocessingStep):
     Parameters
     ----------
     topic : str
+    encoding : str
+        ``codec`` encoding of float arrays, ``raw``, ``float16``, or ``quantized``
+    compression : str or None
+        ``codec`` compression, None or ``zlib``
     """
-    def __init__(self, topic, *args, **kwargs):
-        parameters = {'topic': topic}
+    def __init__(self, topic, *args, encoding='raw', compression=None, **kwargs):
+        parameters = {'topic': topic, 'encoding': encoding, 'compression': compression}
         parameters.update(kwargs)
         super(PublishToRedis, self).__init__(**parameters)
         self.topic = topic
+        self.encoding = encoding
+        self.compression = compression
+        self.index = 0
 
     def run(self, data):
-        r.publish(self.topic, pickle.dumps(data))
+        r.publish(self.topic, codec.encode(data, time=time.time(), sequence=self.index,
+                                           encoding=self.encoding,
+                                           compression=self.compression))
+        self.index += 1
 
 
 class PushToRedis(PreprocessingStep):
@@ -1306,15 +2290,24 @@ class PushToRedis(PreprocessingStep):
     Parameters
     ----------
     key : str
+    encoding : str
+        ``codec`` encoding of float arrays, ``raw``, ``float16``, or ``quantized``
+    compression : str or None
+        ``codec`` compression, None or ``zlib``
     """
-    def __init__(self, key, *args, **kwargs):
-        parameters = {'key': key}
+    def __init__(self, key, *args, encoding='raw', compression=None, **kwargs):
+        parameters = {'key': key, 'encoding': encoding, 'compression': compression}
         parameters.update(kwargs)
         super(PushToRedis, self).__init__(**parameters)
         self.key = key
+        self.encoding = encoding
+        self.compression = compression
+        self.index = 0
 
     def run(self, data):
-        r.lpush(self.key, pickle.dumps(data))
+        r.lpush(self.key, codec.encode(data, time=time.time(), sequence=self.index,
+                                       encoding=self.encoding, compression=self.compression))
+        self.index += 1
 
 
 class Dictionary(PreprocessingStep):
@@ -1340,9 +2333,6 @@ class Dictionary(PreprocessingStep):
         return value
 
 
-import requests
-import json
-
 class SklearnPredictorToAWS(PreprocessingStep):                                                
     """Run the `.predict` method of a scikit-learn predictor on incoming                       
     activity. Returns the predicted output.                                                    
@@ -1353,6 +2343,10 @@ class SklearnPredictorToAWS(PreprocessingStep):
         subject/surface ID                                                                     
     pickled_predictor : str                                                                    
         filename of the pickle file containing the trained classifier                          
+    aws_address : str
+        address to http POST the predictions to
+    coalesce : bool
+        if posting falls behind, only send the newest predictions
                                                                                                
     Attributes                                                                                 
     ----------                                                                                 
@@ -1364,19 +2358,23 @@ class SklearnPredictorToAWS(PreprocessingStep):
         Returns the prediction                                                                 
     """                                                                                        
                                                                                                
-    def __init__(self, surface,  pickled_predictors, aws_address, nan_to_num=True, **kwargs):  
+    def __init__(self, surface,  pickled_predictors, aws_address, nan_to_num=True,
+                 coalesce=True, **kwargs):
         parameters = {'surface': surface, 'pickled_predictors':                                
                       pickled_predictors,                                                      
-                      'nan_to_num': nan_to_num, 'aws_address': aws_address}                    
+                      'nan_to_num': nan_to_num, 'aws_address': aws_address,
+                      'coalesce': coalesce}
         parameters.update(kwargs)                                                              
         super(SklearnPredictorToAWS, self).__init__(**parameters)                              
         subj_dir = config.get_subject_directory(surface)                                       
         pickled_paths = {name: op.join(subj_dir, pickled_predictor) for                        
                          name, pickled_predictor in pickled_predictors.items()}                
-        self.predictors = {name: pickle.load(open(pickled_path, 'rb')) for                     
+        self.predictors = {name: decoding.load_predictor(pickled_path) for
                            name, pickled_path in pickled_paths.items()}                        
         self.nan_to_num = nan_to_num                                                           
         self.aws_address = aws_address                                                         
+        self.coalesce = coalesce
+        self.delivery = delivery.get_delivery()
                                                                                                
     def run(self, activity, experiment_info):                                                                   
         activity = activity.ravel()[None]                                                      
@@ -1400,14 +2398,9 @@ class SklearnPredictorToAWS(PreprocessingStep):
         if experiment_info is not None:
             data['cue'] = experiment_info['cur_cue']
 
-        requests.post(self.aws_address, data=data)                      
+        self.delivery.post(self.aws_address, data=data, coalesce=self.coalesce)
                                                                                                
 
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-import io
-
 class UploadFlatmap(PreprocessingStep):
     """Computes a flatmap and pushes it to an http address
 
@@ -1423,14 +2416,28 @@ class UploadFlatmap(PreprocessingStep):
         height in pixels of the flatmap
 
     address: str
-        location to http POST the flatmap to under key 'flatmap'
+        location to http POST the flatmap to under key 'flatmap.png' (or 'flatmap.webp')
+
+    mask_type: str, default None
+        if given, activity holds the voxels of this pycortex mask instead of a whole volume
 
+    image_format: str, default 'PNG'
+        'PNG' or 'WebP'
+
+    coalesce: bool, default True
+        if posting falls behind, only send the newest flatmap
+
+    The flatmap is rendered by a ``flatmap.FlatmapRenderer``, which projects the voxels onto the
+    flatmap pixels with a precomputed sparse matrix, and posted by the process-wide
+    ``delivery.HTTPDelivery``, so the step does not wait for the upload.
     """
 
     def __init__(self, surface, transform, address, height=1024, vmin=None,
-                 vmax=None, cmap=None, **kwargs):
+                 vmax=None, cmap=None, mask_type=None, image_format='PNG', coalesce=True,
+                 **kwargs):
         parameters = dict(surface=surface, transform=transform,
-                          address=address, height=height)
+                          address=address, height=height, mask_type=mask_type,
+                          image_format=image_format, coalesce=coalesce)
         parameters = {**kwargs, **parameters}
         super(UploadFlatmap, self).__init__(**parameters)
 
@@ -1441,22 +2448,16 @@ class UploadFlatmap(PreprocessingStep):
         self.vmin = vmin
         self.vmax = vmax
         self.cmap = cmap
+        self.coalesce = coalesce
+        self.key = 'flatmap.' + image_format.lower()
+        self.renderer = flatmap.FlatmapRenderer(surface, transform, height=height, vmin=vmin,
+                                                vmax=vmax, cmap=cmap, mask_type=mask_type,
+                                                image_format=image_format)
+        self.delivery = delivery.get_delivery()
 
     def run(self, activity):
-        
-        volume = cortex.Volume(activity, self.surface, self.transform,
-                              cmap=self.cmap, vmin=self.vmin, vmax=self.vmax)
-
-        buf = io.BytesIO()
-
-        fig = cortex.quickflat.make_figure(volume, height=self.height)
-
-        plt.savefig(buf, format="PNG")
-
-        buf.seek(0)
-        content = buf.read()
-
-        requests.post(self.address, data={"flatmap.png": content})
+        content = self.renderer.encode(activity)
+        self.delivery.post(self.address, data={self.key: content}, coalesce=self.coalesce)
 
 
 class SimulateDecodingProba(PreprocessingStep):
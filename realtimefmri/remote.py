@@ -0,0 +1,190 @@
+"""Run expensive preprocessing steps on remote workers
+
+A step is marked remote by setting ``remote: true`` on it in the pipeline configuration. The
+preprocessing process then ships the inputs of that step to a worker through redis and waits for
+the result until ``deadline`` seconds have passed. If no worker answers in time, the step is run
+locally instead, so a slow or missing worker never stalls the pipeline. Workers are started with
+``realtimefmri worker <pipeline>`` on any host that can reach the redis server and has the same
+pycortex database. Several workers serving the same step share its queue.
+
+Jobs and results are encoded with ``codec``, so arrays are sent and received without being
+pickled, and nothing read from redis is unpickled. Arrays decoded from a message are read-only
+views of the received bytes. Inputs and outputs of remote steps must therefore be values that
+``codec.encode`` supports.
+
+Remote execution suits steps without state between volumes, such as motion correction and
+decoders. Steps that keep state, e.g. detrending, keep it on the worker, and a local fallback
+updates only the local copy of that state. Resetting a remote step increments its generation in
+redis, and every worker resets its copy of the step before it runs the first job of a newer
+generation.
+"""
+import time
+from uuid import uuid4
+
+import redis
+
+from realtimefmri import codec, config
+from realtimefmri.utils import get_logger
+
+logger = get_logger('realtimefmri.remote', to_console=True, to_network=False, to_file=True)
+r = redis.StrictRedis(config.REDIS_HOST)
+
+# seconds to wait for a remote result before running the step locally
+DEFAULT_DEADLINE = 1.
+# seconds that unclaimed jobs and results are kept in redis
+EXPIRE = 60
+
+QUEUE_PREFIX = 'remote:queue:'
+JOB_PREFIX = 'remote:job:'
+RESULT_PREFIX = 'remote:result:'
+GENERATION_PREFIX = 'remote:generation:'
+
+
+def _get_generation(name):
+    """Number of times the step ``name`` has been reset"""
+    generation = r.get(GENERATION_PREFIX + name)
+    return 0 if generation is None else int(generation)
+
+
+def _push_job(job_key, message, queue_key):
+    """Atomically store a job under ``job_key`` and push ``job_key`` onto a queue"""
+    pipe = r.pipeline()
+    pipe.set(job_key, message, ex=EXPIRE)
+    pipe.rpush(queue_key, job_key)
+    pipe.execute()
+
+
+def _pop_job(job_key):
+    """Read and delete a job. Returns None if it expired"""
+    pipe = r.pipeline()
+    pipe.get(job_key)
+    pipe.delete(job_key)
+    message, _ = pipe.execute()
+    return message
+
+
+def _push_result(result_key, message):
+    """Store a result for the waiting step, expiring it if nobody picks it up"""
+    pipe = r.pipeline()
+    pipe.rpush(result_key, message)
+    pipe.expire(result_key, EXPIRE)
+    pipe.execute()
+
+
+class RemoteStep():
+    """Run a preprocessing step on a remote worker with a local fallback
+
+    Parameters
+    ----------
+    name : str
+        Name of the step in the pipeline. Workers serve steps by name.
+    step : PreprocessingStep
+        Local instance of the step, used when no result arrives before the deadline
+    deadline : float
+        Seconds to wait for a remote result
+
+    Attributes
+    ----------
+    n_remote : int
+        Number of volumes processed remotely
+    n_local : int
+        Number of volumes processed locally because the deadline was missed
+    generation : int
+        Number of times the step has been reset. Workers reset their copy of the step when they
+        receive a job of a newer generation
+    """
+    def __init__(self, name, step, deadline=DEFAULT_DEADLINE):
+        self.name = name
+        self.step = step
+        self.deadline = deadline
+        self.queue_key = QUEUE_PREFIX + name
+        self.generation = _get_generation(name)
+        self.n_remote = 0
+        self.n_local = 0
+
+    def __getattr__(self, name):
+        if name == 'step':
+            raise AttributeError(name)
+        return getattr(self.step, name)
+
+    def _submit(self, args):
+        job_id = uuid4().hex
+        result_key = RESULT_PREFIX + job_id
+        message = codec.encode({'args': list(args), 'result_key': result_key,
+                                'generation': self.generation,
+                                'deadline': time.time() + self.deadline})
+        _push_job(JOB_PREFIX + job_id, message, self.queue_key)
+        return result_key
+
+    def run(self, *args):
+        result_key = self._submit(args)
+
+        reply = r.blpop([result_key], timeout=self.deadline)
+        if reply is not None:
+            result = codec.decode(reply[1], allow_pickle=False)
+            if 'error' not in result:
+                self.n_remote += 1
+                return result['value']
+
+            logger.warning('Remote step %s failed: %s', self.name, result['error'])
+
+        else:
+            logger.warning('Remote step %s missed its %.2f s deadline, running locally',
+                           self.name, self.deadline)
+
+        self.n_local += 1
+        return self.step.run(*args)
+
+    def reset(self):
+        """Reset the local step and, through the generation in redis, the steps of all
+        workers"""
+        self.step.reset()
+        self.generation = r.incr(GENERATION_PREFIX + self.name)
+
+
+def serve(steps, timeout=1, stop=None):
+    """Serve jobs for preprocessing steps until interrupted
+
+    Parameters
+    ----------
+    steps : dict
+        Maps step names to local step instances
+    timeout : float
+        Seconds to wait for a job before polling again
+    stop : threading.Event or None
+        Stop serving when set
+    """
+    queue_keys = {QUEUE_PREFIX + name: name for name in steps.keys()}
+    generations = {name: _get_generation(name) for name in steps.keys()}
+    logger.info('Serving remote steps %s', ', '.join(steps.keys()))
+
+    while stop is None or not stop.is_set():
+        reply = r.blpop(list(queue_keys.keys()), timeout=timeout)
+        if reply is None:
+            continue
+
+        queue_key, job_key = reply
+        name = queue_keys[queue_key.decode('utf-8')]
+        step = steps[name]
+        message = _pop_job(job_key)
+        if message is None:
+            logger.warning('Job %s expired before it was picked up', job_key)
+            continue
+
+        job = codec.decode(message, allow_pickle=False)
+        if job['generation'] > generations[name]:
+            logger.info('Resetting remote step %s', name)
+            step.reset()
+            generations[name] = job['generation']
+
+        if time.time() > job['deadline']:
+            logger.info('Skipping job %s past its deadline', job_key)
+            continue
+
+        try:
+            result = codec.encode({'value': step.run(*job['args'])})
+        except Exception as e:
+            logger.exception('Remote step failed')
+            result = codec.encode({'error': repr(e)})
+
+        _push_result(job['result_key'], result)
@@ -0,0 +1,193 @@
+"""Ridge regression fit from running sufficient statistics
+
+``IncrementalRidge`` accumulates ``X.T @ X``, ``X.T @ Y`` and the sums needed for centering as
+samples arrive, so fitting does not need to reload the data. A single eigendecomposition of
+``X.T @ X`` gives the solutions for all regularization strengths, and the generalized
+cross-validation error of each of them, so the best alpha can be chosen for each target at
+little extra cost. Targets are processed in chunks to bound memory use.
+"""
+import numpy as np
+from scipy import linalg as la
+
+from realtimefmri.utils import get_logger
+
+logger = get_logger('realtimefmri.ridge', to_console=True, to_network=False, to_file=True)
+
+
+class IncrementalRidge():
+    """Ridge regression with one regularization strength per target, chosen by generalized
+    cross-validation
+
+    Parameters
+    ----------
+    alphas : list of float
+        Regularization strengths to choose from
+    fit_intercept : bool
+    chunk_size : int
+        Number of targets solved at a time
+
+    Attributes
+    ----------
+    n_samples : int
+    xtx : numpy.ndarray
+        (n_features, n_features) sum of ``x x^T`` over samples
+    xty : numpy.ndarray
+        (n_features, n_targets) sum of ``x y^T`` over samples
+    sum_x, sum_y, sum_sq_y : numpy.ndarray
+        Sums of features, targets, and squared targets
+    coef_ : numpy.ndarray
+        (n_targets, n_features) weights after ``fit``
+    intercept_ : numpy.ndarray
+        (n_targets,) intercepts after ``fit``
+    alpha_ : numpy.ndarray
+        (n_targets,) regularization strength chosen for each target
+    gcv_ : numpy.ndarray
+        (n_alphas, n_targets) generalized cross-validation error of each alpha
+
+    Methods
+    -------
+    partial_fit(X, Y)
+        Add samples to the sufficient statistics
+    fit()
+        Solve for all alphas and keep the best one for each target
+    predict(X)
+    get_state()
+        The parameters, statistics, and solution as a dict of arrays
+    from_state(state)
+        Create a model from ``get_state``
+    """
+    STATISTICS = ('xtx', 'xty', 'sum_x', 'sum_y', 'sum_sq_y')
+    SOLUTION = ('coef_', 'intercept_', 'alpha_', 'gcv_')
+
+    def __init__(self, alphas=(1., 10., 100., 1000., 10000.), fit_intercept=True,
+                 chunk_size=10000):
+        self.alphas = np.asarray(alphas, dtype='float64')
+        self.fit_intercept = fit_intercept
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self):
+        self.n_samples = 0
+        self.xtx = None
+        self.xty = None
+        self.sum_x = None
+        self.sum_y = None
+        self.sum_sq_y = None
+
+    def partial_fit(self, X, Y):
+        """Add samples to the sufficient statistics
+
+        Parameters
+        ----------
+        X : numpy.ndarray
+            (n_samples, n_features) or a single sample (n_features,)
+        Y : numpy.ndarray
+            (n_samples, n_targets) or a single sample (n_targets,)
+        """
+        X = np.atleast_2d(np.asarray(X, dtype='float64'))
+        Y = np.atleast_2d(np.asarray(Y, dtype='float64'))
+        if X.shape[0] != Y.shape[0]:
+            raise ValueError(f'X has {X.shape[0]} samples but Y has {Y.shape[0]}')
+
+        if self.xtx is None:
+            n_features, n_targets = X.shape[1], Y.shape[1]
+            self.xtx = np.zeros((n_features, n_features))
+            self.xty = np.zeros((n_features, n_targets))
+            self.sum_x = np.zeros(n_features)
+            self.sum_y = np.zeros(n_targets)
+            self.sum_sq_y = np.zeros(n_targets)
+
+        self.xtx += X.T.dot(X)
+        self.xty += X.T.dot(Y)
+        self.sum_x += X.sum(0)
+        self.sum_y += Y.sum(0)
+        self.sum_sq_y += (Y ** 2).sum(0)
+        self.n_samples += X.shape[0]
+        return self
+
+    def _centered_statistics(self):
+        if not self.fit_intercept:
+            return self.xtx, self.xty, self.sum_sq_y
+
+        mean_x = self.sum_x / self.n_samples
+        mean_y = self.sum_y / self.n_samples
+        xtx = self.xtx - self.n_samples * np.outer(mean_x, mean_x)
+        xty = self.xty - self.n_samples * np.outer(mean_x, mean_y)
+        yty = self.sum_sq_y - self.n_samples * mean_y ** 2
+        return xtx, xty, yty
+
+    def fit(self):
+        """Solve for all alphas and keep the one with the lowest generalized cross-validation
+        error for each target
+
+        Returns
+        -------
+        self
+        """
+        if self.n_samples == 0:
+            raise ValueError('No samples to fit')
+
+        xtx, xty, yty = self._centered_statistics()
+        eigenvalues, eigenvectors = la.eigh(xtx)
+        eigenvalues = np.clip(eigenvalues, 0, None)
+
+        # (n_alphas, n_features) shrinkage of each eigendirection for each alpha
+        shrinkage = 1. / (eigenvalues[None] + self.alphas[:, None])
+        # residual sum of squares is yty - sum_i q_i^2 (lambda_i + 2 alpha) / (lambda_i + alpha)^2
+        rss_factor = (eigenvalues[None] + 2 * self.alphas[:, None]) * shrinkage ** 2
+        # effective number of parameters
+        df = (eigenvalues[None] * shrinkage).sum(1) + self.fit_intercept
+
+        n_targets = xty.shape[1]
+        self.coef_ = np.empty((n_targets, xtx.shape[0]), dtype='float64')
+        self.gcv_ = np.empty((len(self.alphas), n_targets), dtype='float64')
+        self.alpha_ = np.empty(n_targets, dtype='float64')
+        for start in range(0, n_targets, self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            projection = eigenvectors.T.dot(xty[:, chunk])
+            rss = yty[chunk][None] - rss_factor.dot(projection ** 2)
+            gcv = self.n_samples * np.clip(rss, 0, None) / (self.n_samples - df[:, None]) ** 2
+            best = gcv.argmin(0)
+
+            self.gcv_[:, chunk] = gcv
+            self.alpha_[chunk] = self.alphas[best]
+            self.coef_[chunk] = eigenvectors.dot(projection * shrinkage[best].T).T
+
+        if self.fit_intercept:
+            self.intercept_ = (self.sum_y - self.coef_.dot(self.sum_x)) / self.n_samples
+        else:
+            self.intercept_ = np.zeros(n_targets)
+
+        logger.info('Fit ridge on %d samples, %d features, %d targets', self.n_samples,
+                    xtx.shape[0], n_targets)
+        return self
+
+    def predict(self, X):
+        return np.asarray(X).dot(self.coef_.T) + self.intercept_
+
+    def get_state(self):
+        """The parameters, sufficient statistics, and solution, e.g., to store them with
+        ``codec.encode``
+
+        Returns
+        -------
+        A dict of arrays and scalars
+        """
+        state = {'alphas': self.alphas, 'fit_intercept': self.fit_intercept,
+                 'chunk_size': self.chunk_size, 'n_samples': self.n_samples}
+        for name in self.STATISTICS + self.SOLUTION:
+            if getattr(self, name, None) is not None:
+                state[name] = getattr(self, name)
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """Create a model from the dict returned by ``get_state``"""
+        model = cls(alphas=state['alphas'], fit_intercept=state['fit_intercept'],
+                    chunk_size=state['chunk_size'])
+        model.n_samples = state['n_samples']
+        for name in cls.STATISTICS + cls.SOLUTION:
+            if name in state:
+                # decoded arrays are read-only views, and the statistics are updated in place
+                setattr(model, name, np.array(state[name], dtype='float64'))
+        return model
@@ -0,0 +1,206 @@
+"""Run TTL collection, volume collection, and preprocessing in a single process
+
+The ``collect_ttl``, ``collect``, and ``preprocess`` processes exchange every TTL pulse and volume
+through redis. When they always run together on one machine, ``run`` replaces them with asyncio
+tasks that are connected by in-memory queues:
+
+- the TTL task records the time of each pulse
+- the collection task polls the scanner directory for new dicom files, pairs each one with the
+  oldest unused TTL time, and converts it to nifti
+- the preprocessing task runs each volume through the pipeline
+
+All blocking work (reading the TTL source, polling and converting files, running the pipeline)
+happens in executor threads, so converting the next volume overlaps with preprocessing the
+current one. The pipeline always runs in the same thread, so steps see volumes in order.
+"""
+import asyncio
+import os.path as op
+import time
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import redis
+import yaml
+
+from realtimefmri import codec, config, delivery, image_utils, preprocess
+from realtimefmri.collect_ttl import CollectTTL
+from realtimefmri.utils import get_logger
+
+logger = get_logger('realtimefmri.runtime', to_console=True, to_network=False, to_file=True)
+r = redis.StrictRedis(config.REDIS_HOST)
+
+
+class DirectoryMonitor():
+    """Poll a directory for new files
+
+    A file is only reported once its size is the same in two consecutive polls, so that files
+    that are still being written are not read.
+
+    Parameters
+    ----------
+    directory : str
+    file_glob : str
+        Pattern of the files to report, relative to ``directory``
+
+    Methods
+    -------
+    poll()
+        Return the paths of new, complete files ordered by modification time
+    """
+    def __init__(self, directory, file_glob='*/*.dcm'):
+        self.directory = directory
+        self.file_glob = file_glob
+        self.contents = set(glob(op.join(directory, file_glob)))
+        self.pending = {}
+
+    def poll(self):
+        current_files = set(glob(op.join(self.directory, self.file_glob)))
+        self.contents.intersection_update(current_files)
+
+        new_files = []
+        for path in current_files - self.contents:
+            try:
+                size = op.getsize(path)
+            except FileNotFoundError:
+                continue
+
+            if self.pending.get(path) == size:
+                del self.pending[path]
+                self.contents.add(path)
+                new_files.append(path)
+            else:
+                self.pending[path] = size
+
+        return sorted(new_files, key=op.getmtime)
+
+
+async def collect_ttl(collector, timestamps, executor):
+    """Put the time of each TTL pulse in the ``timestamps`` queue"""
+    loop = asyncio.get_running_loop()
+    pulses = collector.collect_ttl()
+    while True:
+        t = await loop.run_in_executor(executor, next, pulses, None)
+        if t is None:
+            break
+
+        logger.info('Received TTL at time %s', str(t))
+        timestamps.put_nowait(t)
+
+
+async def collect(monitor, timestamps, volumes, executor, interval=0.1):
+    """Pair new volumes with TTL times, convert them to nifti, and put them in ``volumes``"""
+    loop = asyncio.get_running_loop()
+    image_number = 0
+    while True:
+        new_paths = await loop.run_in_executor(executor, monitor.poll)
+        for path in new_paths:
+            logger.info('New volume %s', path)
+            timestamp_internal = time.time()
+            try:
+                timestamp = timestamps.get_nowait()
+            except asyncio.QueueEmpty:
+                logger.warning('No TTL pulse for %s, using the time it was detected', path)
+                timestamp = timestamp_internal
+
+            nii = await loop.run_in_executor(executor, image_utils.dicom_to_nifti, path)
+            await volumes.put({'image_number': image_number, 'time': timestamp, 'volume': nii})
+
+            r.set('image_number', codec.encode(image_number))
+            image_number += 1
+
+        await asyncio.sleep(interval)
+
+
+async def process(process_volume, volumes, pipeline_executor):
+    """Run each volume in ``volumes`` through the pipeline"""
+    loop = asyncio.get_running_loop()
+    while True:
+        timestamped_volume = await volumes.get()
+        logger.info('Received image %d', timestamped_volume['image_number'])
+        data_dict = preprocess.create_data_dict(timestamped_volume)
+
+        t1 = time.time()
+        await loop.run_in_executor(pipeline_executor, process_volume, data_dict)
+        t2 = time.time()
+        logger.debug('Pipeline ran in %.4f seconds', t2 - t1)
+
+
+async def listen_reset(reset, pipeline_executor, executor):
+    """Reset the pipeline when a message is published on the ``pipeline_reset`` channel"""
+    loop = asyncio.get_running_loop()
+    subscription = r.pubsub(ignore_subscribe_messages=True)
+    subscription.subscribe('pipeline_reset')
+    while True:
+        message = await loop.run_in_executor(executor, subscription.get_message, True, 1.)
+        if message is not None:
+            # reset in the pipeline thread so that it happens between two volumes
+            await loop.run_in_executor(pipeline_executor, reset)
+            logger.info('Pipeline reset.')
+            delivery.log_report()
+
+
+async def _run(process_volume, reset, collector, monitor, executor, pipeline_executor):
+    timestamps = asyncio.Queue()
+    volumes = asyncio.Queue()
+    tasks = [collect_ttl(collector, timestamps, executor),
+             collect(monitor, timestamps, volumes, executor),
+             process(process_volume, volumes, pipeline_executor),
+             listen_reset(reset, pipeline_executor, executor)]
+    await asyncio.gather(*tasks)
+
+
+def run(recording_id, pipeline_name, ttl_source='keyboard', directory=None, file_glob='*/*.dcm',
+        verbose=True, **global_parameters):
+    """Collect TTL pulses and volumes and preprocess them in a single process
+
+    Parameters
+    ----------
+    recording_id : str
+        A unique identifier for the recording
+    pipeline_name : str
+        Name of preprocessing configuration to use
+    ttl_source : str
+        TTL source. keyboard, serial, redis, or simulate
+    directory : str or None
+        Directory that new dicom files appear in. Defaults to ``config.SCANNER_DIR``
+    file_glob : str
+        Pattern of the dicom files, relative to ``directory``
+    verbose : bool
+        Whether to log to the console
+    """
+    config_path = op.join(config.PIPELINE_DIR, pipeline_name + '.yaml')
+    with open(config_path, 'rb') as f:
+        pipeline_config = yaml.load(f)
+
+    pipeline_config['global_parameters'].update(global_parameters)
+    pipeline = preprocess.Pipeline(recording_id=recording_id, **pipeline_config)
+
+    if pipeline.staged:
+        staged_executor = preprocess.StagedExecutor(pipeline, queue_size=pipeline.queue_size)
+        process_volume = staged_executor.submit
+
+        def reset():
+            staged_executor.drain()
+            pipeline.reset()
+
+    else:
+        process_volume = pipeline.process
+        reset = pipeline.reset
+
+    if directory is None:
+        directory = config.SCANNER_DIR
+
+    collector = CollectTTL(ttl_source, verbose=verbose)
+    monitor = DirectoryMonitor(directory, file_glob=file_glob)
+
+    # one thread per blocking task, plus a separate thread that runs all pipeline steps
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='runtime')
+    pipeline_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipeline')
+    try:
+        asyncio.run(_run(process_volume, reset, collector, monitor, executor, pipeline_executor))
+
+    finally:
+        collector.active = False
+        executor.shutdown(wait=False)
+        pipeline_executor.shutdown(wait=False)
+        delivery.shutdown(timeout=10.)
@@ -7,7 +7,6 @@ from __future__ import print_function
 import logging
 import logging.handlers
 import os.path as op
-import pickle
 import redis
 import struct
 import subprocess
@@ -18,7 +17,7 @@ import numpy as np
 from nibabel import Nifti1Image
 from nibabel import load as nibload
 
-from realtimefmri import config
+from realtimefmri import codec, config
 from sklearn.base import BaseEstimator, TransformerMixin
 
 
@@ -38,7 +37,7 @@ def load_timestamped_array_from_redis(key_prefix):
     """
     data = []
     for key in r.scan_iter(key_prefix + ':*'):
-        dat = pickle.loads(r.get(key))
+        dat = codec.decode(r.get(key))
         data.append(dat)
 
     if len(data) == 0:
@@ -77,12 +76,18 @@ def parse_message(message):
     topic, sync_time, data = message
     topic = topic.decode('utf-8')
     sync_time = struct.unpack('d', sync_time)[0]
-    data = pickle.loads(data)
+    data = codec.decode(data)
     return topic, sync_time, data
 
 
-def load_run(recording_id):
+def load_run(recording_id, dtype='float32'):
     """Load data from a real-time run into a nifti volumes
+
+    Parameters
+    ----------
+    recording_id : str
+    dtype : str
+        Data type of the loaded volumes
     """
     file_paths = glob(op.join(config.RECORDING_DIR, recording_id, '*.nii'))
     file_paths = sorted(file_paths)
@@ -93,12 +98,12 @@ def load_run(recording_id):
         if volume is None:
             x, y, z = nii.shape
             shape = (len(file_paths), x, y, z)
-            volume = np.zeros(shape)
+            volume = np.zeros(shape, dtype=dtype)
             affine = nii.affine
 
         assert nii.affine == affine
 
-        volume[i, ...] = nii.get_data()
+        volume[i, ...] = np.asarray(nii.dataobj)
 
     return Nifti1Image(volume, affine)
 
@@ -1,4 +1,3 @@
-import pickle
 import time
 import warnings
 
@@ -6,7 +5,7 @@ import numpy as np
 import redis
 
 import cortex
-from realtimefmri import config
+from realtimefmri import codec, config, cortex_cache
 from realtimefmri.utils import get_logger
 
 logger = get_logger('realtimefmri.viewer', to_console=True, to_network=False,
@@ -22,7 +21,7 @@ class PyCortexViewer(object):
         if mask_type == '':
             data = np.zeros((self.bufferlen, 30, 100, 100), 'float32')
         else:
-            npts = cortex.db.get_mask(surface, transform, mask_type).sum()
+            npts = cortex_cache.get_mask(surface, transform, mask_type).sum()
             data = np.zeros((self.bufferlen, npts), 'float32')
 
         vol = cortex.Volume(data, surface, transform, vmin=vmin, vmax=vmax)
@@ -72,7 +71,7 @@ class PyCortexViewer(object):
         logger.info('Listening for volumes')
         for message in subscriber.listen():
             if message['type'] == 'message':
-                vol = pickle.loads(message['data'])
+                vol = codec.decode(message['data'])
                 self.update_viewer(vol)
 
 
@@ -1,13 +1,12 @@
 import dash
 import flask
 import os.path as op
-import pickle
 import redis
 
 from flask import render_template
 from pathlib import Path
 
-from realtimefmri import config
+from realtimefmri import codec, config
 from realtimefmri.utils import get_logger
 
 logger = get_logger('realtimefmri.app', to_console=True, to_file=True)
@@ -28,7 +27,7 @@ r = redis.StrictRedis(config.REDIS_HOST)
 def serve_redis(key):
     try:
         value = r.get(key)
-        return pickle.loads(value)
+        return codec.decode(value)
 
     except Exception as e:
         logger.warning(e)
@@ -13,7 +13,7 @@ import dash_html_components as html
 import redis
 from dash.dependencies import Input, Output, State
 
-from realtimefmri import collect, collect_ttl, config, preprocess, viewer
+from realtimefmri import codec, collect, collect_ttl, config, preprocess, viewer
 from realtimefmri.utils import get_logger
 from realtimefmri.web_interface import utils
 from realtimefmri.web_interface.app import app
@@ -130,7 +130,7 @@ def update_tr_count(n):
     if n is not None:
         count = r.get('image_number')
         if count:
-            count = pickle.loads(count)
+            count = codec.decode(count)
 
         return count
 
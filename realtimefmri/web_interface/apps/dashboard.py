@@ -13,7 +13,7 @@ import plotly.graph_objs as go
 import redis
 from dash.dependencies import Input, Output, State
 
-from realtimefmri import config
+from realtimefmri import codec, config
 from realtimefmri.utils import get_logger
 from realtimefmri.web_interface.app import app
 
@@ -86,7 +86,7 @@ def generate_update_graph():
             titles.append(title)
             if dat:
                 logger.debug('dashboard %s', len(dat))
-                data = pickle.loads(dat)
+                data = codec.decode(dat)
                 plot_type = r.get(key + ':type')
 
                 if plot_type == b'bar':
@@ -10,7 +10,8 @@ from flask import render_template, request, Response, send_from_directory
 
 from realtimefmri import config, utils
 from realtimefmri.web_interface.app import app
-from realtimefmri.web_interface.apps.model import detrend_responses
+from realtimefmri.web_interface.apps import jobs
+from realtimefmri.web_interface.apps.model import detrend_responses, load_stored_model
 
 
 logger = utils.get_logger('realtimefmri.experiment', to_file=True)
@@ -56,7 +57,8 @@ def serve_append_random_stimulus_trial():
 
 @app.server.route('/experiment/trial/append/top_n', methods=['POST'])
 def serve_append_top_n():
-    """Add the top n most likely decoding results
+    """Add the top n most likely decoding results. The decoding runs in a background job, see
+    ``append_top_n``.
 
     parameters:
       - name: model_name
@@ -80,12 +82,36 @@ def serve_append_top_n():
     n = int(request.args.get('n', '5'))
     detrend_type = request.args.get('detrend_type', 'whitematterdetrend')
 
-    model = pickle.loads(r.get(f'model:{model_name}'))
     trial_index = pickle.loads(r.get('experiment:trial:current'))['index']
 
+    job_id = jobs.submit(append_top_n, model_name, trial_index, responses_name=responses_name,
+                         n=n, detrend_type=detrend_type)
+    return jobs.job_response(job_id)
+
+
+def append_top_n(model_name, trial_index, responses_name='graymatter', n=5,
+                 detrend_type='whitematterdetrend'):
+    """Decode the responses of a trial and append a trial that shows the top n classes
+
+    Parameters
+    ----------
+    model_name : str
+    trial_index : int
+    responses_name : str
+    n : int
+    detrend_type : str
+
+    Returns
+    -------
+    A message describing the appended trial
+    """
+    model = load_stored_model(model_name)
+
+    jobs.report_progress(0., 'Detrending responses')
     key_prefix = f'responses:{responses_name}'
     _, responses = detrend_responses(key_prefix, detrend_type=detrend_type, trials=[trial_index])
 
+    jobs.report_progress(0.8, 'Decoding')
     responses = np.nan_to_num(responses.mean(0, keepdims=True))
     probabilities = model.predict_proba(responses).ravel()
     top_indices = probabilities.argsort()[-n:][::-1]
@@ -138,8 +164,7 @@ def serve_append_optimal_stimulus_trial():
     n_random = request.args.get('n_random', 3)
 
     X = np.random.randn(5, 10).astype('float32')
-    model = r.get(f'model:{model_name}')
-    model = pickle.loads(model)
+    model = load_stored_model(model_name)
     y_hat = model.predict(X)
 
     optimal_indices = y_hat.argpartition(-n_optimal)[-n_optimal:]
@@ -0,0 +1,208 @@
+"""Run long computations for the web interface in a pool of worker processes
+
+Endpoints that do heavy work call ``submit`` and return the job ID right away instead of
+blocking the server. The state, progress, and result of each job are stored in redis, so they can
+be polled at ``/job/<job_id>`` and ``/job/<job_id>/result``. Jobs that are submitted with a
+``cache_key`` reuse the result of an earlier job with the same key. Including ``data_version`` of
+the input data in the key makes repeated requests on unchanged data return immediately.
+"""
+import json
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from uuid import uuid4
+
+import redis
+from flask import Response
+
+from realtimefmri import codec, config, utils
+from realtimefmri.web_interface.app import app
+
+
+logger = utils.get_logger('realtimefmri.jobs', to_file=True)
+r = redis.StrictRedis(config.REDIS_HOST)
+
+N_WORKERS = 2
+# seconds that job states and results are kept
+EXPIRE = 24 * 60 * 60
+
+_pool = None
+_current_job = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=N_WORKERS)
+    return _pool
+
+
+def _set_state(job_id, **state):
+    key = f'job:{job_id}'
+    r.hset(key, mapping={k: json.dumps(v) for k, v in state.items()})
+    r.expire(key, EXPIRE)
+
+
+def get_state(job_id):
+    """Get the state of a job
+
+    Parameters
+    ----------
+    job_id : str
+
+    Returns
+    -------
+    A dict with the ``status`` (queued, running, done, or failed), ``progress`` between 0 and 1,
+    ``message``, and, for failed jobs, ``error`` of the job, or None if there is no such job
+    """
+    state = r.hgetall(f'job:{job_id}')
+    if len(state) == 0:
+        return None
+    return {k.decode('utf-8'): json.loads(v) for k, v in state.items()}
+
+
+def get_result(job_id):
+    """Get the result of a finished job"""
+    result = r.get(f'job:{job_id}:result')
+    if result is None:
+        return None
+    return codec.decode(result, allow_pickle=False)
+
+
+def report_progress(progress, message=''):
+    """Report the progress of the job running in this process. Does nothing outside of jobs.
+
+    Parameters
+    ----------
+    progress : float
+        Fraction of the job that is done
+    message : str
+    """
+    if _current_job is not None:
+        _set_state(_current_job, progress=progress, message=message)
+
+
+def data_version(key_prefix):
+    """Version of the data stored under a key prefix
+
+    Data is only ever appended under a prefix, so the number of keys and the last key identify
+    its contents.
+
+    Parameters
+    ----------
+    key_prefix : str
+
+    Returns
+    -------
+    A string that changes when data is added
+    """
+    keys = [key.decode('utf-8') for key in r.scan_iter(key_prefix + ':*')]
+    last_key = max(keys) if len(keys) > 0 else ''
+    return f'{len(keys)}:{last_key}'
+
+
+def _run(job_id, cache_key, function, args, kwargs):
+    """Run a job in a worker process and store its result"""
+    global _current_job
+    _current_job = job_id
+    _set_state(job_id, status='running')
+    try:
+        result = function(*args, **kwargs)
+        r.set(f'job:{job_id}:result', codec.encode(result), ex=EXPIRE)
+        _set_state(job_id, status='done', progress=1.)
+        if cache_key is not None:
+            r.set(f'job:cache:{cache_key}', job_id, ex=EXPIRE)
+
+    except Exception as e:
+        logger.exception('Job %s failed', job_id)
+        _set_state(job_id, status='failed', error=repr(e), traceback=traceback.format_exc())
+
+    finally:
+        _current_job = None
+
+
+def _check_job(job_id, pool, future):
+    """Mark a job as failed if its worker process could not run it, e.g. because it died"""
+    global _pool
+    if future.cancelled():
+        _set_state(job_id, status='failed', error='Job was cancelled')
+        return
+
+    error = future.exception()
+    if error is None:
+        return
+
+    logger.error('Job %s failed in the process pool: %r', job_id, error)
+    _set_state(job_id, status='failed', error=repr(error))
+    if isinstance(error, BrokenProcessPool) and _pool is pool:
+        # a broken pool refuses new jobs, so start a new one on the next submit
+        _pool = None
+
+
+def submit(function, *args, cache_key=None, **kwargs):
+    """Run a function in a worker process
+
+    Parameters
+    ----------
+    function : callable
+        A module-level function, so that it can be sent to the worker processes
+    args, kwargs
+        Arguments to the function
+    cache_key : str or None
+        If a job with the same key finished before, its ID is returned instead of running the
+        function again
+
+    Returns
+    -------
+    The job ID
+    """
+    if cache_key is not None:
+        cached_job_id = r.get(f'job:cache:{cache_key}')
+        if cached_job_id is not None:
+            cached_job_id = cached_job_id.decode('utf-8')
+            state = get_state(cached_job_id)
+            if state is not None and state['status'] == 'done':
+                logger.info('Using cached result of job %s', cached_job_id)
+                return cached_job_id
+
+    job_id = uuid4().hex
+    _set_state(job_id, status='queued', progress=0., message='', function=function.__name__)
+    pool = _get_pool()
+    future = pool.submit(_run, job_id, cache_key, function, args, kwargs)
+    future.add_done_callback(partial(_check_job, job_id, pool))
+    logger.info('Submitted job %s %s', job_id, function.__name__)
+    return job_id
+
+
+def job_response(job_id):
+    """Response of an endpoint that submitted a job"""
+    return Response(json.dumps({'job_id': job_id, 'state': f'/job/{job_id}',
+                                'result': f'/job/{job_id}/result'}),
+                    status=202, mimetype='application/json')
+
+
+@app.server.route('/job/<job_id>', methods=['GET'])
+def serve_job_state(job_id):
+    """State and progress of a job"""
+    state = get_state(job_id)
+    if state is None:
+        return Response(json.dumps({'error': f'No job {job_id}'}), status=404,
+                        mimetype='application/json')
+
+    return Response(json.dumps(state), mimetype='application/json')
+
+
+@app.server.route('/job/<job_id>/result', methods=['GET'])
+def serve_job_result(job_id):
+    """Result of a finished job"""
+    state = get_state(job_id)
+    if state is None or state['status'] != 'done':
+        return Response(json.dumps({'error': f'Job {job_id} has no result', 'state': state}),
+                        status=404, mimetype='application/json')
+
+    result = get_result(job_id)
+    try:
+        return Response(json.dumps({'result': result}), mimetype='application/json')
+    except TypeError:
+        return Response(json.dumps({'result': repr(result)}), mimetype='application/json')
@@ -1,14 +1,13 @@
-import pickle
+import json
 from pathlib import Path
 
 import numpy as np
 import redis
-from flask import render_template, request
-from scipy import stats
-from sklearn import linear_model
+from flask import Response, render_template, request
 
-from realtimefmri import config, detrend, utils
+from realtimefmri import codec, config, decoding, detrend, ridge, utils
 from realtimefmri.web_interface.app import app
+from realtimefmri.web_interface.apps import jobs
 
 
 logger = utils.get_logger('realtimefmri.model', to_file=True)
@@ -45,9 +44,93 @@ def load_responses(key_prefix, trials=None):
     return response_times, responses
 
 
+def _pending_responses(pending):
+    """Pack unpaired responses, keyed by time, for ``codec.encode``"""
+    times = sorted(pending)
+    return {'times': np.array(times, dtype='float64'),
+            'responses': np.array([pending[t] for t in times])}
+
+
+def update_detrender(key_prefix, wm_key_prefix='responses:whitematterdetrend'):
+    """Update the white matter detrender of a response key prefix with the responses that
+    arrived since the last update
+
+    The sums and cross-products of the detrender, the keys of the responses it was updated
+    with, and the responses that do not have a partner yet are stored in the database, so all
+    job workers share one detrender, an update only loads the new responses, and flushing the
+    database resets it. Gray and white matter responses are paired by their times. When
+    responses the detrender was updated with are no longer in the database, they were deleted or
+    replaced by a new recording, and the detrender is fit again from scratch.
+
+    Parameters
+    ----------
+    key_prefix : str
+        Prefix to the key for the gray matter responses in the database
+    wm_key_prefix : str
+        Prefix to the key for the white matter responses in the database
+
+    Returns
+    -------
+    The ``detrend.IncrementalWhiteMatterDetrend``
+    """
+    state_key = f'detrender:{key_prefix}'
+    gm_keys_key = f'{state_key}:gm_keys'
+    wm_keys_key = f'{state_key}:wm_keys'
+    with r.lock(f'{state_key}:lock', timeout=600):
+        gm_keys = r.smembers(gm_keys_key)
+        wm_keys = r.smembers(wm_keys_key)
+        state = r.get(state_key)
+        state = None if state is None else codec.decode(state, allow_pickle=False)
+
+        if (state is None or
+                not gm_keys <= set(r.scan_iter(key_prefix + ':*')) or
+                not wm_keys <= set(r.scan_iter(wm_key_prefix + ':*'))):
+            if state is not None:
+                logger.info('Responses under %s changed, refitting detrender', key_prefix)
+            detrender = detrend.IncrementalWhiteMatterDetrend()
+            pending = {'gm': {}, 'wm': {}}
+            gm_keys, wm_keys = set(), set()
+            r.delete(gm_keys_key, wm_keys_key)
+
+        else:
+            detrender = detrend.IncrementalWhiteMatterDetrend.from_state(state['detrender'])
+            pending = {name: dict(zip(state[name]['times'].tolist(), state[name]['responses']))
+                       for name in ('gm', 'wm')}
+
+        seen_gm_keys, seen_wm_keys = set(gm_keys), set(wm_keys)
+        gm_times, gm_responses = load_new_responses(key_prefix, seen_gm_keys)
+        pending['gm'].update(zip(gm_times, gm_responses))
+        wm_times, wm_responses = load_new_responses(wm_key_prefix, seen_wm_keys)
+        pending['wm'].update(zip(wm_times, wm_responses))
+
+        paired_times = sorted(set(pending['gm']) & set(pending['wm']))
+        if len(paired_times) > 0:
+            gm_responses = np.array([pending['gm'].pop(t) for t in paired_times])
+            wm_responses = np.array([pending['wm'].pop(t) for t in paired_times])
+            detrender.partial_fit(gm_responses, wm_responses)
+            logger.info('Updated detrender of %s with %d responses (%d total)', key_prefix,
+                        len(paired_times), detrender.n_samples)
+
+        state = {'detrender': detrender.get_state(),
+                 'gm': _pending_responses(pending['gm']),
+                 'wm': _pending_responses(pending['wm'])}
+        r.set(state_key, codec.encode(state))
+        new_gm_keys = seen_gm_keys - gm_keys
+        if len(new_gm_keys) > 0:
+            r.sadd(gm_keys_key, *new_gm_keys)
+        new_wm_keys = seen_wm_keys - wm_keys
+        if len(new_wm_keys) > 0:
+            r.sadd(wm_keys_key, *new_wm_keys)
+
+    return detrender
+
+
 def detrend_responses(key_prefix, detrend_type, trials=None):
     """Load and detrend responses
 
+    The detrender is fit on all responses, but only updated with the responses that arrived since
+    the previous call, and only the responses of the requested trials are loaded and detrended.
+
     Parameters
     ----------
     key_prefix : str
@@ -59,28 +142,16 @@ def detrend_responses(key_prefix, detrend_type, trials=None):
     An array with size (number of samples, number of voxels) of detrended responses
     """
     if detrend_type == 'whitematterdetrend':
-        response_times, gm_responses = load_responses(key_prefix)
-        _, wm_responses = load_responses('responses:whitematterdetrend')
-
-        detrender = detrend.WhiteMatterDetrend()
-        detrender.fit(gm_responses, wm_responses)
+        detrender = update_detrender(key_prefix)
 
-        gm_detrended = detrender.detrend(gm_responses, wm_responses)
+        response_times, gm_responses = load_responses(key_prefix, trials=trials)
+        _, wm_responses = load_responses('responses:whitematterdetrend', trials=trials)
 
-        gm_mean = np.nanmean(gm_detrended, 0, keepdims=True)
-        gm_std = np.nanstd(gm_detrended, 0, keepdims=True)
-
-        if trials is not None:
-            response_times, gm_responses = load_responses(key_prefix, trials=trials)
-            _, wm_responses = load_responses('responses:whitematterdetrend', trials=trials)
-
-        gm_detrended = detrender.detrend(gm_responses, wm_responses)
+        gm_detrended = detrender.normalize(gm_responses, wm_responses)
 
     else:
         raise NotImplementedError(f'{detrend_type} not implemented.')
 
-    gm_detrended = (gm_detrended - gm_mean) / gm_std
-
     return response_times, gm_detrended
 
 
@@ -100,9 +171,10 @@ def load_features(feature_name):
     """
     features = []
     feature_times = []
-    for key in r.scan_iter('log:stimulus:*'):
-        start_time = r.get(key + ':time')
-        message = r.get(key + ':message')
+    for time_key in r.scan_iter('log:stimulus:*:time'):
+        key = time_key.decode('utf-8')[:-len(':time')]
+        start_time = float(r.get(key + ':time'))
+        message = r.get(key + ':message').decode('utf-8')
         stimulus_name = message.split('start ')[1]
         feature_path = (Path(config.STATIC_PATH) / 'features' / feature_name /
                         Path(stimulus_name).with_suffix('.npy'))
@@ -116,8 +188,55 @@ def load_features(feature_name):
     return feature_times, features
 
 
+def load_new_responses(key_prefix, seen_keys):
+    """Load the responses that are not in ``seen_keys``
+
+    Parameters
+    ----------
+    key_prefix : str
+        Prefix to the key for the response in the database
+    seen_keys : set
+        Keys of responses that were already loaded. Updated with the newly loaded keys.
+
+    Returns
+    -------
+    An array of response times and an array of responses, sorted by time
+    """
+    keys = [key for key in r.scan_iter(key_prefix + ':*') if key not in seen_keys]
+    if len(keys) == 0:
+        return np.empty(0), np.empty((0, 0))
+
+    data = sorted((codec.decode(value) for value in r.mget(keys)), key=lambda x: x[0])
+    seen_keys.update(keys)
+    response_times, responses = zip(*data)
+    return np.array(response_times), np.array(responses)
+
+
 def align_features_and_responses(feature_times, features, response_times, responses):
-    return features, responses
+    """Pair each response with the most recent feature sample at or before its time
+
+    Parameters
+    ----------
+    feature_times : numpy.ndarray or list of numpy.ndarray
+    features : numpy.ndarray or list of numpy.ndarray
+    response_times : numpy.ndarray
+    responses : numpy.ndarray
+
+    Returns
+    -------
+    An array of features and an array of responses with one row per response that has a feature
+    sample before it
+    """
+    if isinstance(feature_times, (list, tuple)):
+        feature_times = np.concatenate(feature_times)
+        features = np.concatenate(features)
+
+    order = np.argsort(feature_times)
+    feature_times, features = feature_times[order], features[order]
+
+    indices = np.searchsorted(feature_times, response_times, side='right') - 1
+    valid = indices >= 0
+    return features[indices[valid]], responses[valid]
 
 
 @app.server.route('/models', methods=['GET'])
@@ -125,9 +244,11 @@ def serve_models():
     """List all stored models, both those stored in the redis database and those stored on the
     server's file system. Models served on the file system can be loaded into the database.
     """
-    datastore_models = []
-    for model_path in (Path(config.DATASTORE_DIR) / 'models').glob('*.pkl'):
-        datastore_models.append(model_path.stem)
+    datastore_models = set()
+    for pattern in ('*.pkl', '*' + decoding.MODEL_EXTENSION):
+        for model_path in (Path(config.DATASTORE_DIR) / 'models').glob(pattern):
+            datastore_models.add(model_path.stem)
+    datastore_models = sorted(datastore_models)
 
     key_prefix = 'model:*'
     database_models = list(r.scan_iter(key_prefix))
@@ -141,9 +262,8 @@ def serve_models():
 def serve_model(model_name):
     if request.method == 'GET':
         key = 'model:' + model_name
-        model = r.get(key)
+        model = load_stored_model(model_name)
         if model is not None:
-            model = pickle.loads(model)
             return f'{key} {str(model)}'
         else:
             return f'No model at {key}'
@@ -151,49 +271,195 @@ def serve_model(model_name):
 
 @app.server.route('/model/<model_name>/store', methods=['POST'])
 def serve_store_model(model_name):
+    model_path = Path(config.DATASTORE_DIR) / f'models/{model_name}{decoding.MODEL_EXTENSION}'
+    if model_path.is_dir():
+        # only the path of a compact model is stored, so its weights are memory-mapped when loaded
+        store_model(model_name, decoding.load_model(str(model_path)))
+        return f'Stored model {model_name}'
+
+    # other estimators are only available as pickles, which are stored as they are
     with open(Path(config.DATASTORE_DIR) / f'models/{model_name}.pkl', 'rb') as f:
         r.set(f'model:{model_name}', f.read())
+    r.incr(f'version:model:{model_name}')
 
     return f'Stored model {model_name}'
 
 
+def model_version(model_name):
+    """Version of a model in the database, incremented every time it is stored"""
+    version = r.get(f'version:model:{model_name}')
+    return 0 if version is None else int(version)
+
+
+def store_model(model_name, model):
+    """Store a model in the database and increment its version
+
+    Ridge models are stored as their parameters, statistics, and solution, and compact models as
+    their path, encoded with ``codec``.
+
+    Parameters
+    ----------
+    model_name : str
+    model : ridge.IncrementalRidge or decoding.LinearModel
+    """
+    if isinstance(model, ridge.IncrementalRidge):
+        stored = {'type': 'ridge', 'state': model.get_state()}
+    elif isinstance(model, decoding.LinearModel):
+        stored = {'type': 'compact', 'path': model.path}
+    else:
+        raise TypeError(f'Cannot store {type(model).__name__} in the database')
+
+    r.set(f'model:{model_name}', codec.encode(stored))
+    r.incr(f'version:model:{model_name}')
+
+
+def load_stored_model(model_name):
+    """Load a model from the database
+
+    Parameters
+    ----------
+    model_name : str
+
+    Returns
+    -------
+    The model, or None if there is no model with that name
+    """
+    message = r.get(f'model:{model_name}')
+    if message is None:
+        return None
+
+    stored = codec.decode(message)
+    if not codec.is_encoded(message):
+        # estimators that were stored from pickles in the datastore, see ``serve_store_model``
+        return stored
+
+    if stored['type'] == 'ridge':
+        return ridge.IncrementalRidge.from_state(stored['state'])
+    if stored['type'] == 'compact':
+        return decoding.load_model(stored['path'])
+    raise ValueError(f'Unknown type of stored model {stored["type"]}')
+
+
+def fit_model(model_name, feature_name, key_prefix='responses', alphas=None):
+    """Fit a ridge model to the responses stored under ``key_prefix``
+
+    Responses stored since the last fit of the same model are added to the running sufficient
+    statistics of its ``ridge.IncrementalRidge``, which is then solved for all alphas at once, so
+    refitting does not reload earlier responses.
+
+    Parameters
+    ----------
+    model_name : str
+    feature_name : str
+    key_prefix : str
+    alphas : list of float or None
+
+    Returns
+    -------
+    A message with the number of samples the model was fit on
+    """
+    fitted_keys_key = f'fit:{model_name}:keys'
+    with r.lock(f'fit:{model_name}:lock', timeout=600):
+        model = load_stored_model(model_name)
+        if not isinstance(model, ridge.IncrementalRidge):
+            model = ridge.IncrementalRidge()
+            r.delete(fitted_keys_key)
+
+        if alphas is not None:
+            model.alphas = np.array(alphas, dtype='float64')
+
+        jobs.report_progress(0., 'Loading responses')
+        fitted_keys = r.smembers(fitted_keys_key)
+        seen_keys = set(fitted_keys)
+        response_times, responses = load_new_responses(key_prefix, seen_keys)
+        if len(responses) > 0:
+            jobs.report_progress(0.3, 'Loading features')
+            feature_times, features = load_features(feature_name)
+            X, y = align_features_and_responses(feature_times, features, response_times,
+                                                responses)
+            model.partial_fit(X, y)
+
+        jobs.report_progress(0.6, 'Solving')
+        model.fit()
+        store_model(model_name, model)
+        new_keys = seen_keys - fitted_keys
+        if len(new_keys) > 0:
+            r.sadd(fitted_keys_key, *new_keys)
+
+    return f'Fit {model_name} on {model.n_samples} samples'
+
+
 @app.server.route('/model/<model_name>/fit', methods=['GET', 'POST'])
 def serve_fit_model(model_name):
-    """Fit a model
+    """Fit a ridge model in a background job, see ``fit_model``
 
     parameters:
       - name: model_name
         in: path
         type: string
         description: Key for model in the database
-      - name: mask_type
+      - name: feature_name
+        in: query
+        type: string
+        required: true
+        description: Name of the stimulus features
+      - name: key_prefix
         in: query
         type: string
-        description: Mask for responses
+        description: Prefix of the keys of the responses
+      - name: alphas
+        in: query
+        type: string
+        description: Comma-separated regularization strengths to choose from
     """
-    detrend_type = request.args.get('detrend_type', None)
-    model_type = request.args.get('model_type', None)
-    mask_type = request.args.get('mask_type', None)
-    load_responses('responses:', )
+    model_type = request.args.get('model_type', 'ridge')
+    feature_name = request.args.get('feature_name', None)
+    key_prefix = request.args.get('key_prefix', 'responses')
+    alphas = request.args.get('alphas', None)
 
-    # # get feature times
-    # feature_times, features = load_features('motion_energy')
-    # X, y = align_features_and_responses(feature_times, features, response_times, responses)
+    if model_type != 'ridge':
+        raise NotImplementedError(f'{model_type} not implemented.')
+
+    if feature_name is None:
+        return Response(json.dumps({'error': 'feature_name is required'}), status=400,
+                        mimetype='application/json')
+
+    if alphas is not None:
+        alphas = [float(alpha) for alpha in alphas.split(',')]
+
+    cache_key = (f'fit:{model_name}:{feature_name}:{key_prefix}:{alphas}:'
+                 f'{jobs.data_version(key_prefix)}')
+    job_id = jobs.submit(fit_model, model_name, feature_name, key_prefix=key_prefix,
+                         alphas=alphas, cache_key=cache_key)
+    return jobs.job_response(job_id)
 
-    y = stats.zscore(responses, axis=0)
-    X = np.random.randn(len(y), 10).astype('float32')
 
-    if model_type == 'ridge':
-        model = linear_model.LinearRegression()
-        _ = model.fit(X, y)
-        r.set(f'model:{model_name}', pickle.dumps(model))
+def decode_model(model_name, trials=None):
+    """Decode responses with a model
+
+    Parameters
+    ----------
+    model_name : str
+    trials : list of int or None
+        Trials to decode. None decodes all responses.
+
+    Returns
+    -------
+    A list of predictions
+    """
+    jobs.report_progress(0., 'Loading responses')
+    _, responses = load_responses('responses', trials=trials)
+
+    model = load_stored_model(model_name)
+    jobs.report_progress(0.5, 'Decoding')
+    y_hat = model.predict(np.nan_to_num(responses))
 
-    return f'Fitting {model_name} {responses.shape}'
+    return np.asarray(y_hat).tolist()
 
 
 @app.server.route('/model/<model_name>/decode', methods=['GET'])
 def serve_decode_model(model_name):
-    """Generate predictions from a model
+    """Generate predictions from a model in a background job, see ``decode_model``
 
     parameters:
       - name: model_name
@@ -202,23 +468,17 @@ def serve_decode_model(model_name):
         description: Key for model in the database
       - name: trials
         in: query
-        type: list of integers
-        description: Trials to decode from
+        type: string
+        description: Comma-separated trials to decode from
     """
-    # # get feature times
-    # feature_times, features = load_features('motion_energy')
     trials = request.args.get('trials', None)
+    if trials is not None:
+        trials = [int(trial) for trial in trials.split(',')]
 
-    load_responses()
-    if trials is None:
-        response_times, responses = utils.load_timestamped_array_from_redis('responses')
-
-    X = np.random.randn(20, 10).astype('float32')
-    model = r.get(f'model:{model_name}')
-    model = pickle.loads(model)
-    y_hat = model.predict(X)
-
-    return f'Predicting {model_name} {len(y_hat)}'
+    cache_key = (f'decode:{model_name}:{model_version(model_name)}:{trials}:'
+                 f'{jobs.data_version("responses")}')
+    job_id = jobs.submit(decode_model, model_name, trials=trials, cache_key=cache_key)
+    return jobs.job_response(job_id)
 
 
 @app.server.route('/model/<model_name>/predict', methods=['GET'])
@@ -239,8 +499,7 @@ def serve_predict_model(model_name):
     # feature_times, features = load_features('motion_energy')
 
     X = np.random.randn(20, 10).astype('float32')
-    model = r.get(f'model:{model_name}')
-    model = pickle.loads(model)
+    model = load_stored_model(model_name)
     y_hat = model.predict(X)
 
     return f'Predicting {model_name} {len(y_hat)}'
@@ -11,6 +11,7 @@ def main():
           author_email='robertg@berkeley.edu',
           packages=find_packages(),
           install_requires=["numpy",
+                            "scipy>=1.5",
                             "redis",
                             "nibabel",
                             "pydicom",
@@ -21,7 +22,8 @@ def main():
                             "scikit-learn",
                             "pyserial",
                             "evdev",
-                            "PyYAML"],
+                            "PyYAML",
+                            "Pillow"],
           entry_points={'console_scripts':
                         ['realtimefmri = realtimefmri.__main__:main']},
           package_data={'realtimefmri': ['config.cfg', 'pipelines/preproc-default.yaml']})
@@ -0,0 +1,18 @@
+import sys
+
+import pytest
+import redis
+
+
+@pytest.fixture
+def redis_db(monkeypatch):
+    """An in-memory redis database that replaces the server in every imported realtimefmri
+    module"""
+    fakeredis = pytest.importorskip('fakeredis')
+    db = fakeredis.FakeStrictRedis()
+    for name, module in list(sys.modules.items()):
+        if name.startswith('realtimefmri') and isinstance(getattr(module, 'r', None),
+                                                          redis.Redis):
+            monkeypatch.setattr(module, 'r', db)
+
+    return db
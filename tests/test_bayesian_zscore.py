@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from realtimefmri import bayesian_zscore
+
+
+@pytest.fixture
+def samples():
+    rng = np.random.RandomState(0)
+    samples = rng.randn(60, 20) * 5 + 1e3
+    samples[30:, 2] = np.nan
+    return samples
+
+
+def batch_zscores(samples, prior_means, prior_variances, mean_belief, variance_alpha,
+                  update_prior):
+    """Z-scores of the previous implementation, which kept every sample"""
+    inverse_gamma = bayesian_zscore.InvGammaParameters(None, None, prior_variances)
+    inverse_gamma.alpha = variance_alpha
+    beta = inverse_gamma.get_beta()
+
+    zscores = []
+    for i in range(len(samples)):
+        history = samples[:i + 1]
+        post_var = bayesian_zscore.compute_posterior_variance(history, prior_means,
+                                                              variance_alpha, beta)
+        post_mean = bayesian_zscore.compute_posterior_mean(history, prior_means, mean_belief)
+        if update_prior:
+            prior_means = post_mean
+        zscores.append((samples[i] - post_mean) / np.sqrt(post_var))
+
+    return np.array(zscores)
+
+
+@pytest.mark.parametrize('update_prior', [False, True])
+def test_matches_batch(samples, update_prior):
+    prior_means = np.full(samples.shape[1], 990.)
+    prior_variances = np.full(samples.shape[1], 30.)
+    step = bayesian_zscore.BayesianZScore(prior_means, prior_variances, 5., 2.,
+                                          update_prior=update_prior)
+    zscores = np.array([step.run(sample) for sample in samples])
+    reference = batch_zscores(samples, prior_means, prior_variances, 5., 2., update_prior)
+
+    np.testing.assert_allclose(zscores, reference, rtol=1e-7, atol=1e-9)
+    # a NaN sample only affects its own voxel
+    assert np.isnan(zscores[30:, 2]).all()
+    assert np.isfinite(np.delete(zscores, 2, axis=1)).all()
+
+    if not update_prior:
+        step.reset()
+        np.testing.assert_allclose(step.run(samples[0]), reference[0])
+
+
+def test_keeps_dtype(samples):
+    samples = samples.astype('float32')
+    step = bayesian_zscore.BayesianZScore(np.zeros(20), np.ones(20), 1., 1.)
+    assert step.run(samples[0]).dtype == np.float32
+
+
+def test_statistics_match_samples(samples):
+    samples = samples[:, :2]
+    center = samples[0]
+    deviations = samples - center
+    n, sum_x, sum_sq_x = len(samples), deviations.sum(0), (deviations ** 2).sum(0)
+    for prior_mean in [0., 1e3, np.array([995., 1005.])]:
+        np.testing.assert_allclose(
+            bayesian_zscore.compute_posterior_variance_from_statistics(
+                n, sum_x, sum_sq_x, prior_mean, 2., 3., center=center),
+            bayesian_zscore.compute_posterior_variance(samples, prior_mean, 2., 3.), rtol=1e-9)
+        np.testing.assert_allclose(
+            bayesian_zscore.compute_posterior_mean_from_statistics(n, sum_x, prior_mean, 4.,
+                                                                   center=center),
+            bayesian_zscore.compute_posterior_mean(samples, prior_mean, 4.), rtol=1e-12)
@@ -0,0 +1,132 @@
+import pickle
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from realtimefmri import codec
+
+
+@pytest.fixture
+def volume():
+    rng = np.random.RandomState(0)
+    return rng.randn(10, 12, 8).astype('float32') * 100 + 500
+
+
+@pytest.mark.parametrize('compression', codec.COMPRESSIONS)
+def test_raw_round_trip(volume, compression):
+    for array in [volume, volume.astype('int16'), volume.astype('float64').T, volume[::2, 3],
+                  np.zeros((0, 5)), np.array(3.5)]:
+        decoded = codec.decode(codec.encode(array, compression=compression))
+        assert decoded.dtype == array.dtype
+        assert decoded.shape == array.shape
+        np.testing.assert_array_equal(decoded, array)
+
+
+def test_raw_arrays_are_aligned_views(volume):
+    message = codec.encode([volume, volume[0]])
+    decoded = codec.decode(message)
+    for array in decoded:
+        assert not array.flags.writeable
+        assert array.ctypes.data % codec.ALIGNMENT == 0
+        assert np.shares_memory(array, np.frombuffer(message, 'uint8'))
+
+
+@pytest.mark.parametrize('compression', codec.COMPRESSIONS)
+def test_float16_round_trip(volume, compression):
+    decoded = codec.decode(codec.encode(volume, encoding='float16', compression=compression))
+    assert decoded.dtype == volume.dtype
+    np.testing.assert_allclose(decoded, volume, rtol=1e-3)
+
+
+@pytest.mark.parametrize('compression', codec.COMPRESSIONS)
+def test_quantized_round_trip(volume, compression):
+    volume = volume.copy()
+    volume[0, 0, :3] = [np.nan, np.inf, -np.inf]
+    decoded = codec.decode(codec.encode(volume, encoding='quantized', compression=compression))
+    assert decoded.dtype == volume.dtype
+
+    finite = np.isfinite(volume)
+    step = np.ptp(volume[finite]) / (codec.QUANTIZED_MAX - 1)
+    np.testing.assert_allclose(decoded[finite], volume[finite], atol=step)
+    assert np.isnan(decoded[~finite]).all()
+
+
+def test_quantized_constant_array():
+    array = np.full(10, 2.5)
+    decoded = codec.decode(codec.encode(array, encoding='quantized'))
+    np.testing.assert_array_equal(decoded, array)
+
+
+def test_encodings_leave_integer_arrays_raw():
+    array = np.arange(20, dtype='int32')
+    for encoding in codec.ENCODINGS:
+        np.testing.assert_array_equal(codec.decode(codec.encode(array, encoding=encoding)), array)
+
+
+@pytest.mark.parametrize('compression', codec.COMPRESSIONS)
+def test_nested_round_trip(volume, compression):
+    value = {'image_number': 3, 'name': 'volume', 'missing': None, 'raw': b'\x00\x01',
+             'pair': (1.5, volume), 'list': [np.float32(2.), True, [volume[0]]]}
+    decoded = codec.decode(codec.encode(value, compression=compression))
+    assert decoded['image_number'] == 3
+    assert decoded['name'] == 'volume'
+    assert decoded['missing'] is None
+    assert decoded['raw'] == b'\x00\x01'
+    assert isinstance(decoded['pair'], tuple)
+    np.testing.assert_array_equal(decoded['pair'][1], volume)
+    assert decoded['list'][:2] == [2., True]
+    np.testing.assert_array_equal(decoded['list'][2][0], volume[0])
+
+
+@pytest.mark.parametrize('compression', codec.COMPRESSIONS)
+def test_nifti_round_trip(volume, compression):
+    affine = np.diag([2., 2., 3., 1.])
+    image = nib.Nifti1Image(volume, affine)
+    decoded = codec.decode(codec.encode(image, compression=compression))
+    assert isinstance(decoded, nib.Nifti1Image)
+    np.testing.assert_array_equal(np.asanyarray(decoded.dataobj), volume)
+    np.testing.assert_array_equal(decoded.affine, affine)
+    assert decoded.header.binaryblock == image.header.binaryblock
+
+
+def test_header(volume):
+    message = codec.encode(volume, time=12.5, sequence=7)
+    assert codec.is_encoded(message)
+    header = codec.read_header(message)
+    assert header['time'] == 12.5
+    assert header['sequence'] == 7
+    assert header['payload_offset'] % codec.ALIGNMENT == 0
+
+
+def test_legacy_pickle(volume):
+    message = pickle.dumps((12.5, volume))
+    assert not codec.is_encoded(message)
+    assert codec.read_header(message) is None
+
+    time, decoded = codec.decode(message)
+    assert time == 12.5
+    np.testing.assert_array_equal(decoded, volume)
+
+    with pytest.raises(ValueError):
+        codec.decode(message, allow_pickle=False)
+
+
+def test_newer_version_is_rejected(volume):
+    message = bytearray(codec.encode(volume))
+    message[len(codec.MAGIC)] = codec.CODEC_VERSION + 1
+    with pytest.raises(ValueError):
+        codec.decode(bytes(message))
+
+
+def test_unsupported_values():
+    with pytest.raises(TypeError):
+        codec.encode(object())
+    with pytest.raises(TypeError):
+        codec.encode({1: np.zeros(3)})
+    with pytest.raises(TypeError):
+        codec.encode(np.array([object()]))
+    with pytest.raises(ValueError):
+        codec.encode(np.zeros(3), encoding='float8')
+    with pytest.raises(ValueError):
+        codec.encode(np.zeros(3), compression='lz4')
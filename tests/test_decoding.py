@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from sklearn import discriminant_analysis, linear_model
+
+from realtimefmri import decoding
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    X = rng.randn(300, 15)
+    y = (X[:, :4].dot(rng.randn(4, 4)) + rng.randn(300, 4)).argmax(1)
+    return X, y
+
+
+@pytest.mark.parametrize('estimator', [
+    linear_model.LogisticRegression(),
+    linear_model.SGDClassifier(loss='log_loss', random_state=0),
+    linear_model.SGDClassifier(loss='modified_huber', random_state=0),
+    discriminant_analysis.LinearDiscriminantAnalysis()])
+@pytest.mark.parametrize('n_classes', [2, 4])
+def test_compact_model_probabilities(tmpdir, data, estimator, n_classes):
+    X, y = data
+    y = y % n_classes
+    estimator.fit(X, y)
+    path = str(tmpdir.join('estimator' + decoding.MODEL_EXTENSION))
+    decoding.save_model(estimator, path)
+    model = decoding.load_model(path)
+
+    X_test = X[:50] * 10
+    np.testing.assert_array_equal(model.predict(X_test), estimator.predict(X_test))
+    np.testing.assert_allclose(model.predict_proba(X_test), estimator.predict_proba(X_test),
+                               rtol=1e-6, atol=1e-12)
+    np.testing.assert_allclose(np.exp(model.predict_log_proba(X_test)),
+                               estimator.predict_proba(X_test), rtol=1e-6, atol=1e-12)
+
+
+def test_compact_model_without_probabilities(tmpdir, data):
+    X, y = data
+    estimator = linear_model.RidgeClassifier().fit(X, y)
+    path = str(tmpdir.join('estimator' + decoding.MODEL_EXTENSION))
+    decoding.save_model(estimator, path)
+    model = decoding.load_model(path)
+
+    np.testing.assert_array_equal(model.predict(X), estimator.predict(X))
+    with pytest.raises(AttributeError):
+        model.predict_proba(X)
+
+
+def test_log_expit():
+    x = np.array([-1000., -10., 0., 10., 1000.])
+    np.testing.assert_allclose(np.exp(decoding._log_expit(x)), 1 / (1 + np.exp(-x)))
+    assert np.isfinite(decoding._log_expit(x)).all()
@@ -0,0 +1,57 @@
+import pytest
+
+from realtimefmri import delivery
+
+
+@pytest.fixture
+def server():
+    server = delivery.serve_stand_in(max_received=5)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_delivers_in_order(server):
+    sender = delivery.HTTPDelivery(n_workers=2)
+    for i in range(5):
+        sender.post(server.url + '/a', data=f'{i}'.encode())
+    assert sender.flush(timeout=5)
+    sender.close()
+
+    assert [request['body'] for request in server.received] == [b'0', b'1', b'2', b'3', b'4']
+    statistics = sender.report()[server.url + '/a']
+    assert statistics['n_queued'] == 5
+    assert statistics['n_sent'] == 5
+    assert statistics['n_failed'] == 0
+
+
+def test_coalesce(server):
+    server.delay = 0.2
+    sender = delivery.HTTPDelivery(n_workers=1)
+    for i in range(5):
+        sender.post(server.url + '/b', data=f'{i}'.encode(), coalesce=True)
+    assert sender.flush(timeout=5)
+    sender.close()
+
+    bodies = [request['body'] for request in server.received]
+    assert bodies[-1] == b'4'
+    statistics = sender.report()[server.url + '/b']
+    assert statistics['n_sent'] + statistics['n_dropped'] == 5
+    assert statistics['n_sent'] == len(bodies)
+
+
+def test_failed_post():
+    sender = delivery.HTTPDelivery(n_workers=1, deadline=0.3, retry_delay=0.05)
+    sender.post('http://127.0.0.1:1/unreachable', data=b'x')
+    assert sender.flush(timeout=5)
+    sender.close()
+    assert sender.report()['http://127.0.0.1:1/unreachable']['n_failed'] == 1
+
+
+def test_received_is_bounded(server):
+    sender = delivery.HTTPDelivery(n_workers=1)
+    for i in range(8):
+        sender.post(server.url + '/c', data=f'{i}'.encode())
+    assert sender.flush(timeout=5)
+    sender.close()
+    assert [request['body'] for request in server.received] == [b'3', b'4', b'5', b'6', b'7']
@@ -0,0 +1,117 @@
+import pickle
+
+import numpy as np
+import pytest
+from sklearn import decomposition, linear_model
+
+from realtimefmri import codec, detrend
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    n_samples = 120
+    drift = rng.randn(n_samples, 3).cumsum(0)
+    wm = drift.dot(rng.randn(3, 40)) + rng.randn(n_samples, 40) + 50
+    gm = drift.dot(rng.randn(3, 60)) + rng.randn(n_samples, 60) + 100
+    return gm, wm
+
+
+def chunks(gm, wm, chunk_size=25):
+    def iterate():
+        for start in range(0, len(gm), chunk_size):
+            yield gm[start:start + chunk_size], wm[start:start + chunk_size]
+    return iterate
+
+
+@pytest.fixture
+def subject_directory(tmpdir, monkeypatch):
+    monkeypatch.setattr(detrend, 'get_subject_directory', lambda subject: str(tmpdir))
+    return tmpdir
+
+
+@pytest.mark.parametrize('svd_solver', ['full', 'randomized'])
+def test_fit_chunks_matches_fit(data, svd_solver):
+    gm, wm = data
+    batch = detrend.WhiteMatterDetrend(n_pcs=5).fit(gm, wm)
+    # with as many random directions as white matter voxels, the randomized solver is exact
+    chunked = detrend.WhiteMatterDetrend(n_pcs=5).fit_chunks(chunks(gm, wm),
+                                                             svd_solver=svd_solver,
+                                                             n_oversamples=wm.shape[1] - 5,
+                                                             random_state=0)
+
+    np.testing.assert_allclose(chunked.mean_, batch.mean_)
+    # components are only defined up to their sign
+    np.testing.assert_allclose(np.abs(chunked.components_.dot(batch.components_.T)),
+                               np.eye(5), atol=1e-6)
+    np.testing.assert_allclose(chunked.detrend(gm, wm), batch.detrend(gm, wm), atol=1e-6)
+
+
+def test_fit_chunks_errors(data):
+    gm, wm = data
+    with pytest.raises(ValueError):
+        detrend.WhiteMatterDetrend(n_pcs=5).fit_chunks(chunks(gm[:5], wm[:5]))
+    with pytest.raises(ValueError):
+        detrend.WhiteMatterDetrend(n_pcs=5).fit_chunks(chunks(gm, wm), svd_solver='arpack')
+
+
+def test_save_load(data, subject_directory):
+    gm, wm = data
+    detrender = detrend.WhiteMatterDetrend(n_pcs=5).fit(gm, wm)
+    path = detrender.save('subject', 'test')
+    assert path == str(subject_directory.join('wmdetrend-test.npz'))
+    assert subject_directory.listdir() == [subject_directory.join('wmdetrend-test.npz')]
+
+    loaded = detrend.load_detrender('subject', 'test')
+    assert loaded.n_pcs == 5
+    np.testing.assert_array_equal(loaded.detrend(gm, wm), detrender.detrend(gm, wm))
+
+
+def test_load_pickles(data, subject_directory):
+    gm, wm = data
+    pca = decomposition.PCA(n_components=5)
+    model = linear_model.LinearRegression().fit(pca.fit_transform(wm), gm)
+    with open(str(subject_directory.join('model-test.pkl')), 'wb') as f:
+        pickle.dump(model, f)
+    with open(str(subject_directory.join('pca-test.pkl')), 'wb') as f:
+        pickle.dump(pca, f)
+
+    loaded = detrend.load_detrender('subject', 'test')
+    assert loaded.n_pcs == 5
+    np.testing.assert_allclose(loaded.detrend(gm, wm), gm - model.predict(pca.transform(wm)))
+
+
+def test_incremental_matches_batch(data):
+    gm, wm = data
+    batch = detrend.WhiteMatterDetrend(n_pcs=5).fit(gm, wm)
+    detrended = batch.detrend(gm, wm)
+
+    incremental = detrend.IncrementalWhiteMatterDetrend(n_pcs=5)
+    for start in range(0, len(gm), 25):
+        incremental.partial_fit(gm[start:start + 25], wm[start:start + 25])
+
+    np.testing.assert_allclose(incremental.detrend(gm, wm), detrended, atol=1e-8)
+    np.testing.assert_allclose(incremental.normalize(gm, wm),
+                               detrended / detrended.std(0), atol=1e-8)
+
+
+def test_incremental_needs_samples(data):
+    gm, wm = data
+    incremental = detrend.IncrementalWhiteMatterDetrend(n_pcs=5).partial_fit(gm[:5], wm[:5])
+    with pytest.raises(ValueError):
+        incremental.detrend(gm, wm)
+
+
+def test_incremental_state_round_trip(data):
+    gm, wm = data
+    incremental = detrend.IncrementalWhiteMatterDetrend(n_pcs=5).partial_fit(gm[:60], wm[:60])
+    empty_state = codec.decode(codec.encode(detrend.IncrementalWhiteMatterDetrend().get_state()))
+    assert detrend.IncrementalWhiteMatterDetrend.from_state(empty_state).n_samples == 0
+
+    state = codec.decode(codec.encode(incremental.get_state()))
+    restored = detrend.IncrementalWhiteMatterDetrend.from_state(state)
+    restored.partial_fit(gm[60:], wm[60:])
+    incremental.partial_fit(gm[60:], wm[60:])
+
+    assert restored.n_samples == len(gm)
+    np.testing.assert_allclose(restored.detrend(gm, wm), incremental.detrend(gm, wm))
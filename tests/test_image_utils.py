@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from realtimefmri import image_utils
+
+
+@pytest.mark.parametrize('shape', [(5, 6, 7), (10, 4, 3), (1, 8, 8)])
+@pytest.mark.parametrize('dim', [0, 1, 2])
+def test_mosaic_index(shape, dim):
+    cortex = pytest.importorskip('cortex')
+    volume = np.random.RandomState(0).randn(*shape)
+    reference, (n_wide, n_tall) = cortex.mosaic(volume, dim=dim, show=False)
+
+    index, padding, size = image_utils.mosaic_index(shape, dim=dim)
+    assert size == (n_wide, n_tall)
+    assert index.shape == reference.shape
+    np.testing.assert_array_equal(padding, np.isnan(reference))
+    np.testing.assert_array_equal(volume.ravel()[index][~padding], reference[~padding])
+
+    fortran = np.asfortranarray(volume)
+    strides = tuple(stride // fortran.itemsize for stride in fortran.strides)
+    index, _, _ = image_utils.mosaic_index(shape, dim=dim, strides=strides)
+    np.testing.assert_array_equal(np.ravel(fortran, order='K')[index][~padding],
+                                  reference[~padding])
+
+
+@pytest.fixture
+def activity():
+    return np.random.RandomState(0).randn(100)
+
+
+def test_roi_average_matrix_masks(activity):
+    rng = np.random.RandomState(1)
+    masks = [rng.rand(100) > 0.7 for _ in range(5)]
+    # overlapping ROIs
+    masks.append(masks[0] | masks[1])
+    matrix = image_utils.roi_average_matrix(masks, 100)
+
+    assert matrix.shape == (6, 100)
+    np.testing.assert_allclose(matrix.dot(activity), [activity[mask].mean() for mask in masks])
+
+
+def test_roi_average_matrix_weights(activity):
+    rng = np.random.RandomState(1)
+    weights = rng.rand(3, 100) * (rng.rand(3, 100) > 0.5)
+    matrix = image_utils.roi_average_matrix(list(weights), 100)
+
+    np.testing.assert_allclose(matrix.dot(activity),
+                               [np.average(activity, weights=w) for w in weights])
+    np.testing.assert_allclose(matrix.sum(1), 1.)
+
+
+def test_roi_average_matrix_empty(activity):
+    masks = [np.zeros(100, dtype=bool), np.arange(100) < 10, np.zeros(100)]
+    matrix = image_utils.roi_average_matrix(masks, 100)
+
+    np.testing.assert_array_equal(np.diff(matrix.indptr) == 0, [True, False, True])
+    np.testing.assert_allclose(matrix.dot(activity), [0., activity[:10].mean(), 0.])
+    with pytest.raises(ValueError):
+        image_utils.roi_average_matrix([np.ones(99)], 100)
@@ -0,0 +1,98 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from realtimefmri.web_interface.apps import jobs, model
+
+
+def add(a, b, scale=1):
+    jobs.report_progress(0.5, 'Adding')
+    return (a + b) * scale
+
+
+def fail():
+    raise ValueError('bad input')
+
+
+@pytest.fixture
+def client(redis_db, monkeypatch):
+    """Run jobs in a thread instead of a worker process"""
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(jobs, '_pool', pool)
+    yield model.app.server.test_client()
+    pool.shutdown()
+
+
+def wait(client, job_id, timeout=5.):
+    start = time.time()
+    while time.time() - start < timeout:
+        response = client.get(f'/job/{job_id}')
+        assert response.status_code == 200
+        state = json.loads(response.data)
+        if state['status'] in ('done', 'failed'):
+            return state
+        time.sleep(0.01)
+
+    raise AssertionError(f'Job {job_id} did not finish')
+
+
+def test_submit(client):
+    job_id = jobs.submit(add, 1, 2, scale=10)
+    state = wait(client, job_id)
+    assert state['status'] == 'done'
+    assert state['progress'] == 1.
+    assert state['message'] == 'Adding'
+    assert state['function'] == 'add'
+
+    assert jobs.get_result(job_id) == 30
+    response = client.get(f'/job/{job_id}/result')
+    assert json.loads(response.data) == {'result': 30}
+
+
+def test_failure(client):
+    job_id = jobs.submit(fail)
+    state = wait(client, job_id)
+    assert state['status'] == 'failed'
+    assert 'bad input' in state['error']
+    assert 'ValueError' in state['traceback']
+
+    assert client.get(f'/job/{job_id}/result').status_code == 404
+    assert client.get('/job/missing').status_code == 404
+
+
+def test_cache(client, redis_db):
+    redis_db.set('responses:000', b'')
+    cache_key = f'add:{jobs.data_version("responses")}'
+    job_id = jobs.submit(add, 1, 2, cache_key=cache_key)
+    wait(client, job_id)
+    assert jobs.submit(add, 1, 2, cache_key=cache_key) == job_id
+
+    # new data changes the version, and so the key
+    redis_db.set('responses:001', b'')
+    new_cache_key = f'add:{jobs.data_version("responses")}'
+    assert new_cache_key != cache_key
+    new_job_id = jobs.submit(add, 1, 2, cache_key=new_cache_key)
+    assert new_job_id != job_id
+    wait(client, new_job_id)
+
+
+def test_failed_jobs_are_not_cached(client):
+    job_id = jobs.submit(fail, cache_key='fail')
+    wait(client, job_id)
+    assert jobs.submit(fail, cache_key='fail') != job_id
+
+
+def test_job_response(client):
+    with model.app.server.test_request_context():
+        response = jobs.job_response('abc')
+    assert response.status_code == 202
+    assert json.loads(response.data) == {'job_id': 'abc', 'state': '/job/abc',
+                                         'result': '/job/abc/result'}
+
+
+def test_fit_model_needs_features(client):
+    response = client.get('/model/test/fit')
+    assert response.status_code == 400
+    assert 'feature_name' in json.loads(response.data)['error']
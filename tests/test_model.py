@@ -0,0 +1,52 @@
+import pickle
+
+import numpy as np
+import pytest
+from sklearn import linear_model
+
+from realtimefmri import codec, decoding, ridge
+from realtimefmri.web_interface.apps import model as model_app
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    X = rng.randn(60, 8)
+    return X, X.dot(rng.randn(8, 3)) + rng.randn(60, 3)
+
+
+def test_store_ridge_model(redis_db, data):
+    X, Y = data
+    model = ridge.IncrementalRidge(alphas=[1., 10.]).partial_fit(X, Y).fit()
+    model_app.store_model('ridge', model)
+
+    assert codec.is_encoded(redis_db.get('model:ridge'))
+    assert model_app.model_version('ridge') == 1
+    stored = model_app.load_stored_model('ridge')
+    assert isinstance(stored, ridge.IncrementalRidge)
+    np.testing.assert_array_equal(stored.predict(X), model.predict(X))
+
+
+def test_store_compact_model(redis_db, data, tmpdir):
+    X, Y = data
+    estimator = linear_model.LogisticRegression().fit(X, Y[:, 0] > 0)
+    path = str(tmpdir.join('logistic'))
+    decoding.save_model(estimator, path)
+    model_app.store_model('logistic', decoding.load_model(path))
+
+    stored = model_app.load_stored_model('logistic')
+    assert isinstance(stored, decoding.LinearModel)
+    assert stored.path == path
+    np.testing.assert_array_equal(stored.predict(X), estimator.predict(X))
+
+
+def test_load_pickled_model(redis_db, data):
+    X, Y = data
+    estimator = linear_model.Ridge().fit(X, Y)
+    redis_db.set('model:pickled', pickle.dumps(estimator))
+
+    np.testing.assert_array_equal(model_app.load_stored_model('pickled').predict(X),
+                                  estimator.predict(X))
+    assert model_app.load_stored_model('missing') is None
+    with pytest.raises(TypeError):
+        model_app.store_model('pickled', estimator)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+from realtimefmri.online_moments import OnlineMoments
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    # large offset, where sums of raw powers lose precision
+    return (rng.gamma(2., size=(300, 40)) + 1e4).astype('float32')
+
+
+def reference_statistics(data):
+    return (data.mean(0, dtype='float64'), data.var(0, dtype='float64'),
+            stats.skew(data.astype('float64'), axis=0),
+            stats.kurtosis(data.astype('float64'), axis=0))
+
+
+def assert_statistics_close(moments, data):
+    for statistic, reference in zip(moments.get_statistics(), reference_statistics(data)):
+        np.testing.assert_allclose(statistic, reference, rtol=1e-6, atol=1e-8)
+
+
+def test_update(data):
+    moments = OnlineMoments(order=4)
+    for x in data:
+        moments.update(x)
+
+    assert moments.n == len(data)
+    assert_statistics_close(moments, data)
+
+
+def test_merge(data):
+    parts = [OnlineMoments(order=4) for _ in range(3)]
+    for part, chunk in zip(parts, np.array_split(data, [100, 250])):
+        for x in chunk:
+            part.update(x)
+
+    merged = OnlineMoments(order=4)
+    for part in parts:
+        merged.merge(part)
+
+    assert merged.n == len(data)
+    assert_statistics_close(merged, data)
+
+
+def test_concatenate(data):
+    parts = [OnlineMoments(order=4) for _ in range(2)]
+    for x in data:
+        parts[0].update(x[:15])
+        parts[1].update(x[15:])
+
+    joined = OnlineMoments.concatenate(parts)
+    assert_statistics_close(joined, data)
+
+    parts[0].update(data[0, :15])
+    with pytest.raises(ValueError):
+        OnlineMoments.concatenate(parts)
+
+
+def test_raw_moments(data):
+    data = data[:, :5] - 1e4
+    moments = OnlineMoments(order=3)
+    for x in data:
+        moments.update(x)
+
+    data = data.astype('float64')
+    for order, raw in enumerate(moments.get_raw_moments(), 1):
+        np.testing.assert_allclose(raw, (data ** order).sum(0), rtol=1e-8)
+
+
+def test_merge_different_orders():
+    with pytest.raises(ValueError):
+        OnlineMoments(order=4).merge(OnlineMoments(order=3))
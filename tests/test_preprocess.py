@@ -0,0 +1,431 @@
+import warnings
+
+import nibabel as nib
+import numpy as np
+import pytest
+from numpy.polynomial.legendre import Legendre
+from scipy import linalg as la
+
+from realtimefmri import config, preprocess
+
+
+def register(step):
+    step.register(f'pipeline:test:{id(step)}')
+    return step
+
+
+@pytest.fixture
+def samples():
+    rng = np.random.RandomState(0)
+    return (rng.randn(30, 50) * 3 + 100).astype('float32')
+
+
+@pytest.mark.parametrize('keep_history', [False, True])
+def test_incremental_mean_std(redis_db, samples, keep_history):
+    step = register(preprocess.IncrementalMeanStd(keep_history=keep_history))
+    assert step.run(samples[0]) == (None, None)
+
+    for i in range(1, len(samples)):
+        mean, std = step.run(samples[i])
+        assert mean.dtype == samples.dtype
+        np.testing.assert_allclose(mean, samples[:i + 1].mean(0), rtol=1e-6)
+        np.testing.assert_allclose(std, samples[:i + 1].std(0), rtol=1e-5)
+
+    if keep_history:
+        np.testing.assert_array_equal(step.data.get_array(), samples)
+
+    step.reset()
+    assert step.run(samples[0]) == (None, None)
+
+
+def test_incremental_mean_std_matches_batch(redis_db):
+    rng = np.random.RandomState(0)
+    # large offset, where the sums of squares of the samples lose precision
+    volumes = rng.randn(200, 4, 5) + 1e4
+    volumes[50, 0, 0] = np.nan
+    step = register(preprocess.IncrementalMeanStd())
+    step.run(volumes[0])
+
+    for i in range(1, len(volumes)):
+        mean, std = step.run(volumes[i])
+        assert mean.shape == volumes.shape[1:]
+        # the previous implementation took the mean and std of all samples so far
+        np.testing.assert_allclose(mean, volumes[:i + 1].mean(0), rtol=1e-12)
+        np.testing.assert_allclose(std, volumes[:i + 1].std(0), rtol=1e-7)
+
+    # a NaN sample only affects its own voxel
+    assert np.isnan(mean[0, 0]) and np.isnan(std[0, 0])
+    assert np.isfinite(mean.ravel()[1:]).all()
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'int16'])
+def test_volume_to_mosaic(redis_db, dtype):
+    cortex = pytest.importorskip('cortex')
+    volume = (np.random.RandomState(0).randn(6, 7, 5) * 100).astype(dtype)
+    reference = cortex.mosaic(volume.astype('float32'), show=False)[0]
+
+    step = register(preprocess.VolumeToMosaic())
+    np.testing.assert_array_equal(step.run(volume), reference)
+    np.testing.assert_array_equal(step.run(volume.T.copy().T), reference)
+
+
+def test_volume_to_mosaic_quantize(redis_db):
+    volume = np.random.RandomState(0).randn(6, 7, 5).astype('float32')
+    volume[0, 0, :2] = [np.nan, np.inf]
+    step = register(preprocess.VolumeToMosaic(quantize=True, vmin=-1., vmax=1.))
+    mosaic = step.run(volume)
+
+    assert mosaic.dtype == np.uint8
+    assert (mosaic.ravel()[step.padding] == 0).all()
+    expected = np.clip(np.nan_to_num((volume + 1.) * 127.5), 0, 255).astype('uint8')
+    expected = expected.ravel()[step.index]
+    expected.ravel()[step.padding] = 0
+    np.testing.assert_array_equal(mosaic, expected)
+
+
+@pytest.fixture
+def subject_directory(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'get_subject_directory', lambda subject: str(tmpdir))
+    return tmpdir
+
+
+def save_nifti(volume, path):
+    nib.Nifti1Image(volume, np.eye(4)).to_filename(str(path))
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_roi_activity_parcellation(redis_db, subject_directory, weighted):
+    rng = np.random.RandomState(0)
+    shape = (4, 5, 6)
+    pre_mask = rng.rand(*shape) > 0.3
+    save_nifti(pre_mask.astype('uint8'), subject_directory.join('mask.nii'))
+    if weighted:
+        # the last parcel is outside of the mask
+        parcellation = rng.rand(*shape, 3) * (rng.rand(*shape, 3) > 0.5)
+        parcellation[..., 2] *= ~pre_mask
+        parcel_weights = [parcellation[..., i][pre_mask] for i in range(3)]
+    else:
+        parcellation = rng.randint(0, 4, size=shape).astype('float32')
+        parcel_weights = [(parcellation == label)[pre_mask] for label in (1, 2, 3)]
+    save_nifti(parcellation, subject_directory.join('parcels.nii'))
+
+    step = register(preprocess.RoiActivity('subject', 'transform', 'mask',
+                                           parcellation_name='parcels'))
+    # activity is in zyx, the transpose of the nifti volumes
+    activity = rng.randn(*shape).astype('float32')
+    roi_activity = step.run(activity.T[pre_mask.T])
+
+    assert roi_activity.dtype == np.float32
+    assert step.roi_names == (['0', '1', '2'] if weighted else ['1', '2', '3'])
+    for roi, weights in zip(roi_activity, parcel_weights):
+        if weights.sum() == 0:
+            assert np.isnan(roi)
+        else:
+            np.testing.assert_allclose(roi, np.average(activity[pre_mask], weights=weights),
+                                       rtol=1e-5)
+
+
+class Scale(preprocess.PreprocessingStep):
+    """A step without a ``dtype`` argument or ``**kwargs``"""
+    def __init__(self, factor):
+        super(Scale, self).__init__(factor=factor)
+        self.factor = factor
+
+    def run(self, array):
+        return array * self.factor
+
+
+def test_pipeline_dtype(redis_db):
+    steps = [{'name': 'volume', 'class_name': 'realtimefmri.preprocess.NiftiToVolume',
+              'kwargs': {'dtype': 'float32'}, 'input': ['image'], 'output': ['volume']},
+             {'name': 'scale', 'class_name': f'{__name__}.Scale', 'kwargs': {'factor': 2},
+              'input': ['volume'], 'output': ['scaled']},
+             {'name': 'zscore', 'class_name': 'realtimefmri.preprocess.IncrementalMeanStd',
+              'input': ['scaled'], 'output': ['mean', 'std']}]
+    pipeline = preprocess.Pipeline(steps, global_parameters={'dtype': 'float64'})
+    assert 'dtype' not in pipeline.pipeline[2]['instance']._parameters
+
+    rng = np.random.RandomState(0)
+    for _ in range(3):
+        image = nib.Nifti1Image(rng.randn(4, 5, 6), np.eye(4))
+        data_dict = pipeline.process({'image': image})
+
+    assert data_dict['volume'].dtype == np.float32
+    assert data_dict['mean'].dtype == np.float32
+    assert data_dict['std'].dtype == np.float32
+
+    pipeline = preprocess.Pipeline([dict(steps[0], kwargs={})])
+    assert pipeline.global_parameters['dtype'] == preprocess.DEFAULT_DTYPE
+    data_dict = pipeline.process({'image': image})
+    assert data_dict['volume'].dtype == np.dtype(preprocess.DEFAULT_DTYPE)
+
+
+@pytest.fixture
+def compcor_masks(monkeypatch):
+    shape = (3, 4, 5)
+    masks = {'gm': np.zeros(shape, dtype=bool), 'wm': np.zeros(shape, dtype=bool)}
+    masks['gm'][:2] = True
+    masks['wm'][1:] = True
+    monkeypatch.setattr(preprocess.cortex_cache, 'get_mask',
+                        lambda surface, transform, mask_type: masks[mask_type])
+    return shape
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+def test_online_compcor_dtype(redis_db, compcor_masks, dtype):
+    step = register(preprocess.OnlineCompcorDetrending('subject', 'transform', n_components=2,
+                                                       mask_gray_matter='gm',
+                                                       mask_white_matter='wm', dtype=dtype))
+    rng = np.random.RandomState(0)
+    for _ in range(5):
+        gm = step.run(rng.randn(*compcor_masks))
+        assert gm.dtype == dtype
+    assert step.gm_data[:].dtype == dtype
+    assert step.wm_data[:].dtype == dtype
+
+
+@pytest.fixture
+def small_shards(monkeypatch):
+    """Shard even small test volumes over two threads"""
+    monkeypatch.setitem(preprocess._sharders, 2, preprocess.VoxelSharder(2, min_shard_size=4))
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_running_mean_std_matches_window(small_shards, n_workers):
+    rng = np.random.RandomState(0)
+    samples = rng.randn(40, 30) * 10 + 1e3
+    samples[[10, 12, 13], 3] = np.nan
+    samples[2, 4] = np.nan
+    samples[:, 5] = np.nan
+    n, n_skip = 6, 2
+    step = preprocess.RunningMeanStd(n=n, n_skip=n_skip, recompute_every=7, dtype='float64',
+                                     n_workers=n_workers)
+
+    for image_number, sample in enumerate(samples):
+        mean, std = step.run(sample, image_number)
+        if image_number < n_skip:
+            np.testing.assert_array_equal(mean, 0.)
+            np.testing.assert_array_equal(std, 1.)
+            continue
+
+        # the previous implementation took the nanmean and nanstd of a window of samples
+        window = samples[max(n_skip, image_number - n + 1):image_number + 1]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            np.testing.assert_allclose(mean, np.nanmean(window, 0), rtol=1e-12)
+            np.testing.assert_allclose(std, np.nanstd(window, 0), rtol=1e-8, atol=1e-10)
+
+    assert np.isnan(mean[5])
+
+
+def compcor_volumes(shape, n_volumes=25):
+    rng = np.random.RandomState(0)
+    drift = rng.randn(n_volumes, 2).cumsum(0)
+    loadings = rng.randn(2, *shape)
+    return (np.tensordot(drift, loadings, axes=1) + rng.randn(n_volumes, *shape) * 0.1 +
+            100)
+
+
+@pytest.mark.parametrize('window_size', [None, 8])
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_online_compcor_incremental_matches_batch(redis_db, compcor_masks, small_shards,
+                                                  window_size, n_workers):
+    def make_step(incremental, n_workers=1):
+        return register(preprocess.OnlineCompcorDetrending(
+            'subject', 'transform', n_components=2, window_size=window_size,
+            mask_gray_matter='gm', mask_white_matter='wm', incremental=incremental,
+            n_workers=n_workers, dtype='float64'))
+
+    incremental = make_step(True, n_workers)
+    batch = make_step(False)
+    for i, volume in enumerate(compcor_volumes(compcor_masks)):
+        detrended = incremental.run(volume)
+        np.testing.assert_allclose(detrended, batch.run(volume), rtol=1e-6, atol=1e-8)
+        if i < 2:
+            # too few samples to detrend
+            np.testing.assert_array_equal(detrended, volume[:2].ravel())
+
+
+def lstsq_detrend(data, poly_degree):
+    """Polynomial detrending of the previous implementation, by least squares on the design"""
+    n_samples = data.shape[0]
+    X = np.ones((n_samples, 1))
+    for d in range(poly_degree):
+        trend = Legendre.basis(d + 1)(np.linspace(-1, 1, n_samples))
+        X = np.hstack((X, trend[:, None]))
+    coef, _, _, _ = la.lstsq(X, data)
+    return data - X.dot(coef)
+
+
+@pytest.mark.parametrize('n_samples', [1, 2, 3, 30])
+@pytest.mark.parametrize('poly_degree', [0, 1, 3])
+def test_detrend_poly_matches_lstsq(n_samples, poly_degree):
+    data = np.random.RandomState(0).randn(n_samples, 10) + np.arange(n_samples)[:, None] * 5
+    reference = lstsq_detrend(data, poly_degree)
+
+    np.testing.assert_allclose(preprocess.detrend_poly(data, poly_degree), reference,
+                               atol=1e-10)
+    np.testing.assert_allclose(preprocess.detrend_poly(data, poly_degree, last_only=True),
+                               reference[-1], atol=1e-10)
+
+    detrended = preprocess.detrend_poly(data.astype('float32'), poly_degree)
+    assert detrended.dtype == np.float32
+    np.testing.assert_allclose(detrended, reference, atol=1e-4)
+
+
+def test_detrend_poly_nan():
+    data = np.random.RandomState(0).randn(20, 5)
+    data[3, 1] = np.nan
+    detrended = preprocess.detrend_poly(data, 2)
+
+    assert np.isnan(detrended[:, 1]).all()
+    finite = [0, 2, 3, 4]
+    np.testing.assert_allclose(detrended[:, finite], lstsq_detrend(data[:, finite], 2),
+                               atol=1e-10)
+
+
+def test_detrend_poly_projector_is_cached():
+    projector = preprocess.detrend_poly_projector(20, 2)
+    assert preprocess.detrend_poly_projector(20, 2) is projector
+    assert not projector.flags.writeable
+    np.testing.assert_allclose(projector, lstsq_detrend(np.eye(20), 2), atol=1e-12)
+
+
+def test_detrend_poly_step():
+    data = np.random.RandomState(0).randn(40, 3, 4) + np.arange(40)[:, None, None]
+    step = preprocess.DetrendPoly(window_size=10, poly_degree=1)
+    for i, volume in enumerate(data):
+        detrended = step.run(volume)
+        assert detrended.shape == volume.shape
+        if i < 2:
+            # too few samples to fit the trend
+            np.testing.assert_array_equal(detrended, 0.)
+        else:
+            window = data[max(0, i - 9):i + 1].reshape(-1, 12)
+            np.testing.assert_allclose(detrended.ravel(), lstsq_detrend(window, 1)[-1],
+                                       atol=1e-10)
+
+
+@pytest.mark.parametrize('n_voxels', [1, 7, 100, 101])
+def test_sharder_shards(n_voxels):
+    sharder = preprocess.VoxelSharder(3, min_shard_size=10)
+    shards = sharder.shards(n_voxels)
+    assert len(shards) == max(1, min(3, n_voxels // 10))
+    np.testing.assert_array_equal(np.concatenate([np.arange(n_voxels)[shard]
+                                                  for shard in shards]), np.arange(n_voxels))
+    assert sharder.shards(n_voxels) is shards
+
+
+def test_sharder_matches_serial():
+    rng = np.random.RandomState(0)
+    data = rng.randn(20, 1000)
+    data[3, 500] = np.nan
+    sharder = preprocess.VoxelSharder(4, min_shard_size=100)
+
+    def zscore(data, out, ddof=0):
+        out[:] = (data[-1] - data.mean(0)) / data.std(0, ddof=ddof)
+
+    out = np.empty(1000)
+    sharder.map(zscore, data, out, ddof=1)
+    expected = np.empty(1000)
+    zscore(data, expected, ddof=1)
+    np.testing.assert_array_equal(out, expected)
+
+    np.testing.assert_allclose(sharder.sum(lambda data: data.dot(data[-1]), data),
+                               data.dot(data[-1]))
+
+
+def staged_steps():
+    return [{'name': 'detrend', 'class_name': 'realtimefmri.preprocess.DetrendPoly',
+             'kwargs': {'window_size': 5}, 'stage': 'detrend',
+             'input': ['activity'], 'output': ['detrended']},
+            {'name': 'zscore', 'class_name': 'realtimefmri.preprocess.IncrementalMeanStd',
+             'stage': 'statistics', 'input': ['detrended'], 'output': ['mean', 'std']},
+            {'name': 'delay', 'class_name': 'realtimefmri.preprocess.DelayFeatures',
+             'kwargs': {'delays': [0, 1], 'copy': True}, 'input': ['detrended'],
+             'output': ['features']},
+            {'name': 'last', 'class_name': 'realtimefmri.preprocess.DetrendPoly',
+             'kwargs': {'window_size': 3, 'poly_degree': 0}, 'stage': 'last',
+             'input': ['features'], 'output': ['centered']}]
+
+
+def test_staged_matches_serial(redis_db):
+    activity = np.random.RandomState(0).randn(30, 8).cumsum(0)
+    activity[10, 2] = np.nan
+
+    serial = preprocess.Pipeline(staged_steps())
+    expected = [serial.process({'image_number': i, 'activity': x})
+                for i, x in enumerate(activity)]
+
+    staged = preprocess.Pipeline(staged_steps(), staged=True)
+    assert [[step['name'] for step in stage] for stage in staged.stages()] == \
+        [['detrend'], ['zscore', 'delay'], ['last']]
+    results = []
+    executor = preprocess.StagedExecutor(staged, queue_size=2, callback=results.append)
+    for i, x in enumerate(activity):
+        executor.submit({'image_number': i, 'activity': x})
+    executor.drain()
+    assert len(results) == len(activity)
+    executor.stop()
+
+    assert [result['image_number'] for result in results] == list(range(len(activity)))
+    for result, reference in zip(results, expected):
+        for key in ['detrended', 'mean', 'std', 'features', 'centered']:
+            if reference[key] is None:
+                assert result[key] is None
+            else:
+                np.testing.assert_array_equal(result[key], reference[key])
+
+
+def make_delayed(activity, delays):
+    """Delayed features of all volumes at once, with zeros before the first volume"""
+    delayed = []
+    for delay in delays:
+        shifted = np.zeros_like(activity)
+        shifted[delay:] = activity[:len(activity) - delay]
+        delayed.append(shifted)
+    return np.hstack(delayed)
+
+
+@pytest.mark.parametrize('delays', [[0, 1, 2], [1, 2, 3], [0, 2, 5], [3]])
+def test_delay_features_matches_batch(delays):
+    activity = np.random.RandomState(0).randn(12, 2, 3)
+    activity[4, 0, 1] = np.nan
+    reference = make_delayed(activity.reshape(12, -1), delays)
+
+    step = preprocess.DelayFeatures(delays=delays, copy=True, dtype='float64')
+    features = [step.run(volume) for volume in activity]
+    np.testing.assert_array_equal(features, reference)
+
+    # after a reset, earlier volumes are zeros again
+    step.reset()
+    np.testing.assert_array_equal(step.run(activity[5]),
+                                  make_delayed(activity[5:6].reshape(1, -1), delays)[0])
+
+
+def test_delay_features_selected_indices(subject_directory):
+    activity = np.random.RandomState(0).randn(10, 6)
+    reference = make_delayed(activity, [1, 2, 4])
+    selected_indices = np.array([17, 0, 5, 12, 6])
+    np.save(str(subject_directory.join('selected.npy')), selected_indices)
+
+    for indices in [selected_indices, 'selected.npy']:
+        step = preprocess.DelayFeatures(delays=[1, 2, 4], selected_indices=indices,
+                                        surface='subject', dtype='float64')
+        features = [step.run(x) for x in activity]
+        np.testing.assert_array_equal(features, reference[:, selected_indices])
+
+
+def test_delay_features_views():
+    activity = np.random.RandomState(0).randn(5, 4).astype('float32')
+    step = preprocess.DelayFeatures(delays=[0, 1])
+    first = step.run(activity[0])
+    assert first.dtype == np.float32
+    np.testing.assert_array_equal(first, np.r_[activity[0], np.zeros(4)])
+
+    # without copy, the features are a view that the next volume overwrites
+    step.run(activity[1])
+    assert not np.array_equal(first, np.r_[activity[0], np.zeros(4)])
+
+    with pytest.raises(ValueError):
+        preprocess.DelayFeatures(delays=[-1, 0])
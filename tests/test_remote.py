@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from realtimefmri import remote
+
+
+class Counter():
+    """Counts the volumes it has seen since it was reset"""
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+
+    def run(self, value):
+        self.count += 1
+        return [self.name, self.count, value]
+
+    def reset(self):
+        self.count = 0
+
+
+@pytest.fixture
+def serve(redis_db):
+    """Serve a worker in a thread while in the context"""
+    class Worker():
+        def __init__(self, step):
+            self.step = step
+
+        def __enter__(self):
+            self.stop = threading.Event()
+            self.thread = threading.Thread(target=remote.serve,
+                                           args=({'counter': self.step},),
+                                           kwargs={'timeout': 0.05, 'stop': self.stop})
+            self.thread.start()
+            return self.step
+
+        def __exit__(self, *exc_info):
+            self.stop.set()
+            self.thread.join()
+
+    return Worker
+
+
+def test_remote_run(serve):
+    step = remote.RemoteStep('counter', Counter('local'), deadline=5.)
+    with serve(Counter('worker')):
+        assert step.run(1.5) == ['worker', 1, 1.5]
+        assert step.run(2.5) == ['worker', 2, 2.5]
+
+    assert step.n_remote == 2
+    assert step.step.count == 0
+
+
+def test_remote_fallback(redis_db):
+    step = remote.RemoteStep('counter', Counter('local'), deadline=0.05)
+    assert step.run(1.) == ['local', 1, 1.]
+    assert step.n_local == 1
+
+
+def run_on_every_worker(step, workers, max_volumes=200):
+    """Run volumes until each worker has processed one, and return the first result of each"""
+    first_results = {}
+    for _ in range(max_volumes):
+        name, count, _ = step.run(0.)
+        first_results.setdefault(name, count)
+        if len(first_results) == len(workers):
+            return first_results
+
+    raise AssertionError(f'Only workers {list(first_results)} received volumes')
+
+
+def test_reset_reaches_every_worker(serve):
+    step = remote.RemoteStep('counter', Counter('local'), deadline=5.)
+    workers = [Counter('a'), Counter('b')]
+    with serve(workers[0]), serve(workers[1]):
+        assert run_on_every_worker(step, workers) == {'a': 1, 'b': 1}
+        for _ in range(5):
+            step.run(0.)
+
+        step.reset()
+        assert step.generation == 1
+        assert run_on_every_worker(step, workers) == {'a': 1, 'b': 1}
+
+    # a step created after the reset does not reset the workers again
+    late = remote.RemoteStep('counter', Counter('local'), deadline=5.)
+    assert late.generation == 1
+    count = workers[0].count
+    with serve(workers[0]):
+        assert late.run(0.) == ['a', count + 1, 0.]
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from sklearn import linear_model
+
+from realtimefmri import codec, ridge
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    X = rng.randn(200, 20) + 3
+    weights = rng.randn(20, 50)
+    weights[:, :25] *= 0.01
+    Y = X.dot(weights) + rng.randn(200, 50) * 2 + 5
+    return X, Y
+
+
+@pytest.mark.parametrize('fit_intercept', [True, False])
+def test_matches_sklearn_ridge(data, fit_intercept):
+    X, Y = data
+    model = ridge.IncrementalRidge(alphas=[10.], fit_intercept=fit_intercept).partial_fit(X, Y)
+    model.fit()
+
+    reference = linear_model.Ridge(alpha=10., fit_intercept=fit_intercept).fit(X, Y)
+    np.testing.assert_allclose(model.coef_, reference.coef_, rtol=1e-6, atol=1e-8)
+    np.testing.assert_allclose(model.intercept_, reference.intercept_, rtol=1e-6, atol=1e-8)
+    np.testing.assert_allclose(model.predict(X[:5]), reference.predict(X[:5]), rtol=1e-6)
+
+
+def test_partial_fit_matches_batch(data):
+    X, Y = data
+    batch = ridge.IncrementalRidge().partial_fit(X, Y).fit()
+
+    incremental = ridge.IncrementalRidge(chunk_size=7)
+    for start in range(0, 150, 50):
+        incremental.partial_fit(X[start:start + 50], Y[start:start + 50])
+    for x, y in zip(X[150:], Y[150:]):
+        incremental.partial_fit(x, y)
+    incremental.fit()
+
+    assert incremental.n_samples == len(X)
+    np.testing.assert_allclose(incremental.coef_, batch.coef_, rtol=1e-6, atol=1e-10)
+    np.testing.assert_allclose(incremental.intercept_, batch.intercept_, rtol=1e-6)
+    np.testing.assert_array_equal(incremental.alpha_, batch.alpha_)
+
+
+def test_alpha_per_target(data):
+    X, Y = data
+    alphas = [0.1, 10., 1000., 1e5]
+    model = ridge.IncrementalRidge(alphas=alphas).partial_fit(X, Y).fit()
+
+    assert model.gcv_.shape == (len(alphas), Y.shape[1])
+    np.testing.assert_array_equal(model.alpha_, np.array(alphas)[model.gcv_.argmin(0)])
+    # targets with weak weights need more regularization
+    assert np.median(model.alpha_[:25]) > np.median(model.alpha_[25:])
+
+    for target in [0, 49]:
+        reference = linear_model.Ridge(alpha=model.alpha_[target]).fit(X, Y[:, target])
+        np.testing.assert_allclose(model.coef_[target], reference.coef_, rtol=1e-6, atol=1e-8)
+
+
+def test_errors(data):
+    X, Y = data
+    with pytest.raises(ValueError):
+        ridge.IncrementalRidge().fit()
+    with pytest.raises(ValueError):
+        ridge.IncrementalRidge().partial_fit(X, Y[:10])
+
+
+def test_state_round_trip(data):
+    X, Y = data
+    model = ridge.IncrementalRidge(alphas=[1., 100.]).partial_fit(X[:100], Y[:100]).fit()
+    restored = ridge.IncrementalRidge.from_state(codec.decode(codec.encode(model.get_state()),
+                                                              allow_pickle=False))
+    np.testing.assert_array_equal(restored.predict(X[:5]), model.predict(X[:5]))
+
+    model.partial_fit(X[100:], Y[100:]).fit()
+    restored.partial_fit(X[100:], Y[100:]).fit()
+    assert restored.n_samples == len(X)
+    np.testing.assert_array_equal(restored.coef_, model.coef_)
+    np.testing.assert_array_equal(restored.alpha_, model.alpha_)
+
+    empty = ridge.IncrementalRidge.from_state(ridge.IncrementalRidge().get_state())
+    assert empty.n_samples == 0
+    assert empty.xtx is None